@@ -0,0 +1,304 @@
+"""Offline benchmark of the NWM API endpoints.
+
+The endpoints are driven through FastAPI's TestClient against the DuckDB
+backend, reading synthetic NWM-shaped Parquet files generated locally, so no
+BigQuery, GCS or deployed gateway is needed.
+
+Usage, from the repository root:
+
+    python benchmarks/api_benchmark.py
+    python benchmarks/api_benchmark.py --compare benchmarks/results/<commit>.json
+
+Each scenario reports its latency percentiles, throughput and the peak
+memory allocated by Python while it runs. The results are written as JSON to
+benchmarks/results/<commit>.json so runs on different commits can be
+compared with --compare.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+# Number of members and of hourly lead times written for each forecast run
+FORECAST_LAYOUT = dict(
+    short_range = dict(members=1, lead_times=18, step=1),
+    medium_range = dict(members=6, lead_times=40, step=6),
+    long_range = dict(members=4, lead_times=30, step=24),
+)
+
+# First reach id of the synthetic network
+FIRST_COMID = 1000001
+
+
+def generate_data(root, reaches, cycles, seed=0):
+    """Write synthetic NWM Parquet files in the layout read by the DuckDB backend.
+
+    Args:
+
+        root (str): The directory of the files.
+        reaches (int): The number of reaches of the network.
+        cycles (int): The number of cycles written for each forecast run.
+        seed (int): Seed of the random values.
+    """
+    rng = np.random.default_rng(seed)
+    comids = np.arange(FIRST_COMID, FIRST_COMID + reaches, dtype=np.int64)
+    first_cycle = datetime(2023, 1, 1)
+
+    def write(path, time):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        streamflow = rng.gamma(2, 5, reaches)
+        pq.write_table(pa.table(dict(
+            feature_id=comids,
+            time=pa.array(np.full(reaches, np.datetime64(time, 's'))),
+            streamflow=streamflow.astype(np.float32),
+            velocity=(streamflow / 10).astype(np.float32),
+        )), path)
+
+    # Forecast files, one per cycle, member and lead time
+    for forecast_type, layout in FORECAST_LAYOUT.items():
+        for cycle in range(cycles):
+            reference_time = first_cycle + timedelta(hours=6 * cycle)
+            for member in range(1, layout['members'] + 1):
+                if forecast_type == 'short_range':
+                    folder, suffix = 'short_range', 'channel_rt'
+                else:
+                    folder, suffix = f'{forecast_type}_mem{member}', f'channel_rt_{member}'
+                for lead_time in range(1, layout['lead_times'] + 1):
+                    hours = lead_time * layout['step']
+                    write(
+                        f'{root}/channel_rt/{folder}/nwm.{reference_time:%Y%m%d}.t{reference_time:%H}z.'
+                        f'{forecast_type}.{suffix}.f{hours:03d}.conus.parq',
+                        reference_time + timedelta(hours=hours),
+                    )
+
+    # Hourly analysis-assimilation files over the same period
+    for hour in range(6 * cycles):
+        cycle = first_cycle + timedelta(hours=hour)
+        write(
+            f'{root}/channel_rt/analysis_assim/nwm.{cycle:%Y%m%d}.t{cycle:%H}z.analysis_assim.channel_rt.tm01.conus.parq',
+            cycle - timedelta(hours=1),
+        )
+
+    # Static tables, the reaches being short segments spread over CONUS. The
+    # network is a random tree, every reach but the outlets flowing into one
+    # of the reaches before it
+    lon = rng.uniform(-124, -67, reaches)
+    lat = rng.uniform(25, 49, reaches)
+    outlets = max(1, reaches // 1000)
+    downstream = [None] * outlets + comids[rng.integers(0, np.arange(outlets, reaches))].tolist()
+    pq.write_table(pa.table(dict(
+        station_id=comids,
+        to=pa.array(downstream, pa.int64()),
+        geometry=[f'LINESTRING ({x:.5f} {y:.5f}, {x + 0.01:.5f} {y + 0.01:.5f})' for x, y in zip(lon, lat)],
+    )), f'{root}/stream_network.parquet')
+
+    flows = np.sort(rng.gamma(2, 20, (6, reaches)), axis=0)
+    pq.write_table(pa.table(dict(
+        feature_id=comids,
+        **{f'return_period_{rp}': flows[index] for index, rp in enumerate((2, 5, 10, 25, 50, 100))},
+    )), f'{root}/flood_return_periods.parquet')
+
+    return comids.tolist()
+
+
+def traversal_reaches(comids, downstream, basin_size=1000):
+    """Return the reach whose upstream basin is the closest to basin_size
+    reaches and the reach with the longest path down to its outlet."""
+    positions = {comid: position for position, comid in enumerate(comids)}
+    parents = [positions.get(comid, -1) if comid is not None else -1 for comid in downstream]
+
+    # Every reach flows into a reach before it, so the basins and depths are
+    # accumulated in one pass in each direction
+    sizes, depths = [1] * len(comids), [0] * len(comids)
+    for position in reversed(range(len(comids))):
+        if parents[position] >= 0:
+            sizes[parents[position]] += sizes[position]
+    for position in range(len(comids)):
+        if parents[position] >= 0:
+            depths[position] = depths[parents[position]] + 1
+
+    upstream = min(range(len(comids)), key=lambda position: abs(sizes[position] - basin_size))
+    return comids[upstream], comids[max(range(len(comids)), key=depths.__getitem__)]
+
+
+def scenarios(comids, downstream):
+    """Return the name and URL of every benchmark scenario."""
+    single = str(comids[0])
+    multi = ','.join(map(str, comids[:100]))
+    every = ','.join(map(str, comids))
+    upstream_of, downstream_of = traversal_reaches(comids, downstream)
+    return dict(
+        forecast_single_reach=f'/forecast?forecast_type=medium_range&comids={single}',
+        forecast_multi_reach=f'/forecast?forecast_type=medium_range&comids={multi}',
+        forecast_ensemble=f'/forecast?forecast_type=medium_range&comids={single}&ensemble=0,1,2,3,4,5',
+        forecast_long_range_ensemble=f'/forecast?forecast_type=long_range&comids={multi}&ensemble=0,1,2,3',
+        forecast_all_reaches=f'/forecast?forecast_type=short_range&comids={every}',
+        forecast_all_reaches_parquet=f'/forecast?forecast_type=short_range&comids={every}&output_format=parquet',
+        analysis_assim_single_reach=f'/analysis-assim?comids={single}&start_time=2023-01-01&end_time=2023-01-03',
+        analysis_assim_multi_reach=f'/analysis-assim?comids={multi}&start_time=2023-01-01&end_time=2023-01-03',
+        geometry_multi_reach=f'/geometry?comids={multi}',
+        geometry_nearest_reach='/geometry?lat=40.0&lon=-111.0',
+        return_period_single_reach=f'/return-period?comids={single}',
+        return_period_all_reaches=f'/return-period?comids={every}&output_format=csv',
+        forecast_upstream_basin=f'/forecast?forecast_type=short_range&upstream_of={upstream_of}',
+        forecast_downstream_path=f'/forecast?forecast_type=medium_range&downstream_of={downstream_of}',
+        return_period_basin_and_path=f'/return-period?upstream_of={upstream_of}&downstream_of={downstream_of}',
+    )
+
+
+def run_scenario(client, url, repeat, warmup):
+    # Warm up the connections and the file listings before measuring
+    for _ in range(warmup):
+        response = client.get(url)
+        response.raise_for_status()
+
+    latencies, response_bytes = [], 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        response_bytes += len(response.content)
+    elapsed = time.perf_counter() - started
+
+    # Trace the memory of one more request, tracing slows the measured ones down
+    tracemalloc.start()
+    client.get(url).raise_for_status()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return dict(
+        repeat=repeat,
+        mean_seconds=statistics.fmean(latencies),
+        p50_seconds=latencies[len(latencies) // 2],
+        p95_seconds=latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        min_seconds=latencies[0],
+        max_seconds=latencies[-1],
+        requests_per_second=repeat / elapsed,
+        response_bytes=response_bytes // repeat,
+        peak_memory_bytes=peak,
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline, threshold):
+    """Print the change of the p50 latency of every scenario against a baseline.
+
+    Returns the scenarios slower than the baseline by more than threshold.
+    """
+    regressions = []
+    print(f"\n{'scenario':34} {'baseline p50':>13} {'p50':>10} {'change':>8}")
+    for name, result in results['scenarios'].items():
+        reference = baseline['scenarios'].get(name)
+        if reference is None:
+            continue
+        change = result['p50_seconds'] / reference['p50_seconds'] - 1
+        flag = ' REGRESSION' if change > threshold else ''
+        print(f"{name:34} {reference['p50_seconds'] * 1000:11.1f}ms {result['p50_seconds'] * 1000:8.1f}ms {change:+8.1%}{flag}")
+        if flag:
+            regressions.append(name)
+
+    return regressions
+
+
+def main(argv=None):
+    """Main entry point; generates the data, runs the scenarios and stores the results."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reaches', type=int, default=10000, help='Number of reaches of the synthetic network.')
+    parser.add_argument('--cycles', type=int, default=2, help='Number of cycles of each forecast run.')
+    parser.add_argument('--repeat', type=int, default=10, help='Number of measured requests per scenario.')
+    parser.add_argument('--warmup', type=int, default=2, help='Number of unmeasured requests per scenario.')
+    parser.add_argument('--data-dir', help='Directory of the synthetic data, generated if missing. Defaults to a temporary directory.')
+    parser.add_argument('--scenario', action='append', help='Only run the given scenarios.')
+    parser.add_argument('--result-cache', action='store_true', help='Serve repeated requests from the result cache.')
+    parser.add_argument('--output', help='Path of the JSON results. Defaults to benchmarks/results/<commit>.json.')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown of the p50 latency reported as a regression.')
+    args = parser.parse_args(argv)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='nwm-benchmark-')
+    if not os.path.exists(os.path.join(data_dir, 'stream_network.parquet')):
+        print(f'Generating {args.reaches} reaches in {data_dir}')
+        generate_data(data_dir, args.reaches, args.cycles)
+    network = pq.read_table(os.path.join(data_dir, 'stream_network.parquet'), columns=['station_id', 'to'])
+    comids, downstream = network['station_id'].to_pylist(), network['to'].to_pylist()
+
+    # The settings are read when the application is imported
+    os.environ['NWM_API_BACKEND'] = 'duckdb'
+    os.environ['NWM_API_PARQUET_ROOT'] = data_dir
+    os.environ['NWM_API_NETWORK_TOPOLOGY_PATH'] = os.path.join(data_dir, 'network_topology.npz')
+    if not args.result_cache:
+        os.environ['NWM_API_RESULT_CACHE_MAX_BYTES'] = '0'
+        os.environ.pop('NWM_API_RESULT_CACHE_DIR', None)
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from app.topology import network_topology
+
+    # Keep the per-request logs out of the report
+    logging.getLogger('app.requests').disabled = True
+
+    results = dict(
+        commit=git_commit(),
+        created_at=datetime.now(timezone.utc).isoformat(),
+        python=platform.python_version(),
+        machine=platform.platform(),
+        reaches=len(comids),
+        result_cache=args.result_cache,
+        scenarios={},
+    )
+
+    with TestClient(app) as client:
+        # Wait for the network topology built in the background at startup
+        deadline = time.monotonic() + 60
+        while network_topology.get() is None and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        for name, url in scenarios(comids, downstream).items():
+            if args.scenario and name not in args.scenario:
+                continue
+            result = results['scenarios'][name] = run_scenario(client, url, args.repeat, args.warmup)
+            print(
+                f"{name:34} p50 {result['p50_seconds'] * 1000:8.1f}ms  p95 {result['p95_seconds'] * 1000:8.1f}ms  "
+                f"{result['requests_per_second']:7.1f} req/s  peak {result['peak_memory_bytes'] / 2 ** 20:7.1f} MiB"
+            )
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,29 @@
 import argparse
 
 import apache_beam as beam
-import geopandas as gpd
+from dateutil import parser as date_parser
 
+# Run from the src/ directory, or with it on PYTHONPATH, to use the query backend of the API
+from app.export import ExportJob, export_shard, export_spec, parse_bbox, resolve_reaches
 
-def main(argv=None):
-    """Main entry point; defines and runs the export pipeline."""
 
-    gdf = gpd.read_file('/Users/kelmarkert/Downloads/NHDPlusCA 2/NHDPlus18/NHDSnapshot/NHDSnapshot.gdb', driver='FileGDB', layer='NHDFlowline')
-    reach_ids = ','.join(map(str, gdf['Permanent_Identifier'].values[:20000]))
+def main(argv=None):
+    """Main entry point; defines and runs the export pipeline.
 
-    print(len(reach_ids))
+    The export is prepared like `python -m app.export`, then every pending
+    shard is exported by a Beam worker to its own Parquet file. Running the
+    pipeline again only exports the shards without a part file.
+    """
 
     parser = argparse.ArgumentParser()
 
+    parser.add_argument(
+        '--forecast_type',
+        type=str,
+        default='long_range',
+        help='The forecast run to export.'
+    )
+
     parser.add_argument(
         '--reference_time',
         type=str,
@@ -21,6 +31,25 @@ def main(argv=None):
         help='The reference time of the forecast to export.'
     )
 
+    reaches = parser.add_mutually_exclusive_group(required=True)
+    reaches.add_argument('--comids', type=str, help='A comma-separated list of reach IDs.')
+    reaches.add_argument('--hydroshare_id', type=str, help='A HydroShare resource listing the reach IDs.')
+    reaches.add_argument('--bbox', type=str, help='The min_lon,min_lat,max_lon,max_lat bounding box of the reaches.')
+
+    parser.add_argument(
+        '--output',
+        type=str,
+        required=True,
+        help='The directory of the exports, visible to every worker.'
+    )
+
+    parser.add_argument(
+        '--shard_reaches',
+        type=int,
+        default=5000,
+        help='The number of reaches of every shard.'
+    )
+
     parser.add_argument(
         '--runner',
         type=str,
@@ -29,50 +58,32 @@ def main(argv=None):
         help='The runner on which to execute the pipeline.'
     )
 
-    args, pipeline_args = parser.parse_known_args()
+    args, pipeline_args = parser.parse_known_args(argv)
 
-    if pipeline_args is not None and args.runner == 'DataflowRunner':
-        #define pipeline options
-        opts = beam.pipeline.PipelineOptions(flags=pipeline_args)
-    
-    elif pipeline_args is None and args.runner == 'DataflowRunner':
+    if not pipeline_args and args.runner == 'DataflowRunner':
         raise RuntimeError('No pipeline args were supplied with DataflowRunner.')
-    
-    elif pipeline_args is not None and args.runner == 'DirectRunner':
-        opts = beam.pipeline.PipelineOptions(flags=pipeline_args)
-
-    else:
-        opts = None
-
-    query = f'''
-        SELECT 
-            time, 
-            reference_time, 
-            streamflow, 
-            velocity, 
-            ensemble
-        FROM
-            `ciroh-water-demo.national_water_model_demo.channel_rt_long_range`
-        WHERE 
-            reference_time = "{args.reference_time}"
-            AND feature_id IN ({", ".join(map(str, reach_ids.split(',')))})
-    '''
+
+    # Define the pipeline options, the DirectRunner exporting the shards with local processes by default
+    opts = beam.pipeline.PipelineOptions(flags=pipeline_args or ['--direct_running_mode=multi_processing'])
+
+    comids = resolve_reaches(
+        list(map(int, args.comids.split(','))) if args.comids else None,
+        args.hydroshare_id,
+        parse_bbox(args.bbox) if args.bbox else None,
+    )
+    spec = export_spec(args.forecast_type, date_parser.parse(args.reference_time), comids, None, args.shard_reaches)
+    job = ExportJob.create(args.output, spec)
+    print(f'Export {job.id}: {len(job.pending_shards())} of {job.shards} shards to export in {job.directory}')
 
     with beam.Pipeline(runner=args.runner, options=opts) as p:
-        (p 
-            | 'QueryTable' >> beam.io.ReadFromBigQuery(
-                query=query,
-                project='kmarkert-personal',
-                gcs_location='gs://kmarkert_phd_research/nwm_dataflow_output/temp',
-                use_standard_sql=True
-            )
-            | 'WriteToText' >> beam.io.WriteToText(
-                'gs://kmarkert_phd_research/nwm_dataflow_output/long_range.csv'
-            )
+        (p
+            | 'Shards' >> beam.Create(job.pending_shards())
+            | 'ExportShard' >> beam.Map(lambda shard: export_shard(job.directory, job.spec, shard))
+            | 'Report' >> beam.Map(print)
         )
 
     return
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,1050 @@
+# Import libraries required for data processing
+import asyncio
+import re
+import threading
+from datetime import datetime, timedelta
+from dateutil import parser
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Import libraries associated with the query engines
+import anyio.to_thread
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+from google.cloud import bigquery, bigquery_storage
+from requests.adapters import HTTPAdapter
+
+from . import queries
+from .config import settings
+from .queries import AGGREGATE_INTERVALS, FORECAST_OPTS, RETURN_PERIODS, parse_statistics
+from .result_cache import ArrowRows, forecast_ttl
+
+# Pattern of the forecast cycle encoded in NWM file names, e.g. "nwm.20230101.t06z"
+CYCLE_PATTERN = re.compile(r'nwm\.(\d{8})\.t(\d{2})z')
+
+
+class QueryBackend:
+    """Interface of the query engines used by the API endpoints.
+
+    Each method returns an iterable of mapping-like rows (anything exposing
+    ``items()``) so the endpoints can treat every engine the same way. The
+    rows are produced lazily, page by page, so they can be streamed. Results
+    may also provide ``to_arrow_iterable()`` to be read as Arrow record
+    batches without building the rows, and an async ``wait()`` completing once
+    the rows can be read without blocking on the query.
+    """
+
+    def latest_reference_time(self, forecast_type: str):
+        """Return the most recent reference time available for forecast_type."""
+        raise NotImplementedError
+
+    def forecast(self, forecast_type: str, reference_time, comids: list, ensembles: list | None):
+        """Return the forecast rows for the given cycle, reaches and ensembles.
+
+        If reference_time is None the latest available cycle is returned. If
+        ensembles is None the members are averaged and reported with an
+        ensemble value of 'average'.
+        """
+        raise NotImplementedError
+
+    def forecast_cycles(
+        self, forecast_type: str, start_time, end_time, reference_times: list | None, comids: list, ensembles: list | None,
+    ):
+        """Return the forecast rows of every cycle between start_time and end_time.
+
+        If reference_times is given only these cycles are returned. The rows
+        are ordered by cycle, reach, ensemble and lead time, in hours since
+        the reference time.
+        """
+        raise NotImplementedError
+
+    def ensemble_members(self, forecast_type: str, reference_time, comids: list | None = None):
+        """Return the members of a forecast cycle, one row per reach and time.
+
+        The streamflow and velocity columns hold the values of the members
+        as lists. If comids is None every reach of the cycle is returned.
+        """
+        raise NotImplementedError
+
+    def analysis_assim(
+        self, comids: list, run_offset: int, start_time: str, end_time: str,
+        aggregate: str | None = None, statistics: list | None = None,
+    ):
+        """Return the analysis-assimilation rows between start_time and end_time.
+
+        If aggregate is 'hourly', 'daily' or 'monthly', one row per reach and
+        interval is returned instead, holding the statistics of the records
+        of the interval.
+        """
+        raise NotImplementedError
+
+    def stream_network(self, station_ids: list):
+        """Return the stream_network records of the given reaches."""
+        raise NotImplementedError
+
+    def nearest_reach(self, lat: float, lon: float, k: int = 1, max_distance: float | None = None):
+        """Return the k stream_network records closest to a point with their distance in meters.
+
+        Reaches farther than max_distance meters, if given, are ignored.
+        """
+        raise NotImplementedError
+
+    def reach_geometries(self):
+        """Return the station_id and WKT geometry of every reach of the stream_network."""
+        raise NotImplementedError
+
+    def reach_topology(self):
+        """Return the station_id and downstream station_id, to, of every reach of the stream_network."""
+        raise NotImplementedError
+
+    def static_table(self, name: str):
+        """Return every record of the stream_network or flood_return_periods table."""
+        raise NotImplementedError
+
+    def return_periods(self, comids: list, return_periods: list | None, order_by_comid: bool):
+        """Return the flood return-period records of the given reaches."""
+        raise NotImplementedError
+
+    def dry_run(self, method: str, *args) -> dict:
+        """Estimate the cost of the query run by method for the given arguments.
+
+        The query is validated but not run; the returned dictionary holds the
+        number of bytes it would scan as total_bytes_processed.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """Return counters describing the engine usage."""
+        return {}
+
+    def close(self):
+        """Release the connections held by the engine."""
+
+
+class BigQueryBackend(QueryBackend):
+    """Query engine reading the NWM public dataset in BigQuery.
+
+    A single client is shared by every request and worker thread. Its HTTP
+    session keeps a bounded pool of keep-alive connections so credential
+    discovery and TLS setup only happen once per connection. The queries are
+    built by the queries module with typed parameters, so identical requests
+    can be answered from the BigQuery query cache.
+
+    Args:
+
+        pool_size (int): Maximum number of connections kept open to the
+            BigQuery API.
+        page_size (int): Number of rows retrieved per page of results.
+        project (str, optional): The project billed for the queries.
+            Defaults to the project of the application default credentials.
+        poll_seconds (float): Longest delay between two checks of a running job.
+    """
+
+    # Number of clients created in the process, which should stay at one
+    _clients_created = 0
+    _clients_lock = threading.Lock()
+
+    def __init__(self, pool_size: int = 32, project: str | None = None, page_size: int = 10000, poll_seconds: float = 1):
+        # Set up the credentials and the pooled HTTP session once per process
+        credentials, default_project = google.auth.default(scopes=bigquery.Client.SCOPE)
+        self._session = AuthorizedSession(credentials)
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', self._adapter)
+
+        self.client = bigquery.Client(
+            project=project or default_project,
+            credentials=credentials,
+            _http=self._session,
+        )
+        with BigQueryBackend._clients_lock:
+            BigQueryBackend._clients_created += 1
+        self.page_size = page_size
+        self.poll_seconds = poll_seconds
+
+        # Read large results as Arrow through the BigQuery Storage Read API
+        self.bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=credentials)
+
+        self._queries = 0
+        self._lock = threading.Lock()
+
+    def _job_config(self, query, dry_run=False):
+        # Dry runs skip the query cache so the bytes a query scans are reported
+        return bigquery.QueryJobConfig(
+            query_parameters=query.parameters,
+            use_query_cache=not dry_run,
+            dry_run=dry_run,
+        )
+
+    def run_query(self, query):
+        # Count the queries sent through the shared client
+        with self._lock:
+            self._queries += 1
+
+        # Submit the job to BigQuery, the result pages are retrieved lazily once it is done
+        query_job = self.client.query(query.sql, job_config=self._job_config(query))
+
+        return BigQueryRows(query_job, self.page_size, self.bqstorage_client, self.poll_seconds)
+
+    def dry_run(self, method, *args):
+        # Validate the query and estimate its cost without running it
+        query = getattr(queries, method)(*args)
+        query_job = self.client.query(query.sql, job_config=self._job_config(query, dry_run=True))
+
+        return dict(total_bytes_processed=query_job.total_bytes_processed)
+
+    def stats(self):
+        # Count the connections opened and the requests sent through the pool
+        pools = self._adapter.poolmanager.pools
+        pools = [pools[key] for key in pools.keys()]
+        return dict(
+            clients_created=BigQueryBackend._clients_created,
+            queries=self._queries,
+            connections_opened=sum(pool.num_connections for pool in pools),
+            http_requests=sum(pool.num_requests for pool in pools),
+        )
+
+    def close(self):
+        self.bqstorage_client.transport.close()
+        self.client.close()
+        self._session.close()
+
+    def latest_reference_time(self, forecast_type):
+        latest_reference_time_result = self.run_query(queries.latest_reference_time(forecast_type))
+
+        # Iterate over the results to get the latest reference_time
+        reference_time = None
+        for row in latest_reference_time_result:
+            reference_time = row['latest_reference_time']
+
+        return reference_time
+
+    def forecast(self, forecast_type, reference_time, comids, ensembles):
+        return self.run_query(queries.forecast(forecast_type, reference_time, comids, ensembles))
+
+    def forecast_cycles(self, forecast_type, start_time, end_time, reference_times, comids, ensembles):
+        return self.run_query(queries.forecast_cycles(forecast_type, start_time, end_time, reference_times, comids, ensembles))
+
+    def ensemble_members(self, forecast_type, reference_time, comids=None):
+        return self.run_query(queries.ensemble_members(forecast_type, reference_time, comids))
+
+    def analysis_assim(self, comids, run_offset, start_time, end_time, aggregate=None, statistics=None):
+        return self.run_query(queries.analysis_assim(comids, run_offset, start_time, end_time, aggregate, statistics))
+
+    def stream_network(self, station_ids):
+        return self.run_query(queries.stream_network(station_ids))
+
+    def nearest_reach(self, lat, lon, k=1, max_distance=None):
+        return self.run_query(queries.nearest_reach(lat, lon, k, max_distance))
+
+    def reach_geometries(self):
+        return self.run_query(queries.reach_geometries())
+
+    def reach_topology(self):
+        return self.run_query(queries.reach_topology())
+
+    def static_table(self, name):
+        return self.run_query(queries.static_table(name))
+
+    def return_periods(self, comids, return_periods, order_by_comid):
+        return self.run_query(queries.return_periods(comids, return_periods, order_by_comid))
+
+
+class BigQueryRows:
+    """Lazily consumed result of a BigQuery job.
+
+    Reading the rows blocks until the job is done. Async callers can await
+    ``wait()`` first, which polls the job from the event loop instead of
+    holding a thread for the whole duration of the query.
+
+    Args:
+
+        query_job (google.cloud.bigquery.QueryJob): The submitted job.
+        page_size (int): Number of rows retrieved per page of results.
+        bqstorage_client (BigQueryReadClient): Client of the Storage Read API
+            used when the result is read as Arrow.
+        poll_seconds (float): Longest delay between two checks of the job.
+    """
+
+    def __init__(self, query_job, page_size, bqstorage_client, poll_seconds=1):
+        self.query_job = query_job
+        self._page_size = page_size
+        self._bqstorage_client = bqstorage_client
+        self._poll_seconds = poll_seconds
+        self._results = None
+
+    async def wait(self):
+        """Wait until the job is done, checking it with a growing delay."""
+        delay = 0.05
+        while not await anyio.to_thread.run_sync(self.query_job.done):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self._poll_seconds)
+
+    def statistics(self) -> dict:
+        """Return the statistics of the completed job."""
+        job = self.query_job
+        return dict(
+            job_id=job.job_id,
+            total_bytes_processed=job.total_bytes_processed,
+            total_bytes_billed=job.total_bytes_billed,
+            cache_hit=job.cache_hit,
+            slot_millis=job.slot_millis,
+            queue_seconds=(job.started - job.created).total_seconds() if job.started and job.created else None,
+            run_seconds=(job.ended - job.started).total_seconds() if job.ended and job.started else None,
+        )
+
+    def _rows(self):
+        # Block until the job is done and open the first page of results
+        if self._results is None:
+            self._results = self.query_job.result(page_size=self._page_size)
+        return self._results
+
+    def __iter__(self):
+        return iter(self._rows())
+
+    def to_arrow_iterable(self):
+        """Yield the result as pyarrow RecordBatches."""
+        return self._rows().to_arrow_iterable(bqstorage_client=self._bqstorage_client)
+
+
+class DuckDBRows:
+    """Lazily consumed result of a DuckDB query.
+
+    The result is read once, either row by row or as Arrow record batches,
+    mirroring the BigQuery RowIterator.
+
+    Args:
+
+        cursor (duckdb.DuckDBPyConnection): The cursor holding the executed query.
+        batch_size (int): Number of rows fetched at once.
+    """
+
+    def __init__(self, cursor, batch_size: int):
+        self._cursor = cursor
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        # Fetch the rows in batches so they can be streamed to the client
+        columns = [column[0] for column in self._cursor.description]
+        try:
+            while True:
+                batch = self._cursor.fetchmany(self.batch_size)
+                if not batch:
+                    return
+                for values in batch:
+                    yield dict(zip(columns, values))
+        finally:
+            self._cursor.close()
+
+    def to_arrow_iterable(self):
+        """Yield the result as pyarrow RecordBatches."""
+        try:
+            yield from self._cursor.to_arrow_reader(self.batch_size)
+        finally:
+            self._cursor.close()
+
+
+class DuckDBBackend(QueryBackend):
+    """Query engine reading NWM Parquet files with DuckDB.
+
+    The files are read from a local directory or any fsspec/httpfs location
+    following the national-water-model-parq layout:
+
+        channel_rt/long_range_mem1/nwm.20230101.t00z.long_range.channel_rt_1.f006.conus.parq
+        channel_rt/short_range/nwm.20230101.t00z.short_range.channel_rt.f001.conus.parq
+        channel_rt/analysis_assim/nwm.20230101.t00z.analysis_assim.channel_rt.tm01.conus.parq
+        stream_network.parquet
+        flood_return_periods.parquet
+
+    The reference time and ensemble of forecast records are taken from the file
+    names, so only the files of the requested cycle and members are opened.
+
+    Args:
+
+        root (str): Local directory or URL holding the Parquet files.
+        batch_size (int): Number of rows fetched at once while streaming results.
+    """
+
+    # Columns derived from the forecast file names
+    _REFERENCE_TIME_SQL = r"strptime(regexp_extract(filename, 'nwm\.(\d{8}\.t\d{2})z', 1), '%Y%m%d.t%H')"
+    _ENSEMBLE_SQL = r"COALESCE(TRY_CAST(NULLIF(regexp_extract(filename, 'channel_rt_(\d+)\.', 1), '') AS INTEGER) - 1, 0)"
+
+    def __init__(self, root: str, batch_size: int = 10000):
+        import duckdb
+
+        self.root = root.rstrip('/')
+        self.batch_size = batch_size
+        self._con = duckdb.connect()
+
+        # Make remote roots readable through httpfs or a registered fsspec filesystem
+        if '://' in self.root:
+            protocol = self.root.split('://')[0]
+            if protocol in ('s3', 'gcs', 'gs', 'http', 'https'):
+                self._con.execute("INSTALL httpfs; LOAD httpfs;")
+                if protocol in ('gcs', 'gs'):
+                    self._con.execute("SET s3_endpoint='storage.googleapis.com';")
+            else:
+                import fsspec
+                self._con.register_filesystem(fsspec.filesystem(protocol))
+
+    def close(self):
+        self._con.close()
+
+    def _execute(self, query, params=None):
+        # Use a cursor per call so the connection can be shared across worker threads
+        cursor = self._con.cursor()
+        try:
+            result = cursor.execute(query, params or [])
+        except Exception:
+            cursor.close()
+            raise
+
+        return DuckDBRows(cursor, self.batch_size)
+
+    def _glob(self, patterns):
+        # Resolve the file patterns, silently ignoring the ones without matches
+        files = []
+        for pattern in patterns:
+            files.extend(row['file'] for row in self._execute("SELECT file FROM glob(?)", [pattern]))
+        return sorted(files)
+
+    def _forecast_files(self, forecast_type, reference_time=None, ensembles=None):
+        # Narrow the file listing to the requested cycle and ensemble members
+        cycle = reference_time.strftime('nwm.%Y%m%d.t%Hz') if reference_time else 'nwm.*'
+        if forecast_type == 'short_range':
+            folders = ['short_range']
+        elif ensembles:
+            folders = [f'{forecast_type}_mem{ensemble + 1}' for ensemble in ensembles]
+        else:
+            folders = [f'{forecast_type}_mem*']
+
+        return self._glob(
+            f'{self.root}/channel_rt/{folder}/{cycle}.*.parq*' for folder in folders
+        )
+
+    def latest_reference_time(self, forecast_type):
+        # The latest cycle is read from the file names without opening any file
+        cycles = [CYCLE_PATTERN.search(file) for file in self._forecast_files(forecast_type)]
+        cycles = [datetime.strptime(''.join(match.groups()), '%Y%m%d%H') for match in cycles if match]
+
+        return max(cycles) if cycles else None
+
+    def forecast(self, forecast_type, reference_time, comids, ensembles):
+        # The latest cycle is found from the file names
+        if reference_time is None:
+            reference_time = self.latest_reference_time(forecast_type)
+            if reference_time is None:
+                return []
+
+        files = self._forecast_files(forecast_type, reference_time, ensembles)
+        if not files:
+            return []
+
+        source = f"""
+            SELECT
+                feature_id,
+                {self._REFERENCE_TIME_SQL} AS reference_time,
+                time,
+                {self._ENSEMBLE_SQL} AS ensemble,
+                streamflow,
+                velocity
+            FROM
+                read_parquet(?, filename=true, union_by_name=true)
+            WHERE
+                feature_id IN ({", ".join("?" * len(comids))})
+        """
+
+        if not ensembles:
+            # Average the members when no ensemble is specified
+            query = f"""
+                SELECT
+                    feature_id,
+                    reference_time,
+                    time,
+                    'average' AS ensemble,
+                    AVG(streamflow) AS streamflow,
+                    AVG(velocity) AS velocity
+                FROM ({source})
+                GROUP BY
+                    feature_id, reference_time, time
+                ORDER BY time
+            """
+        else:
+            query = f"""
+                SELECT *
+                FROM ({source})
+                WHERE ensemble IN ({", ".join("?" * len(ensembles))})
+                ORDER BY time
+            """
+
+        return self._execute(query, [files, *comids, *(ensembles or [])])
+
+    def forecast_cycles(self, forecast_type, start_time, end_time, reference_times, comids, ensembles):
+        start_time, end_time = _parse_time(start_time), _parse_time(end_time)
+        reference_times = {_parse_time(value) for value in reference_times} if reference_times else None
+
+        # Only open the files of the cycles inside the window or the list
+        files = []
+        for file in self._forecast_files(forecast_type, ensembles=ensembles):
+            match = CYCLE_PATTERN.search(file)
+            cycle = datetime.strptime(''.join(match.groups()), '%Y%m%d%H') if match else None
+            if cycle is not None and start_time <= cycle <= end_time and (not reference_times or cycle in reference_times):
+                files.append(file)
+        if not files:
+            return []
+
+        source = f"""
+            SELECT
+                feature_id,
+                {self._REFERENCE_TIME_SQL} AS reference_time,
+                time,
+                {self._ENSEMBLE_SQL} AS ensemble,
+                streamflow,
+                velocity
+            FROM
+                read_parquet(?, filename=true, union_by_name=true)
+            WHERE
+                feature_id IN ({", ".join("?" * len(comids))})
+        """
+
+        if not ensembles:
+            # Average the members when no ensemble is specified
+            query = f"""
+                SELECT
+                    feature_id,
+                    reference_time,
+                    date_diff('hour', reference_time, time) AS lead_time,
+                    time,
+                    'average' AS ensemble,
+                    AVG(streamflow) AS streamflow,
+                    AVG(velocity) AS velocity
+                FROM ({source})
+                GROUP BY
+                    feature_id, reference_time, time
+                ORDER BY
+                    reference_time, feature_id, lead_time
+            """
+        else:
+            query = f"""
+                SELECT
+                    feature_id,
+                    reference_time,
+                    date_diff('hour', reference_time, time) AS lead_time,
+                    time,
+                    ensemble,
+                    streamflow,
+                    velocity
+                FROM ({source})
+                WHERE ensemble IN ({", ".join("?" * len(ensembles))})
+                ORDER BY
+                    reference_time, feature_id, ensemble, lead_time
+            """
+
+        return self._execute(query, [files, *comids, *(ensembles or [])])
+
+    def ensemble_members(self, forecast_type, reference_time, comids=None):
+        files = self._forecast_files(forecast_type, reference_time)
+        if not files:
+            return []
+
+        comids_sql = f"WHERE feature_id IN ({', '.join('?' * len(comids))})" if comids is not None else ""
+        query = f"""
+            SELECT
+                feature_id,
+                reference_time,
+                time,
+                list(streamflow ORDER BY ensemble) FILTER (WHERE streamflow IS NOT NULL) AS streamflow,
+                list(velocity ORDER BY ensemble) FILTER (WHERE velocity IS NOT NULL) AS velocity
+            FROM (
+                SELECT
+                    feature_id,
+                    {self._REFERENCE_TIME_SQL} AS reference_time,
+                    time,
+                    {self._ENSEMBLE_SQL} AS ensemble,
+                    streamflow,
+                    velocity
+                FROM
+                    read_parquet(?, filename=true, union_by_name=true)
+                {comids_sql}
+            )
+            GROUP BY
+                feature_id, reference_time, time
+        """
+
+        return self._execute(query, [files, *(comids or [])])
+
+    def analysis_assim(self, comids, run_offset, start_time, end_time, aggregate=None, statistics=None):
+        start_time, end_time = _parse_time(start_time), _parse_time(end_time)
+
+        # Only open the cycles that can hold records inside the requested range
+        files = []
+        for file in self._glob([f'{self.root}/channel_rt/analysis_assim/nwm.*.tm{run_offset:02d}.*.parq*']):
+            match = CYCLE_PATTERN.search(file)
+            cycle = datetime.strptime(''.join(match.groups()), '%Y%m%d%H') if match else None
+            if cycle is None or start_time <= cycle <= end_time + timedelta(hours=run_offset):
+                files.append(file)
+        if not files:
+            return []
+
+        query = f"""
+            SELECT
+                feature_id,
+                time,
+                streamflow,
+                velocity
+            FROM
+                read_parquet(?, union_by_name=true)
+            WHERE
+                feature_id IN ({", ".join("?" * len(comids))})
+                AND time >= ?
+                AND time <= ?
+            ORDER BY
+                time
+        """
+
+        if aggregate is not None:
+            # Group the records of every reach by interval
+            interval = f"CAST(date_trunc('{AGGREGATE_INTERVALS[aggregate].lower()}', time) AS TIMESTAMP)"
+            fields = ["feature_id", f"{interval} AS time"]
+            for statistic in parse_statistics(statistics):
+                fields += [f"{_statistic_sql(statistic, column)} AS {column}_{statistic}" for column in ("streamflow", "velocity")]
+
+            query = f"""
+                SELECT
+                    {", ".join(fields + ["COUNT(*) AS count"])}
+                FROM ({query})
+                GROUP BY
+                    1, 2
+                ORDER BY
+                    2, 1
+            """
+
+        return self._execute(query, [files, *comids, start_time, end_time])
+
+    def _static_files(self, name):
+        # The files of a static table, bound as a parameter of read_parquet
+        return f'{self.root}/{name}.parq*'
+
+    def stream_network(self, station_ids):
+        query = f"""
+            SELECT
+                *
+            FROM
+                read_parquet(?)
+            WHERE
+                station_id IN ({", ".join("?" * len(station_ids))})
+            ORDER BY
+                station_id
+        """
+
+        return self._execute(query, [self._static_files('stream_network'), *map(int, station_ids)])
+
+    def nearest_reach(self, lat, lon, k=1, max_distance=None):
+        # Without a spatial extension the reach geometries are read as WKT and the
+        # haversine distance in meters is measured to the closest reach vertex
+        query = r"""
+            WITH streams AS (
+                SELECT *
+                FROM read_parquet(?)
+            ),
+            vertices AS (
+                SELECT
+                    station_id,
+                    CAST(string_split(vertex, ' ')[1] AS DOUBLE) AS x,
+                    CAST(string_split(vertex, ' ')[2] AS DOUBLE) AS y
+                FROM (
+                    SELECT
+                        station_id,
+                        UNNEST(regexp_extract_all(geometry, '-?[\d.eE+-]+ -?[\d.eE+-]+')) AS vertex
+                    FROM streams
+                )
+            ),
+            closest AS (
+                SELECT
+                    station_id,
+                    MIN(2 * 6371008.8 * ASIN(SQRT(
+                        POW(SIN(RADIANS(y - ?) / 2), 2)
+                        + COS(RADIANS(?)) * COS(RADIANS(y)) * POW(SIN(RADIANS(x - ?) / 2), 2)
+                    ))) AS distance
+                FROM vertices
+                GROUP BY station_id
+                HAVING distance <= ?
+                ORDER BY distance
+                LIMIT ?
+            )
+            SELECT
+                streams.*,
+                closest.distance
+            FROM streams
+            JOIN closest USING (station_id)
+            ORDER BY closest.distance
+        """
+
+        max_distance = max_distance if max_distance is not None else float('inf')
+        return self._execute(query, [self._static_files('stream_network'), lat, lat, lon, max_distance, k])
+
+    def reach_geometries(self):
+        query = """
+            SELECT
+                station_id,
+                CAST(geometry AS VARCHAR) AS geometry
+            FROM
+                read_parquet(?)
+        """
+
+        return self._execute(query, [self._static_files('stream_network')])
+
+    def reach_topology(self):
+        query = """
+            SELECT
+                station_id,
+                "to"
+            FROM
+                read_parquet(?)
+        """
+
+        return self._execute(query, [self._static_files('stream_network')])
+
+    def static_table(self, name):
+        if name not in ('stream_network', 'flood_return_periods'):
+            raise ValueError(f"Invalid static table {name!r}.")
+
+        query = """
+            SELECT
+                *
+            FROM
+                read_parquet(?)
+        """
+
+        return self._execute(query, [self._static_files(name)])
+
+    def return_periods(self, comids, return_periods, order_by_comid):
+        # Extract all six return periods data by default
+        return_periods = return_periods or RETURN_PERIODS
+        selected_fields = ", ".join(["feature_id"] + [f"return_period_{int(rp)}" for rp in return_periods])
+
+        query = f"""
+            SELECT
+                {selected_fields}
+            FROM
+                read_parquet(?)
+            WHERE
+                feature_id IN ({", ".join("?" * len(comids))})
+        """
+
+        if order_by_comid:
+            #  Add the sorting statement if order_by_comid is True
+            query += " ORDER BY feature_id"
+
+        return self._execute(query, [self._static_files('flood_return_periods'), *comids])
+
+
+class KerchunkBackend(DuckDBBackend):
+    """Query engine reading the NWM NetCDF files through kerchunk reference indexes.
+
+    The forecasts and analysis-assimilation records are read from the
+    NetCDF files of the national-water-model bucket, or of a local directory
+    following its layout:
+
+        nwm.20230101/short_range/nwm.t00z.short_range.channel_rt.f001.conus.nc
+        nwm.20230101/medium_range_mem1/nwm.t00z.medium_range.channel_rt_1.f003.conus.nc
+        nwm.20230101/analysis_assim/nwm.t00z.analysis_assim.channel_rt.tm00.conus.nc
+
+    A reference index is built for the lead times of every forecast member
+    and for the cycles of every day of analysis-assimilation, then persisted,
+    so a read only fetches the chunks holding the requested reaches, through
+    a local chunk cache, without BigQuery. The stream_network and
+    flood_return_periods tables are read from the Parquet files of
+    parquet_root like the DuckDB backend.
+
+    Args:
+
+        root (str): Local directory or URL holding the NetCDF files.
+        parquet_root (str): Local directory or URL holding the Parquet files
+            of the static tables.
+        index_dir (str, optional): Directory of the persisted reference
+            indexes. Defaults to None, which keeps them in memory only.
+        chunk_cache_dir (str, optional): Directory of the chunk cache.
+            Defaults to None, which disables the cache.
+        chunk_cache_max_bytes (int): Size limit of the chunk cache.
+        batch_size (int): Number of rows fetched at once while streaming results.
+    """
+
+    # Number of members of the forecast runs
+    MEMBERS = dict(short_range=1, medium_range=6, long_range=4)
+
+    def __init__(
+        self, root: str, parquet_root: str, index_dir: str | None = None,
+        chunk_cache_dir: str | None = None, chunk_cache_max_bytes: int = 0, batch_size: int = 10000,
+    ):
+        super().__init__(parquet_root, batch_size)
+        from .references import ChunkCache, ChunkReader, ReferenceIndexes
+
+        self.netcdf_root = root.rstrip('/')
+        self.reader = ChunkReader({}, ChunkCache(chunk_cache_dir, chunk_cache_max_bytes))
+        self.indexes = ReferenceIndexes(index_dir, self.reader)
+        self._fs = self.reader.filesystem(self.netcdf_root)
+
+    def stats(self):
+        return dict(reference_indexes=self.indexes.stats())
+
+    def _list(self, pattern):
+        # Return the sorted URLs of the files matching a pattern
+        paths = self._fs.glob(pattern)
+        if '://' in self.netcdf_root:
+            paths = [self._fs.unstrip_protocol(path) for path in paths]
+        return sorted(paths)
+
+    @staticmethod
+    def _folder(forecast_type, member):
+        return forecast_type if forecast_type == 'short_range' else f'{forecast_type}_mem{member + 1}'
+
+    def _cycles(self, forecast_type, days):
+        # Find the cycles of the given days from the file names of the first member
+        folder = self._folder(forecast_type, 0)
+        cycles = set()
+        for day in days:
+            for file in self._list(f'{self.netcdf_root}/nwm.{day:%Y%m%d}/{folder}/nwm.t*z.{forecast_type}.*.conus.nc'):
+                match = re.search(r'nwm\.t(\d{2})z', file.rsplit('/', 1)[-1])
+                if match:
+                    cycles.add(datetime(day.year, day.month, day.day, int(match.group(1))))
+        return sorted(cycles)
+
+    def latest_reference_time(self, forecast_type):
+        # Only the files of the two most recent days are listed
+        days = sorted(
+            datetime.strptime(path.rstrip('/').rsplit('.', 1)[-1], '%Y%m%d')
+            for path in self._fs.glob(f'{self.netcdf_root}/nwm.*')
+            if re.search(r'nwm\.\d{8}$', path.rstrip('/'))
+        )
+        for day in reversed(days[-2:]):
+            cycles = self._cycles(forecast_type, [day])
+            if cycles:
+                return cycles[-1]
+        return None
+
+    def _member_table(self, forecast_type, reference_time, member, comids):
+        # Read the records of one member of a cycle through its reference index
+        folder = self._folder(forecast_type, member)
+        pattern = (
+            f'{self.netcdf_root}/nwm.{reference_time:%Y%m%d}/{folder}/'
+            f'nwm.t{reference_time:%H}z.{forecast_type}.channel_rt*.f*.conus.nc'
+        )
+        index = self.indexes.get(
+            f'{forecast_type}/{reference_time:%Y%m%d%H}/{folder}', lambda: self._list(pattern), forecast_ttl(reference_time),
+        )
+        if index is None:
+            return None
+
+        table = _records_table(*index.read(['streamflow', 'velocity'], comids, self.reader))
+        return table.add_column(1, 'reference_time', pa.array(
+            np.full(table.num_rows, np.datetime64(reference_time, 'us')), pa.timestamp('us'),
+        )).add_column(3, 'ensemble', pa.array(np.full(table.num_rows, member), pa.int64()))
+
+    def _forecast_table(self, forecast_type, reference_time, comids, ensembles):
+        members = ensembles if ensembles else range(self.MEMBERS[forecast_type])
+        if forecast_type == 'short_range':
+            members = [member for member in members if member == 0]
+
+        tables = [self._member_table(forecast_type, reference_time, member, comids) for member in members]
+        tables = [table for table in tables if table is not None]
+        if not tables:
+            return None
+        table = pa.concat_tables(tables)
+
+        if not ensembles:
+            # Average the members when no ensemble is specified, ignoring missing values
+            table = table.group_by(['feature_id', 'reference_time', 'time'], use_threads=False).aggregate(
+                [('streamflow', 'mean'), ('velocity', 'mean')]
+            )
+            table = pa.table(dict(
+                feature_id=table['feature_id'],
+                reference_time=table['reference_time'],
+                time=table['time'],
+                ensemble=pa.array(['average'] * table.num_rows, pa.string()),
+                streamflow=table['streamflow_mean'],
+                velocity=table['velocity_mean'],
+            ))
+
+        return table.sort_by([('time', 'ascending'), ('feature_id', 'ascending'), ('ensemble', 'ascending')])
+
+    def forecast(self, forecast_type, reference_time, comids, ensembles):
+        # The latest cycle is found from the file names
+        if reference_time is None:
+            reference_time = self.latest_reference_time(forecast_type)
+            if reference_time is None:
+                return []
+
+        table = self._forecast_table(forecast_type, _parse_time(reference_time), comids, ensembles)
+        return ArrowRows(table) if table is not None else []
+
+    def forecast_cycles(self, forecast_type, start_time, end_time, reference_times, comids, ensembles):
+        start_time, end_time = _parse_time(start_time), _parse_time(end_time)
+        reference_times = {_parse_time(value) for value in reference_times} if reference_times else None
+
+        # Only read the cycles inside the window or the list
+        days = [start_time.date() + timedelta(days=day) for day in range((end_time.date() - start_time.date()).days + 1)]
+        tables = []
+        for cycle in self._cycles(forecast_type, days):
+            if start_time <= cycle <= end_time and (not reference_times or cycle in reference_times):
+                table = self._forecast_table(forecast_type, cycle, comids, ensembles)
+                if table is not None:
+                    tables.append(table)
+        if not tables:
+            return []
+
+        table = pa.concat_tables(tables)
+        table = table.add_column(2, 'lead_time', pc.hours_between(table['reference_time'], table['time']))
+        return ArrowRows(table.sort_by([
+            ('reference_time', 'ascending'), ('feature_id', 'ascending'), ('ensemble', 'ascending'), ('lead_time', 'ascending'),
+        ]))
+
+    def ensemble_members(self, forecast_type, reference_time, comids=None):
+        reference_time = _parse_time(reference_time)
+        tables = [self._member_table(forecast_type, reference_time, member, comids) for member in range(self.MEMBERS[forecast_type])]
+        tables = [table for table in tables if table is not None]
+        if not tables:
+            return []
+
+        # Gather the values of the members of every reach and time, in member order
+        table = pa.concat_tables(tables).sort_by([('feature_id', 'ascending'), ('time', 'ascending'), ('ensemble', 'ascending')])
+        feature_ids, times = table['feature_id'].to_numpy(), table['time'].cast(pa.int64()).to_numpy()
+        changed = (feature_ids[1:] != feature_ids[:-1]) | (times[1:] != times[:-1])
+        starts = np.concatenate([[0], np.flatnonzero(changed) + 1])
+        columns = dict(
+            feature_id=table['feature_id'].take(starts),
+            reference_time=table['reference_time'].take(starts),
+            time=table['time'].take(starts),
+        )
+        for column in ('streamflow', 'velocity'):
+            valid = table[column].is_valid().to_numpy(zero_copy_only=False)
+            offsets = np.concatenate([[0], np.cumsum(np.add.reduceat(valid.astype(np.int32), starts))])
+            columns[column] = pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), table[column].combine_chunks().filter(pa.array(valid)))
+        return ArrowRows(pa.table(columns))
+
+    def analysis_assim(self, comids, run_offset, start_time, end_time, aggregate=None, statistics=None):
+        start_time, end_time = _parse_time(start_time), _parse_time(end_time)
+
+        # The records of a time are in the cycle run_offset hours later
+        first_day = (start_time + timedelta(hours=run_offset)).date()
+        last_day = (end_time + timedelta(hours=run_offset)).date()
+        tables = []
+        for day in (first_day + timedelta(days=offset) for offset in range((last_day - first_day).days + 1)):
+            pattern = (
+                f'{self.netcdf_root}/nwm.{day:%Y%m%d}/analysis_assim/'
+                f'nwm.t*z.analysis_assim.channel_rt.tm{run_offset:02d}.conus.nc'
+            )
+            index = self.indexes.get(
+                f'analysis_assim/tm{run_offset:02d}/{day:%Y%m%d}',
+                lambda pattern=pattern: self._list(pattern),
+                forecast_ttl(datetime(day.year, day.month, day.day, 23)),
+            )
+            if index is not None:
+                tables.append(_records_table(*index.read(['streamflow', 'velocity'], comids, self.reader)))
+        if not tables:
+            return []
+
+        table = pa.concat_tables(tables)
+        within = pc.and_(
+            pc.greater_equal(table['time'], pa.scalar(start_time, pa.timestamp('us'))),
+            pc.less_equal(table['time'], pa.scalar(end_time, pa.timestamp('us'))),
+        )
+        table = table.filter(within).sort_by([('time', 'ascending'), ('feature_id', 'ascending')])
+
+        if aggregate is not None:
+            table = _aggregate_table(table, aggregate, statistics)
+
+        return ArrowRows(table)
+
+
+def _records_table(feature_ids, times, values):
+    # Flatten the (time, reach) arrays read from a reference index, time first
+    rows = len(times) * len(feature_ids)
+    columns = dict(
+        feature_id=pa.array(np.tile(feature_ids, len(times)), pa.int64()),
+        time=pa.array(np.repeat(times.astype('datetime64[us]'), len(feature_ids)), pa.timestamp('us')),
+    )
+    for variable, array in values.items():
+        array = array.reshape(rows)
+        columns[variable] = pa.array(array, pa.float64(), mask=np.isnan(array))
+    return pa.table(columns)
+
+
+def _aggregate_table(table, aggregate, statistics):
+    # Group the records of every reach by interval, like the SQL of the other engines
+    interval = AGGREGATE_INTERVALS[aggregate].lower()
+    columns = dict(feature_id=table['feature_id'], time=pc.floor_temporal(table['time'], unit=interval))
+    aggregations, names = [], []
+    for statistic in parse_statistics(statistics):
+        for column in ('streamflow', 'velocity'):
+            name = f'{column}_{statistic}'
+            columns[name] = table[column]
+            if statistic.startswith('p'):
+                aggregations.append((name, 'tdigest', pc.TDigestOptions(q=int(statistic[1:]) / 100)))
+            else:
+                aggregations.append((name, statistic))
+            names.append(name)
+    columns['count'] = table['feature_id']
+    aggregations.append(('count', 'count', pc.CountOptions(mode='all')))
+    names.append('count')
+
+    grouped = pa.table(columns).group_by(['feature_id', 'time'], use_threads=False).aggregate(aggregations)
+    result = dict(feature_id=grouped['feature_id'], time=grouped['time'])
+    for name, (_, function, *_) in zip(names, aggregations):
+        values = grouped[f'{name}_{function}']
+        result[name] = pc.list_flatten(values) if function == 'tdigest' else values
+    return pa.table(result).sort_by([('time', 'ascending'), ('feature_id', 'ascending')])
+
+
+def _statistic_sql(statistic, column):
+    # DuckDB computes the exact percentiles
+    if statistic.startswith('p'):
+        return f"quantile_cont({column}, {int(statistic[1:]) / 100})"
+    return dict(mean='avg', min='min', max='max')[statistic] + f"({column})"
+
+
+def _parse_time(value):
+    # Accept both datetime objects and ISO formatted strings
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    return parser.parse(str(value)).replace(tzinfo=None)
+
+
+# Supported query engines
+BACKENDS = dict(
+    bigquery = lambda: BigQueryBackend(
+        settings.bigquery_pool_size, settings.bigquery_project, settings.page_size, settings.bigquery_poll_seconds
+    ),
+    duckdb = lambda: DuckDBBackend(settings.parquet_root, settings.page_size),
+    kerchunk = lambda: KerchunkBackend(
+        settings.netcdf_root, settings.parquet_root, settings.reference_index_dir,
+        settings.chunk_cache_dir, settings.chunk_cache_max_bytes, settings.page_size,
+    ),
+)
+
+_backend = None
+
+
+def get_backend() -> QueryBackend:
+    """Return the query engine selected by the NWM_API_BACKEND setting.
+
+    The engine is created on first use and shared by all requests.
+    """
+    global _backend
+
+    if _backend is None:
+        if settings.backend not in BACKENDS:
+            raise ValueError(f"Invalid backend {settings.backend!r}. Supported values are {list(BACKENDS)}.")
+        _backend = BACKENDS[settings.backend]()
+
+    return _backend
+
+
+def close_backend():
+    """Close the shared query engine, if one was created."""
+    global _backend
+
+    if _backend is not None:
+        _backend.close()
+        _backend = None
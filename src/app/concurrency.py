@@ -0,0 +1,121 @@
+# Import libraries required for running blocking work concurrently
+import asyncio
+
+import anyio.to_thread
+
+from .config import settings
+from .metrics import current_request, stage
+
+
+class ConcurrencyLimits:
+    """Bound the work a single instance of the API runs at the same time.
+
+    The endpoints run on the event loop and hand their blocking calls (query
+    submission, page downloads, disk reads) to a pool of worker threads. Query
+    jobs are awaited without holding a thread, so the number of requests in
+    progress is no longer capped by the size of the thread pool; the limits
+    below bound it instead.
+
+    Args:
+
+        max_requests (int): Maximum number of requests processed at once,
+            further requests wait for a slot. 0 disables the limit.
+        max_queries (int): Maximum number of backend queries submitted and
+            awaited at once.
+        worker_threads (int): Number of worker threads running blocking calls.
+    """
+
+    def __init__(self, max_requests: int, max_queries: int, worker_threads: int):
+        self.max_requests = max_requests
+        self.max_queries = max_queries
+        self.worker_threads = worker_threads
+
+        self._requests = None
+        self._queries = None
+        self._counters = dict(requests=0, queries=0, requests_in_progress=0, queries_in_progress=0)
+
+    def open(self):
+        """Create the limits on the running event loop and size the thread pool."""
+        self._requests = asyncio.Semaphore(self.max_requests or 2 ** 31)
+        self._queries = asyncio.Semaphore(self.max_queries)
+        anyio.to_thread.current_default_thread_limiter().total_tokens = self.worker_threads
+
+    async def run(self, fn, *args):
+        """Run a blocking call in a worker thread and return its result."""
+        return await anyio.to_thread.run_sync(fn, *args)
+
+    async def query(self, fn, *args):
+        """Submit a backend query in a worker thread and wait until its results are ready.
+
+        Results providing an async ``wait()`` are awaited on the event loop, so
+        no thread is held while the query job runs. The time until the
+        results are ready is added to the 'query' stage of the current request.
+        """
+        if self._queries is None:
+            self.open()
+
+        async with self._queries:
+            self._counters['queries'] += 1
+            self._counters['queries_in_progress'] += 1
+            try:
+                with stage('query'):
+                    results = await self.run(fn, *args)
+                    if hasattr(results, 'wait'):
+                        await results.wait()
+            finally:
+                self._counters['queries_in_progress'] -= 1
+
+        # Record the statistics of the job with the request that ran it
+        request = current_request()
+        if request is not None and hasattr(results, 'statistics'):
+            request.record_query(results.statistics())
+
+        return results
+
+    async def request(self, call):
+        """Process a request once a request slot is available."""
+        if self._requests is None:
+            self.open()
+
+        async with self._requests:
+            self._counters['requests'] += 1
+            self._counters['requests_in_progress'] += 1
+            try:
+                return await call()
+            finally:
+                self._counters['requests_in_progress'] -= 1
+
+    def stats(self) -> dict:
+        """Return the number of requests and queries processed and in progress."""
+        return dict(self._counters, worker_threads=self.worker_threads)
+
+
+class RequestLimitMiddleware:
+    """ASGI middleware processing the HTTP requests within the request limit.
+
+    The slot of a request is held until its response, streamed or not, has
+    been sent completely.
+
+    Args:
+
+        app (ASGIApp): The wrapped application.
+        limits (ConcurrencyLimits): The limits of the instance.
+    """
+
+    def __init__(self, app, limits: ConcurrencyLimits):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        return await self.limits.request(lambda: self.app(scope, receive, send))
+
+
+# Create the limits shared by the application
+limits = ConcurrencyLimits(
+    max_requests=settings.max_concurrent_requests,
+    max_queries=settings.max_concurrent_queries,
+    worker_threads=settings.worker_threads,
+)
@@ -0,0 +1,180 @@
+# Import libraries required for reading the service configuration
+from pydantic import BaseSettings
+
+
+class Settings(BaseSettings):
+    """Runtime configuration of the NWM API.
+
+    Every field can be overridden with an environment variable of the same
+    name prefixed with "NWM_API_", e.g. NWM_API_BACKEND=duckdb.
+
+    Attributes:
+
+        backend (str): The query engine used to answer requests.
+            Supported values are 'bigquery', 'duckdb' and 'kerchunk'.
+            Defaults to 'bigquery'.
+        parquet_root (str): Root directory or fsspec URL of the NWM Parquet
+            files read by the 'duckdb' backend. Forecast files are expected in
+            the "channel_rt/<forecast_type>[_memN]/" layout of the
+            national-water-model-parq bucket. The 'kerchunk' backend reads the
+            stream_network and flood_return_periods files from there.
+            Example: "s3://national-water-model-parq"
+        netcdf_root (str): Root directory or fsspec URL of the NWM NetCDF
+            files read by the 'kerchunk' backend, in the
+            "nwm.<YYYYMMDD>/<forecast_type>[_memN]/" layout of the
+            national-water-model bucket.
+            Defaults to 'gs://national-water-model'.
+        reference_index_dir (str, optional): Directory of the kerchunk
+            reference indexes of the NetCDF files, built on first use.
+            Defaults to None, which keeps the indexes in memory only.
+        chunk_cache_dir (str, optional): Directory of the local cache of the
+            NetCDF chunks read by the 'kerchunk' backend.
+            Defaults to None, which disables the cache.
+        chunk_cache_max_bytes (int): Size limit of the chunk cache.
+            Defaults to 10 GiB.
+        bigquery_pool_size (int): Maximum number of HTTP connections the shared
+            BigQuery client keeps open.
+            Defaults to 32.
+        page_size (int): Number of result rows fetched from the backend at once
+            while a response is streamed.
+            Defaults to 10000.
+        bigquery_project (str, optional): The project billed for BigQuery jobs.
+            Defaults to the project of the application default credentials.
+        reference_time_poll_seconds (int): Delay in seconds between two lookups
+            of the latest reference time once the next cycle of a forecast run
+            is due.
+            Defaults to 300.
+        hydroshare_timeout_seconds (float): Timeout of the requests to HydroShare.
+            Defaults to 10.
+        hydroshare_cache_size (int): Maximum number of HydroShare comid lists
+            kept in cache.
+            Defaults to 256.
+        hydroshare_cache_ttl_seconds (float): Number of seconds a cached comid
+            list is used before it is revalidated.
+            Defaults to 3600.
+        hydroshare_max_stale_seconds (float): Number of seconds an expired comid
+            list can still be served while it is revalidated or HydroShare is
+            unavailable.
+            Defaults to 86400.
+        result_cache_max_bytes (int): Size limit in bytes of the in-memory
+            result cache.
+            Defaults to 268435456 (256 MiB).
+        result_cache_dir (str, optional): Directory of the on-disk result cache.
+            Defaults to None, which keeps the results in memory only.
+        result_cache_disk_max_bytes (int): Size limit in bytes of the on-disk
+            result cache.
+            Defaults to 2147483648 (2 GiB).
+        result_cache_immutable_after_seconds (float): Age of a forecast cycle
+            after which its results are considered final and cached without
+            expiration.
+            Defaults to 21600.
+        result_cache_recent_ttl_seconds (float): Number of seconds the results
+            of a more recent cycle are cached.
+            Defaults to 300.
+        max_concurrent_requests (int): Maximum number of requests an instance
+            processes at once, further requests wait for a slot. 0 disables
+            the limit.
+            Defaults to 0.
+        max_concurrent_queries (int): Maximum number of backend queries an
+            instance runs at once. BigQuery allows 100 concurrent interactive
+            queries per project by default.
+            Defaults to 64.
+        worker_threads (int): Number of worker threads running the blocking
+            calls of the endpoints, e.g. page downloads and Parquet reads.
+            Defaults to 64.
+        bigquery_poll_seconds (float): Longest delay in seconds between two
+            checks of a running BigQuery job.
+            Defaults to 1.
+        spatial_index_path (str, optional): Snapshot file of the spatial index
+            used to find the reaches nearest to a point. It is loaded at
+            startup, or built from the query backend and saved there when it
+            does not exist.
+            Defaults to None, which finds the nearest reaches with a query.
+        static_tables_dir (str, optional): Directory of the local snapshots of
+            the stream_network and flood_return_periods tables. They are
+            memory-mapped at startup, or built from the query backend when
+            they do not exist.
+            Defaults to None, which reads these tables from the backend.
+        ensemble_stats_dir (str, optional): Directory of the statistics of the
+            members of the medium_range and long_range cycles, materialized
+            once per cycle.
+            Defaults to None, which computes the statistics on every request.
+        ensemble_stats_update (bool): Whether the instance materializes the
+            statistics of the new cycles itself, rather than a scheduled
+            "python -m app.ensemble_stats" job.
+            Defaults to False.
+        ensemble_stats_cycles (int): Number of materialized cycles kept for
+            each forecast run.
+            Defaults to 8.
+        ensemble_stats_settle_seconds (float): Delay in seconds between the
+            first sighting of a new cycle and its materialization, giving the
+            cycle time to be published completely.
+            Defaults to 1800.
+        export_dir (str, optional): Directory of the bulk exports requested
+            through the API, one subdirectory of sharded Parquet files per
+            export.
+            Defaults to None, which disables the exports through the API.
+        export_workers (int): Number of processes exporting the shards of a
+            bulk export at once.
+            Defaults to 4.
+        export_shard_reaches (int): Number of reaches of every shard of a
+            bulk export.
+            Defaults to 5000.
+        snap_max_points (int): Maximum number of points of a batch snapping
+            request.
+            Defaults to 100000.
+        network_topology_path (str, optional): Snapshot file of the network
+            topology index answering the upstream_of and downstream_of
+            queries, built from the stream_network at startup when missing.
+            Defaults to None, which disables the network queries.
+        network_max_reaches (int): Maximum number of reaches selected by an
+            upstream_of or downstream_of query.
+            Defaults to 100000.
+        slow_request_seconds (float): Duration in seconds from which a request
+            is logged with the WARNING severity.
+            Defaults to 10.
+    """
+
+    backend: str = 'bigquery'
+    parquet_root: str = '.'
+    netcdf_root: str = 'gs://national-water-model'
+    reference_index_dir: str | None = None
+    chunk_cache_dir: str | None = None
+    chunk_cache_max_bytes: int = 10 * 1024 ** 3
+    bigquery_pool_size: int = 32
+    bigquery_project: str | None = None
+    page_size: int = 10000
+    reference_time_poll_seconds: int = 300
+    hydroshare_timeout_seconds: float = 10
+    hydroshare_cache_size: int = 256
+    hydroshare_cache_ttl_seconds: float = 3600
+    hydroshare_max_stale_seconds: float = 86400
+    result_cache_max_bytes: int = 256 * 1024 ** 2
+    result_cache_dir: str | None = None
+    result_cache_disk_max_bytes: int = 2 * 1024 ** 3
+    result_cache_immutable_after_seconds: float = 21600
+    result_cache_recent_ttl_seconds: float = 300
+    max_concurrent_requests: int = 0
+    max_concurrent_queries: int = 64
+    worker_threads: int = 64
+    bigquery_poll_seconds: float = 1
+    slow_request_seconds: float = 10
+    spatial_index_path: str | None = None
+    snap_max_points: int = 100000
+    static_tables_dir: str | None = None
+    ensemble_stats_dir: str | None = None
+    ensemble_stats_update: bool = False
+    ensemble_stats_cycles: int = 8
+    ensemble_stats_settle_seconds: float = 1800
+    export_dir: str | None = None
+    export_workers: int = 4
+    export_shard_reaches: int = 5000
+    network_topology_path: str | None = None
+    network_max_reaches: int = 100000
+
+    class Config:
+        env_prefix = 'NWM_API_'
+
+
+# Create the settings instance shared by the application
+settings = Settings()
@@ -0,0 +1,86 @@
+# Import libraries required for data processing
+import numpy as np
+import pyarrow as pa
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """Select the points of a series to plot with the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last points are kept and the others are split into
+    max_points - 2 buckets of consecutive points. From each bucket the point
+    forming the largest triangle with the point selected in the previous
+    bucket and the average of the next bucket is kept, which preserves the
+    peaks and troughs of the series.
+
+    Args:
+
+        x (numpy.ndarray): The increasing positions of the points.
+        y (numpy.ndarray): The values of the points.
+        max_points (int): The number of points to keep, at least 3.
+
+    Returns:
+
+        numpy.ndarray: The increasing indices of the selected points.
+    """
+    size = len(x)
+    if max_points >= size or max_points < 3:
+        return np.arange(size)
+
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+
+    # Bounds of the buckets of the points between the first and the last one
+    bounds = np.linspace(1, size - 1, max_points - 1).astype(np.int64)
+    # Averages of every bucket, followed by the last point
+    sums_x, sums_y = np.add.reduceat(x[1:size - 1], bounds[:-1] - 1), np.add.reduceat(y[1:size - 1], bounds[:-1] - 1)
+    counts = np.diff(bounds)
+    averages_x = np.append(sums_x / counts, x[-1])
+    averages_y = np.append(sums_y / counts, y[-1])
+
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, size - 1
+    previous = 0
+    for bucket in range(max_points - 2):
+        start, end = bounds[bucket], bounds[bucket + 1]
+        # Twice the area of the triangles formed with every point of the bucket
+        areas = np.abs(
+            (x[previous] - averages_x[bucket + 1]) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (averages_y[bucket + 1] - y[previous])
+        )
+        # Points without value are only kept when no other point can be
+        previous = start + int(np.argmax(np.nan_to_num(areas, nan=-1)))
+        selected[bucket + 1] = previous
+
+    return selected
+
+
+def downsample(table: pa.Table, max_points: int, column: str = 'streamflow') -> pa.Table:
+    """Keep at most max_points records of every reach, selected with LTTB on column.
+
+    Args:
+
+        table (pyarrow.Table): The records, with feature_id, time and column.
+        max_points (int): The number of records to keep for every reach.
+        column (str): The column whose shape is preserved.
+            Defaults to 'streamflow'.
+
+    Returns:
+
+        pyarrow.Table: The selected records, ordered by time and feature_id.
+    """
+    if not table.num_rows:
+        return table
+
+    table = table.sort_by([('feature_id', 'ascending'), ('time', 'ascending')])
+    feature_ids = table['feature_id'].to_numpy()
+    times = table['time'].cast(pa.int64()).to_numpy()
+    values = table[column].to_numpy(zero_copy_only=False)
+
+    # Select the records of every reach separately
+    starts = np.concatenate([[0], np.flatnonzero(feature_ids[1:] != feature_ids[:-1]) + 1, [table.num_rows]])
+    indices = np.concatenate([
+        start + lttb_indices(times[start:end], values[start:end], max_points)
+        for start, end in zip(starts[:-1], starts[1:])
+    ])
+
+    return table.take(pa.array(indices, pa.int64())).sort_by([('time', 'ascending'), ('feature_id', 'ascending')])
@@ -0,0 +1,463 @@
+# Import libraries required for data processing
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+import warnings
+from datetime import datetime, timezone
+from dateutil import parser as date_parser
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .backends import get_backend
+from .concurrency import limits
+from .config import settings
+from .queries import parse_statistics
+from .responses import iter_record_batches
+from .result_cache import ArrowRows, forecast_ttl, normalize_reference_time, result_cache
+
+# Forecast runs made of several members
+ENSEMBLE_FORECASTS = ('medium_range', 'long_range')
+
+# Statistics of the members besides the percentiles, written p1 to p99
+ENSEMBLE_STATISTICS = ('mean', 'median', 'min', 'max', 'std')
+
+# Statistics stored for every materialized cycle
+MATERIALIZED_STATISTICS = ('mean', 'median', 'min', 'max', 'std', 'p10', 'p25', 'p75', 'p90')
+
+# Number of files the statistics of a cycle are split into, by feature_id
+SHARDS = 64
+
+# Name of the file marking a cycle as completely materialized
+MANIFEST = 'manifest.json'
+
+
+def _member_matrix(values: pa.ChunkedArray) -> np.ndarray:
+    # Pad the member lists of every row into a (rows, members) matrix, NaN
+    # standing for the missing members
+    values = values.combine_chunks() if isinstance(values, pa.ChunkedArray) else values
+    lengths = pc.fill_null(pc.list_value_length(values), 0).to_numpy()
+    flat = pc.list_flatten(values).cast(pa.float64()).to_numpy(zero_copy_only=False)
+
+    matrix = np.full((len(values), int(lengths.max(initial=0))), np.nan)
+    rows = np.repeat(np.arange(len(values)), lengths)
+    columns = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    matrix[rows, columns] = flat
+    return matrix
+
+
+def _percentiles(matrix: np.ndarray, percentiles: list) -> np.ndarray:
+    # Interpolate the percentiles of every row linearly between the sorted
+    # members, like numpy.nanpercentile but without a loop over the rows
+    ordered = np.sort(matrix, axis=1)
+    counts = np.sum(~np.isnan(matrix), axis=1)
+    rows = np.arange(len(matrix))
+
+    results = np.full((len(percentiles), len(matrix)), np.nan)
+    valid = counts > 0
+    for index, percentile in enumerate(percentiles):
+        positions = percentile / 100 * (counts[valid] - 1)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.ceil(positions).astype(np.int64)
+        low, high = ordered[rows[valid], lower], ordered[rows[valid], upper]
+        results[index, valid] = low + (high - low) * (positions - lower)
+
+    return results
+
+
+def _statistics(matrix: np.ndarray, statistics: list) -> dict:
+    # Compute every statistic over the members at once, ignoring the missing ones
+    if not matrix.shape[1]:
+        return {statistic: np.full(len(matrix), np.nan) for statistic in statistics}
+
+    results = {}
+    with warnings.catch_warnings():
+        # Rows without any member have NaN statistics
+        warnings.simplefilter('ignore', RuntimeWarning)
+        functions = dict(mean=np.nanmean, min=np.nanmin, max=np.nanmax)
+        for statistic in statistics:
+            if statistic in functions:
+                results[statistic] = functions[statistic](matrix, axis=1)
+            elif statistic == 'std':
+                results[statistic] = np.nanstd(matrix, axis=1, ddof=1)
+
+    # The median is the 50th percentile
+    percentiles = {
+        statistic: 50 if statistic == 'median' else int(statistic[1:])
+        for statistic in statistics if statistic == 'median' or statistic.startswith('p')
+    }
+    if percentiles:
+        results.update(zip(percentiles, _percentiles(matrix, list(percentiles.values()))))
+
+    return results
+
+
+def compute_ensemble_statistics(members: pa.Table, statistics: list) -> pa.Table:
+    """Compute statistics of the members of a forecast for every reach and time.
+
+    Every statistic of every row is computed in one vectorized pass over a
+    (rows, members) matrix, the missing members being ignored.
+
+    Args:
+
+        members (pyarrow.Table): The feature_id, reference_time and time of
+            every row with the streamflow and velocity of its members as lists,
+            as returned by the ensemble_members() method of the query backends.
+        statistics (list): The statistics among 'mean', 'median', 'min',
+            'max', 'std' and the percentiles 'p1' to 'p99'. The standard
+            deviation is the sample standard deviation of the members.
+
+    Returns:
+
+        pyarrow.Table: The feature_id, reference_time, time, the number of
+        members and a streamflow_<statistic> and velocity_<statistic> column
+        for each statistic.
+    """
+    columns = dict(
+        feature_id=members['feature_id'],
+        reference_time=members['reference_time'],
+        time=members['time'],
+        members=pc.fill_null(pc.list_value_length(members['streamflow']), 0),
+    )
+    values = {column: _statistics(_member_matrix(members[column]), statistics) for column in ('streamflow', 'velocity')}
+    for statistic in statistics:
+        for column in ('streamflow', 'velocity'):
+            columns[f'{column}_{statistic}'] = pa.array(values[column][statistic], pa.float64())
+
+    return pa.table(columns)
+
+
+def _take_ranges(ids: np.ndarray, comids: list) -> np.ndarray:
+    # Find the rows of every comid in the sorted ids
+    comids = np.asarray(sorted(set(comids)), dtype=ids.dtype)
+    starts, ends = np.searchsorted(ids, comids, 'left'), np.searchsorted(ids, comids, 'right')
+    lengths = ends - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+class EnsembleStatsStore:
+    """Statistics of the members of the medium and long range cycles,
+    materialized once per cycle.
+
+    The statistics of every reach and time of a cycle are stored in
+    directory/<forecast_type>/<YYYYMMDDHH>/ as Arrow IPC files, the reaches
+    being split into SHARDS files sorted by feature_id so the rows of any
+    reach are found with a binary search in a memory-mapped file. A manifest
+    is written last, so only complete cycles are read. The most recent
+    cycles of each forecast run are kept.
+
+    Args:
+
+        directory (str, optional): The directory of the statistics. Defaults
+            to None, which disables the store.
+        cycles (int): The number of cycles kept for each forecast run.
+        settle_seconds (float): Delay between the first sighting of a new cycle
+            and its materialization, giving the cycle time to be published
+            completely.
+    """
+
+    def __init__(self, directory: str | None, cycles: int = 8, settle_seconds: float = 1800):
+        self.directory = directory
+        self.cycles = cycles
+        self.settle_seconds = settle_seconds
+        self._seen = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _cycle_dir(self, forecast_type, reference_time):
+        reference_time = datetime.fromisoformat(normalize_reference_time(reference_time))
+        return os.path.join(self.directory, forecast_type, f'{reference_time:%Y%m%d%H}')
+
+    def manifest(self, forecast_type: str, reference_time) -> dict | None:
+        """Return the manifest of a materialized cycle, or None."""
+        if not self.directory:
+            return None
+        try:
+            with open(os.path.join(self._cycle_dir(forecast_type, reference_time), MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def materialized_cycles(self, forecast_type: str) -> list:
+        """Return the reference times of the materialized cycles, oldest first."""
+        folder = os.path.join(self.directory, forecast_type)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(
+            datetime.strptime(name, '%Y%m%d%H') for name in os.listdir(folder)
+            if len(name) == 10 and name.isdigit() and os.path.exists(os.path.join(folder, name, MANIFEST))
+        )
+
+    def materialize(self, forecast_type: str, reference_time) -> dict:
+        """Compute and store the statistics of every reach of a cycle.
+
+        The members are read from the query backend and processed one record
+        batch at a time, so the whole cycle is never held in memory.
+
+        Returns:
+
+            dict: The manifest of the cycle.
+        """
+        cycle_dir = self._cycle_dir(forecast_type, reference_time)
+        temporary_dir = f'{cycle_dir}.{threading.get_ident()}.tmp'
+        os.makedirs(temporary_dir, exist_ok=True)
+        statistics = list(MATERIALIZED_STATISTICS)
+        started = time.perf_counter()
+
+        try:
+            # Split the statistics of every batch into the shards
+            writers, rows = {}, 0
+            for batch in iter_record_batches(get_backend().ensemble_members(forecast_type, reference_time)):
+                self._check_stopped()
+                table = compute_ensemble_statistics(pa.Table.from_batches([batch]), statistics)
+                shards = pc.bit_wise_and(table['feature_id'], SHARDS - 1).to_numpy()
+                for shard in np.unique(shards):
+                    part = table.filter(pa.array(shards == shard))
+                    if shard not in writers:
+                        sink = pa.OSFile(os.path.join(temporary_dir, f'shard-{shard:03d}.stream'), 'wb')
+                        writers[shard] = (sink, pa.ipc.new_stream(sink, part.schema))
+                    writers[shard][1].write_table(part)
+                rows += table.num_rows
+
+            for sink, writer in writers.values():
+                writer.close()
+                sink.close()
+
+            # Sort every shard by reach and time
+            for shard in writers:
+                self._check_stopped()
+                stream_path = os.path.join(temporary_dir, f'shard-{shard:03d}.stream')
+                with pa.OSFile(stream_path, 'rb') as source:
+                    table = pa.ipc.open_stream(source).read_all()
+                table = table.sort_by([('feature_id', 'ascending'), ('time', 'ascending')])
+                with pa.OSFile(os.path.join(temporary_dir, f'shard-{shard:03d}.arrow'), 'wb') as sink:
+                    with pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+                os.remove(stream_path)
+
+            manifest = dict(
+                forecast_type=forecast_type,
+                reference_time=normalize_reference_time(reference_time),
+                statistics=statistics,
+                shards=sorted(int(shard) for shard in writers),
+                rows=rows,
+                backend=type(get_backend()).__name__,
+                seconds=round(time.perf_counter() - started, 3),
+                materialized_at=datetime.now(timezone.utc).isoformat(),
+            )
+            with open(os.path.join(temporary_dir, MANIFEST), 'w') as f:
+                json.dump(manifest, f, indent=2)
+
+            # Replace a previous materialization of the cycle at once
+            if os.path.exists(cycle_dir):
+                shutil.rmtree(cycle_dir)
+            os.replace(temporary_dir, cycle_dir)
+
+        finally:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+        self._prune(forecast_type)
+        return manifest
+
+    def _check_stopped(self):
+        # Give up the cycle being materialized once the store is stopped
+        if self._stop.is_set():
+            raise InterruptedError('The ensemble statistics store was stopped.')
+
+    def _prune(self, forecast_type):
+        # Remove the cycles older than the most recent ones
+        for reference_time in self.materialized_cycles(forecast_type)[:-self.cycles]:
+            shutil.rmtree(self._cycle_dir(forecast_type, reference_time), ignore_errors=True)
+
+    def read(self, forecast_type: str, reference_time, comids: list, statistics: list) -> pa.Table | None:
+        """Return the stored statistics of the given reaches, ordered by time
+        and feature_id, or None if the cycle or a statistic is not stored."""
+        manifest = self.manifest(forecast_type, reference_time)
+        if manifest is None or not set(statistics) <= set(manifest['statistics']):
+            return None
+
+        columns = ['feature_id', 'reference_time', 'time', 'members']
+        columns += [f'{column}_{statistic}' for statistic in statistics for column in ('streamflow', 'velocity')]
+
+        # Read the rows of every reach from the memory-mapped shard holding it
+        cycle_dir = self._cycle_dir(forecast_type, reference_time)
+        comids = np.asarray(list(comids), dtype=np.int64)
+        tables = []
+        for shard in np.unique(comids & (SHARDS - 1)):
+            if shard not in manifest['shards']:
+                continue
+            with pa.memory_map(os.path.join(cycle_dir, f'shard-{shard:03d}.arrow')) as source:
+                table = pa.ipc.open_file(source).read_all()
+            rows = _take_ranges(table['feature_id'].to_numpy(), comids[(comids & (SHARDS - 1)) == shard])
+            tables.append(table.select(columns).take(pa.array(rows, pa.int64())))
+
+        if not tables:
+            return pa.table({})
+        return pa.concat_tables(tables).sort_by([('time', 'ascending'), ('feature_id', 'ascending')])
+
+    def update(self, now: float | None = None) -> list:
+        """Materialize the latest cycle of every ensemble forecast run once it
+        has settled, returning the manifests written."""
+        now = time.monotonic() if now is None else now
+        manifests = []
+        for forecast_type in ENSEMBLE_FORECASTS:
+            try:
+                reference_time = get_backend().latest_reference_time(forecast_type)
+                if reference_time is None or self.manifest(forecast_type, reference_time) is not None:
+                    continue
+
+                # Wait for the cycle to be published completely
+                key = (forecast_type, normalize_reference_time(reference_time))
+                with self._lock:
+                    seen_at = self._seen.setdefault(key, now)
+                    # Forget the cycles older than the ones kept on disk
+                    seen = sorted(seen_key for seen_key in self._seen if seen_key[0] == forecast_type)
+                    for seen_key in seen[:-self.cycles]:
+                        del self._seen[seen_key]
+                if now - seen_at < self.settle_seconds:
+                    continue
+
+                manifests.append(self.materialize(forecast_type, reference_time))
+                self._errors.pop(forecast_type, None)
+
+            except Exception as e:
+                # Retry at the next update
+                self._errors[forecast_type] = repr(e)
+
+        return manifests
+
+    def start(self, interval: float):
+        """Materialize the new cycles in a background thread, checking every interval seconds."""
+        if self.directory and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(interval,), name='ensemble-stats-update', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float | None = 10):
+        """Stop the background thread.
+
+        A cycle being materialized is abandoned at its next record batch or
+        shard. The thread is a daemon, so it does not keep the process alive
+        if it is still blocked on the backend after timeout seconds.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.is_set():
+            self.update()
+            self._stop.wait(interval)
+
+    def stats(self) -> dict:
+        """Return the materialized cycles of every ensemble forecast run."""
+        if not self.directory:
+            return dict(enabled=False)
+        return dict(
+            enabled=True,
+            updating=self._thread is not None,
+            cycles={
+                forecast_type: [cycle.isoformat() for cycle in self.materialized_cycles(forecast_type)]
+                for forecast_type in ENSEMBLE_FORECASTS
+            },
+            errors=dict(self._errors),
+        )
+
+
+async def fetch_ensemble_statistics(forecast_type: str, reference_time, comids: list, statistics: list):
+    """Return the statistics of the members of a cycle for the given reaches.
+
+    The statistics are read from the store when the cycle is materialized.
+    Otherwise the members are retrieved, through the result cache, and the
+    statistics computed for the requested reaches only.
+
+    Returns:
+
+        ArrowRows: The statistics, ordered by time and feature_id.
+    """
+    table = await limits.run(ensemble_stats.read, forecast_type, reference_time, comids, statistics)
+    if table is not None:
+        return ArrowRows(table)
+
+    key = ('ensemble_members', forecast_type, normalize_reference_time(reference_time), tuple(sorted(set(comids))))
+    members = await result_cache.cached_table(
+        key, lambda: get_backend().ensemble_members(forecast_type, reference_time, comids), forecast_ttl(reference_time)
+    )
+    if not members.table.num_rows:
+        return members
+
+    table = await limits.run(compute_ensemble_statistics, members.table, statistics)
+    return ArrowRows(table.sort_by([('time', 'ascending'), ('feature_id', 'ascending')]))
+
+
+async def read_ensemble_average(forecast_type: str, reference_time, comids: list):
+    """Return the ensemble average of a materialized cycle in the layout of
+    the forecast results, or None if the cycle is not materialized."""
+    if forecast_type not in ENSEMBLE_FORECASTS or reference_time is None or not ensemble_stats.directory:
+        return None
+
+    table = await limits.run(ensemble_stats.read, forecast_type, reference_time, comids, ['mean'])
+    if table is None or not table.num_rows:
+        return None
+
+    return ArrowRows(pa.table(dict(
+        feature_id=table['feature_id'],
+        reference_time=table['reference_time'],
+        time=table['time'],
+        ensemble=pa.array(['average'] * table.num_rows),
+        streamflow=table['streamflow_mean'],
+        velocity=table['velocity_mean'],
+    )))
+
+
+def parse_ensemble_statistics(statistics: list | None) -> list:
+    """Validate the ensemble statistics, defaulting to every statistic but the percentiles."""
+    return parse_statistics(statistics or list(ENSEMBLE_STATISTICS), ENSEMBLE_STATISTICS)
+
+
+# Create the store shared by the application
+ensemble_stats = EnsembleStatsStore(
+    settings.ensemble_stats_dir, settings.ensemble_stats_cycles, settings.ensemble_stats_settle_seconds
+)
+
+
+def main(argv=None):
+    """Materialize the ensemble statistics of a cycle from the configured query backend."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('forecast_types', nargs='*', help=f'The forecast runs among {list(ENSEMBLE_FORECASTS)}, all of them by default.')
+    parser.add_argument('--reference-time', help='The reference time of the cycle. Defaults to the latest cycle.')
+    parser.add_argument('--directory', default=settings.ensemble_stats_dir, help='The directory of the statistics.')
+    parser.add_argument('--force', action='store_true', help='Materialize the cycle again if it is already stored.')
+    args = parser.parse_args(argv)
+    if not args.directory:
+        parser.error('Provide the directory or set NWM_API_ENSEMBLE_STATS_DIR.')
+    for forecast_type in args.forecast_types:
+        if forecast_type not in ENSEMBLE_FORECASTS:
+            parser.error(f'Invalid forecast type {forecast_type!r}. Supported values are {list(ENSEMBLE_FORECASTS)}.')
+
+    store = EnsembleStatsStore(args.directory, settings.ensemble_stats_cycles)
+    for forecast_type in args.forecast_types or ENSEMBLE_FORECASTS:
+        if args.reference_time:
+            reference_time = date_parser.parse(args.reference_time)
+        else:
+            reference_time = get_backend().latest_reference_time(forecast_type)
+        if reference_time is None:
+            print(f'{forecast_type}: no cycle found')
+            continue
+        if not args.force and store.manifest(forecast_type, reference_time) is not None:
+            print(f'{forecast_type}: {reference_time:%Y-%m-%d %H}z is already materialized')
+            continue
+
+        manifest = store.materialize(forecast_type, reference_time)
+        print(f"{forecast_type}: {reference_time:%Y-%m-%d %H}z, {manifest['rows']} rows in {manifest['seconds']}s")
+
+
+if __name__ == '__main__':
+    main()
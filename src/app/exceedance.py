@@ -0,0 +1,105 @@
+# Import libraries required for data processing
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .queries import RETURN_PERIODS
+
+# Columns of the classification of forecasts without any record
+EXCEEDANCE_SCHEMA = pa.schema([
+    ('feature_id', pa.int64()),
+    ('reference_time', pa.timestamp('us', tz='UTC')),
+    ('ensemble', pa.string()),
+    ('peak_time', pa.timestamp('us', tz='UTC')),
+    ('peak_streamflow', pa.float64()),
+    ('return_period', pa.int64()),
+    ('return_period_streamflow', pa.float64()),
+])
+
+
+def _group_starts(*columns) -> np.ndarray:
+    # Find the rows where a new group of equal values starts
+    if not len(columns[0]):
+        return np.zeros(0, dtype=np.int64)
+
+    changed = np.zeros(len(columns[0]) - 1, dtype=bool)
+    for values in columns:
+        changed |= values[1:] != values[:-1]
+    return np.concatenate([[0], np.flatnonzero(changed) + 1])
+
+
+def classify_exceedance(forecast: pa.Table, thresholds: pa.Table, return_periods: list | None = None) -> pa.Table:
+    """Find the peak of every forecast series and the highest return period it exceeds.
+
+    The forecast is reduced to one row per (feature_id, ensemble) series,
+    holding its peak streamflow and the time of the first occurrence of the
+    peak, then compared with the return-period flows of its reach.
+
+    Args:
+
+        forecast (pyarrow.Table): The forecast records, with the feature_id,
+            reference_time, time, ensemble and streamflow columns.
+        thresholds (pyarrow.Table): The flood return-period records, with a
+            feature_id column and a return_period_<years> column for each of
+            return_periods.
+        return_periods (list, optional): The return periods, in years, to
+            compare the peaks with. Defaults to None, for all six of them.
+
+    Returns:
+
+        pyarrow.Table: The feature_id, reference_time, ensemble, peak_time,
+        peak_streamflow, return_period and return_period_streamflow of every
+        series, ordered by feature_id and ensemble. return_period is null
+        when the peak exceeds none of the return periods or the reach has
+        no return periods.
+    """
+    return_periods = sorted({int(rp) for rp in return_periods}) if return_periods else list(RETURN_PERIODS)
+    if not forecast.num_rows:
+        return EXCEEDANCE_SCHEMA.empty_table()
+
+    # Order every series by decreasing streamflow so its peak comes first
+    forecast = forecast.sort_by([
+        ('feature_id', 'ascending'),
+        ('ensemble', 'ascending'),
+        ('streamflow', 'descending'),
+        ('time', 'ascending'),
+    ])
+    feature_ids = forecast['feature_id'].to_numpy()
+    starts = _group_starts(feature_ids, forecast['ensemble'].to_numpy(zero_copy_only=False))
+    peaks = forecast.take(pa.array(starts, pa.int64()))
+    peak_ids = feature_ids[starts]
+    peak_flows = peaks['streamflow'].to_numpy(zero_copy_only=False).astype(np.float64)
+
+    # Look up the return-period flows of every series, NaN for unknown reaches
+    flows = np.full((len(starts), len(return_periods)), np.nan)
+    if thresholds.num_rows:
+        thresholds = thresholds.sort_by([('feature_id', 'ascending')])
+        threshold_ids = thresholds['feature_id'].to_numpy()
+        positions = np.minimum(np.searchsorted(threshold_ids, peak_ids), len(threshold_ids) - 1)
+        known = threshold_ids[positions] == peak_ids
+        for index, rp in enumerate(return_periods):
+            values = thresholds[f'return_period_{rp}'].to_numpy(zero_copy_only=False).astype(np.float64)
+            flows[known, index] = values[positions[known]]
+
+    # Select the highest return period exceeded by each peak, comparisons with NaN being False
+    with np.errstate(invalid='ignore'):
+        exceeded = peak_flows[:, None] >= flows
+    any_exceeded = exceeded.any(axis=1)
+    highest = len(return_periods) - 1 - np.argmax(exceeded[:, ::-1], axis=1)
+    rows = np.arange(len(starts))
+
+    return pa.table(dict(
+        feature_id=pa.array(peak_ids, pa.int64()),
+        reference_time=peaks['reference_time'],
+        ensemble=peaks['ensemble'],
+        peak_time=peaks['time'],
+        peak_streamflow=pa.array(peak_flows, pa.float64()),
+        return_period=pa.array(np.array(return_periods)[highest], pa.int64(), mask=~any_exceeded),
+        return_period_streamflow=pa.array(flows[rows, highest], pa.float64(), mask=~any_exceeded),
+    ))
+
+
+def filter_exceedance(table: pa.Table, min_return_period: int) -> pa.Table:
+    """Keep the series whose peak exceeds at least min_return_period."""
+    mask = pc.greater_equal(table['return_period'], min_return_period)
+    return table.filter(pc.fill_null(mask, False))
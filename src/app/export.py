@@ -0,0 +1,422 @@
+# Import libraries required for data processing
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from dateutil import parser as date_parser
+
+import numpy as np
+import pyarrow.parquet as pq
+
+from .backends import get_backend
+from .config import settings
+from .queries import FORECAST_OPTS
+from .responses import read_arrow_table
+from .result_cache import normalize_reference_time
+
+# Name of the file holding the specification of an export
+MANIFEST = '_export.json'
+
+# Name of the file holding the progress of an export
+PROGRESS = '_progress.json'
+
+
+def parse_bbox(bbox: str) -> list:
+    """Parse a 'min_lon,min_lat,max_lon,max_lat' bounding box.
+
+    Raises:
+
+        ValueError: If the bounding box is malformed or empty.
+    """
+    try:
+        min_lon, min_lat, max_lon, max_lat = map(float, bbox.split(','))
+    except ValueError:
+        raise ValueError(f"Invalid bounding box {bbox!r}. Expected 'min_lon,min_lat,max_lon,max_lat'.")
+    if not (min_lon < max_lon and min_lat < max_lat):
+        raise ValueError(f"Invalid bounding box {bbox!r}. The minimums must be lower than the maximums.")
+    return [min_lon, min_lat, max_lon, max_lat]
+
+
+def resolve_reaches(comids: list | None = None, hydroshare_id: str | None = None, bbox: list | None = None) -> list:
+    """Return the reaches of an export given as a list, a HydroShare resource or a bounding box.
+
+    The bounding box is looked up in the snapshot of the spatial index when
+    there is one, otherwise the index is built from the query backend.
+    """
+    if bbox is not None:
+        from .spatial import ReachIndex, build_reach_index
+        path = settings.spatial_index_path
+        index = ReachIndex.load(path) if path and os.path.exists(path) else build_reach_index()
+        return index.in_bbox(*bbox).tolist()
+
+    if hydroshare_id:
+        from .hydroshare import comid_resolver
+
+        async def resolve():
+            try:
+                return await comid_resolver.get(hydroshare_id)
+            finally:
+                await comid_resolver.aclose()
+
+        return asyncio.run(resolve())
+
+    return list(comids or [])
+
+
+def export_spec(forecast_type: str, reference_time, comids: list, ensembles: list | None, shard_reaches: int) -> dict:
+    """Return the specification of an export, the reaches being sorted and deduplicated."""
+    return dict(
+        forecast_type=forecast_type,
+        reference_time=normalize_reference_time(reference_time),
+        ensembles=sorted(set(ensembles)) if ensembles else None,
+        shard_reaches=shard_reaches,
+        comids=np.unique(np.asarray(comids, dtype=np.int64)).tolist(),
+    )
+
+
+def job_id(spec: dict) -> str:
+    """Return the identifier of an export, derived from its specification."""
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _part_path(directory, shard):
+    return os.path.join(directory, f'part-{shard:05d}.parquet')
+
+
+def export_shard(directory: str, spec: dict, shard: int) -> dict:
+    """Query the forecast of one shard of reaches and write it as a Parquet file.
+
+    The file is written under a temporary name and renamed once complete, so
+    an existing part file is always a finished shard. This function runs in
+    the worker processes of the export and in the Beam example pipeline.
+
+    Returns:
+
+        dict: The shard number, its number of rows and the size of its file.
+    """
+    size = spec['shard_reaches']
+    comids = spec['comids'][shard * size:(shard + 1) * size]
+    reference_time = datetime.fromisoformat(spec['reference_time'])
+
+    table = read_arrow_table(get_backend().forecast(spec['forecast_type'], reference_time, comids, spec['ensembles']))
+    if table.num_rows:
+        table = table.sort_by([('feature_id', 'ascending'), ('time', 'ascending')])
+
+    path = _part_path(directory, shard)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    pq.write_table(table, temporary_path, compression='zstd')
+    os.replace(temporary_path, path)
+
+    return dict(shard=shard, rows=table.num_rows, bytes=os.path.getsize(path))
+
+
+class ExportJob:
+    """Bulk export of a forecast cycle to sharded Parquet files.
+
+    The reaches of the export are split into shards of shard_reaches reaches,
+    in increasing feature_id order, and the forecast of every shard is
+    written to its own zstd compressed part-NNNNN.parquet file, ordered by
+    feature_id and time. The shards are exported in parallel by a pool of
+    local processes, each with its own query backend.
+
+    The specification of the export is kept in _export.json and its progress
+    in _progress.json, next to the part files. Running an interrupted export
+    again only exports the shards without a part file.
+
+    Args:
+
+        directory (str): The directory of the export.
+        spec (dict): The specification returned by export_spec().
+    """
+
+    def __init__(self, directory: str, spec: dict):
+        self.directory = directory
+        self.spec = spec
+        self.id = job_id(spec)
+
+    @classmethod
+    def create(cls, root: str, spec: dict):
+        """Prepare the export of spec in its own directory of root, or reopen it."""
+        directory = os.path.join(root, job_id(spec))
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                if json.load(f) != spec:
+                    raise ValueError(f'{directory} holds a different export.')
+        else:
+            temporary_path = f'{manifest_path}.tmp'
+            with open(temporary_path, 'w') as f:
+                json.dump(spec, f)
+            os.replace(temporary_path, manifest_path)
+        return cls(directory, spec)
+
+    @classmethod
+    def open(cls, root: str, export_id: str):
+        """Return the export export_id of root, or None if it does not exist."""
+        directory = os.path.join(root, export_id)
+        if not export_id.isalnum() or not os.path.exists(os.path.join(directory, MANIFEST)):
+            return None
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return cls(directory, json.load(f))
+
+    @property
+    def shards(self) -> int:
+        """Return the number of shards of the export."""
+        return -(-len(self.spec['comids']) // self.spec['shard_reaches'])
+
+    def pending_shards(self) -> list:
+        """Return the shards without a part file."""
+        return [shard for shard in range(self.shards) if not os.path.exists(_part_path(self.directory, shard))]
+
+    def progress(self) -> dict:
+        """Return the last recorded progress of the export."""
+        try:
+            with open(os.path.join(self.directory, PROGRESS)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return self._progress('pending', shards_done=self.shards - len(self.pending_shards()))
+
+    def _progress(self, status, **values):
+        return dict(
+            id=self.id,
+            status=status,
+            forecast_type=self.spec['forecast_type'],
+            reference_time=self.spec['reference_time'],
+            reaches=len(self.spec['comids']),
+            shards=self.shards,
+            directory=self.directory,
+            updated_at=datetime.now(timezone.utc).isoformat(),
+            **values,
+        )
+
+    def _record(self, progress):
+        path = os.path.join(self.directory, PROGRESS)
+        temporary_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(progress, f, indent=2)
+        os.replace(temporary_path, path)
+
+    def mark(self, status: str):
+        """Record the status of the export without running it, e.g. 'queued'."""
+        progress = self.progress()
+        progress.update(status=status, updated_at=datetime.now(timezone.utc).isoformat())
+        self._record(progress)
+
+    def run(self, workers: int = 1, on_progress=None) -> dict:
+        """Export the pending shards and return the final progress.
+
+        Args:
+
+            workers (int): The number of processes exporting shards at once.
+                With 1, the shards are exported in the calling process.
+            on_progress (callable, optional): Called with the progress after
+                every exported shard.
+        """
+        # Remove the files of the shards interrupted during a previous run
+        for name in os.listdir(self.directory):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(self.directory, name))
+
+        pending = self.pending_shards()
+        done = sorted(set(range(self.shards)) - set(pending))
+        progress = self._progress(
+            'running',
+            shards_done=len(done),
+            rows=sum(pq.read_metadata(_part_path(self.directory, shard)).num_rows for shard in done),
+            bytes=sum(os.path.getsize(_part_path(self.directory, shard)) for shard in done),
+            resumed=bool(done),
+            started_at=datetime.now(timezone.utc).isoformat(),
+            seconds=0.0,
+            error=None,
+        )
+        self._record(progress)
+        started = time.perf_counter()
+
+        def update(result):
+            progress.update(
+                shards_done=progress['shards_done'] + 1,
+                rows=progress['rows'] + result['rows'],
+                bytes=progress['bytes'] + result['bytes'],
+                seconds=round(time.perf_counter() - started, 3),
+                updated_at=datetime.now(timezone.utc).isoformat(),
+            )
+            self._record(progress)
+            if on_progress is not None:
+                on_progress(dict(progress, shard=result['shard']))
+
+        try:
+            if workers <= 1 or len(pending) <= 1:
+                for shard in pending:
+                    update(export_shard(self.directory, self.spec, shard))
+            else:
+                # Spawn the workers, forking a process running threads is unsafe
+                context = multiprocessing.get_context('spawn')
+                with ProcessPoolExecutor(max_workers=min(workers, len(pending)), mp_context=context) as pool:
+                    futures = [pool.submit(export_shard, self.directory, self.spec, shard) for shard in pending]
+                    try:
+                        for future in as_completed(futures):
+                            update(future.result())
+                    except BaseException:
+                        for future in futures:
+                            future.cancel()
+                        raise
+
+        except BaseException as e:
+            progress.update(status='failed', error=repr(e), updated_at=datetime.now(timezone.utc).isoformat())
+            self._record(progress)
+            raise
+
+        progress.update(
+            status='done',
+            seconds=round(time.perf_counter() - started, 3),
+            finished_at=datetime.now(timezone.utc).isoformat(),
+            updated_at=datetime.now(timezone.utc).isoformat(),
+        )
+        self._record(progress)
+        return progress
+
+
+class ExportQueue:
+    """Exports requested through the API, run one at a time in the background.
+
+    Every export uses its own pool of worker processes, so running them one
+    after the other bounds the load of the instance. An export whose progress
+    says it is queued or running but that is not known to the queue was
+    interrupted, e.g. by a restart of the instance, and is resumed when it is
+    requested again.
+
+    Args:
+
+        directory (str, optional): The directory of the exports. Defaults to
+            None, which disables the exports through the API.
+        workers (int): The number of processes of every export.
+        shard_reaches (int): The number of reaches of every shard.
+    """
+
+    def __init__(self, directory: str | None, workers: int, shard_reaches: int):
+        self.directory = directory
+        self.workers = workers
+        self.shard_reaches = shard_reaches
+        self._queue = queue.Queue()
+        self._active = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._completed = 0
+        self._failed = 0
+
+    def submit(self, forecast_type: str, reference_time, comids: list, ensembles: list | None) -> dict:
+        """Queue the export of a cycle, unless it is already queued, running or done.
+
+        Returns:
+
+            dict: The progress of the export.
+        """
+        spec = export_spec(forecast_type, reference_time, comids, ensembles, self.shard_reaches)
+        job = ExportJob.create(self.directory, spec)
+        with self._lock:
+            if job.id in self._active or job.progress()['status'] == 'done':
+                return self.status(job.id)
+            self._active.add(job.id)
+            job.mark('queued')
+            self._queue.put(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='export', daemon=True)
+                self._thread.start()
+        return self.status(job.id)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job.run(self.workers)
+                self._completed += 1
+            except Exception:
+                # The error is recorded in the progress of the export
+                self._failed += 1
+            finally:
+                with self._lock:
+                    self._active.discard(job.id)
+
+    def status(self, export_id: str) -> dict | None:
+        """Return the progress of an export, or None if it does not exist."""
+        job = ExportJob.open(self.directory, export_id) if self.directory else None
+        if job is None:
+            return None
+        progress = job.progress()
+        if progress['status'] in ('queued', 'running') and export_id not in self._active:
+            progress['status'] = 'interrupted'
+        return progress
+
+    def stats(self) -> dict:
+        """Return whether the exports are enabled and the counts of exports."""
+        return dict(
+            enabled=bool(self.directory),
+            active=len(self._active),
+            completed=self._completed,
+            failed=self._failed,
+        )
+
+
+# Create the export queue shared by the application
+exports = ExportQueue(settings.export_dir, settings.export_workers, settings.export_shard_reaches)
+
+
+def main(argv=None):
+    """Export a forecast cycle to sharded Parquet files from the configured query backend."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('forecast_type', help=f'The forecast run among {list(FORECAST_OPTS)}.')
+    parser.add_argument('--reference-time', help='The reference time of the cycle. Defaults to the latest cycle.')
+    reaches = parser.add_mutually_exclusive_group(required=True)
+    reaches.add_argument('--comids', help='A comma-separated list of reach IDs.')
+    reaches.add_argument('--hydroshare-id', help='A HydroShare resource listing the reach IDs.')
+    reaches.add_argument('--bbox', help="The 'min_lon,min_lat,max_lon,max_lat' bounding box of the reaches.")
+    parser.add_argument('--ensemble', help='A comma-separated list of ensembles. Defaults to their average.')
+    parser.add_argument('--directory', default=settings.export_dir, help='The directory of the exports.')
+    parser.add_argument('--workers', type=int, default=settings.export_workers, help='The number of worker processes.')
+    parser.add_argument('--shard-reaches', type=int, default=settings.export_shard_reaches, help='The number of reaches of every shard.')
+    args = parser.parse_args(argv)
+    if not args.directory:
+        parser.error('Provide the directory or set NWM_API_EXPORT_DIR.')
+    if args.forecast_type not in FORECAST_OPTS:
+        parser.error(f'Invalid forecast type {args.forecast_type!r}. Supported values are {list(FORECAST_OPTS)}.')
+    if args.shard_reaches < 1:
+        parser.error('The number of reaches of every shard must be positive.')
+    try:
+        bbox = parse_bbox(args.bbox) if args.bbox else None
+        comids = list(map(int, args.comids.split(','))) if args.comids else None
+        ensembles = list(map(int, args.ensemble.split(','))) if args.ensemble else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.reference_time:
+        reference_time = date_parser.parse(args.reference_time)
+    else:
+        reference_time = get_backend().latest_reference_time(args.forecast_type)
+    if reference_time is None:
+        parser.error(f'No {args.forecast_type} cycle found.')
+
+    comids = resolve_reaches(comids, args.hydroshare_id, bbox)
+    if not comids:
+        parser.error('No reach to export.')
+
+    job = ExportJob.create(args.directory, export_spec(args.forecast_type, reference_time, comids, ensembles, args.shard_reaches))
+    pending = job.pending_shards()
+    print(f"Export {job.id}: {len(job.spec['comids'])} reaches in {job.shards} shards, {len(pending)} to export in {job.directory}")
+
+    def report(progress):
+        print(f"shard {progress['shard']}: {progress['shards_done']}/{progress['shards']} shards, {progress['rows']} rows, {progress['seconds']}s")
+
+    progress = job.run(args.workers, report)
+    print(f"Export {job.id}: {progress['rows']} rows, {progress['bytes']} bytes in {progress['seconds']}s")
+
+
+if __name__ == '__main__':
+    main()
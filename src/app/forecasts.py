@@ -0,0 +1,132 @@
+# Import libraries required for data processing
+import numpy as np
+import pyarrow as pa
+
+from .backends import get_backend
+from .concurrency import limits
+from .responses import read_arrow_table
+from .result_cache import ArrowRows, forecast_key, forecast_ttl, normalize_reference_time, result_cache
+from .singleflight import single_flight
+
+
+def _split_units(table):
+    # Split a forecast result into one table per (feature_id, ensemble) unit
+    if not table.num_rows:
+        return {}
+
+    table = table.sort_by([('feature_id', 'ascending'), ('ensemble', 'ascending'), ('time', 'ascending')])
+    feature_ids = table['feature_id'].to_numpy()
+    ensembles = table['ensemble'].to_numpy(zero_copy_only=False)
+
+    # Find the rows where a new unit starts
+    starts = np.flatnonzero((feature_ids[1:] != feature_ids[:-1]) | (ensembles[1:] != ensembles[:-1])) + 1
+    starts = np.concatenate([[0], starts])
+    ends = np.concatenate([starts[1:], [table.num_rows]])
+
+    # Copy every unit into its own buffers: a slice would keep the whole
+    # result alive in the cache while being charged for its own rows only
+    return {
+        (table['feature_id'][start].as_py(), table['ensemble'][start].as_py()): table.take(pa.array(np.arange(start, end)))
+        for start, end in zip(starts.tolist(), ends.tolist())
+    }
+
+
+def _store_units(forecast_type, reference_time, results, requested):
+    # Read the results, then cache them unit by unit
+    table = read_arrow_table(results)
+    units = _split_units(table)
+    if not units:
+        # Empty results are not cached, the cycle may not be published yet
+        return units
+
+    # The results of the latest cycle carry the reference time they are cached under
+    if reference_time is None:
+        reference_time = next(iter(units.values()))['reference_time'][0].as_py()
+
+    # The cycle is published, so the requested units it has no data for are
+    # cached empty rather than queried again by every request
+    empty = table.schema.empty_table()
+    units.update({unit: empty for unit in requested if unit not in units})
+
+    ttl = forecast_ttl(reference_time)
+    for unit, unit_table in units.items():
+        result_cache.put(forecast_key(forecast_type, reference_time, *unit), unit_table, ttl)
+
+    return units
+
+
+async def _fetch_units(forecast_type, reference_time, comids, ensembles):
+    results = await limits.query(get_backend().forecast, forecast_type, reference_time, comids, ensembles)
+    requested = [(comid, member) for comid in comids for member in ensembles or ['average']]
+    return await limits.run(_store_units, forecast_type, reference_time, results, requested)
+
+
+def _read_units(forecast_type, reference_time, units):
+    # Look up every unit in the result cache
+    return {unit: result_cache.get(forecast_key(forecast_type, reference_time, *unit)) for unit in units}
+
+
+async def fetch_forecast(forecast_type: str, reference_time, comids: list, ensembles: list | None):
+    """Retrieve a forecast, reusing the cached forecasts of individual reaches.
+
+    The request is decomposed into (reach, ensemble) units, the ensemble
+    being 'average' when no ensemble is requested. Units found in the result
+    cache are reused, the missing reaches are retrieved in a single batched
+    query, shared with the identical requests running concurrently, and
+    cached unit by unit, then the units are reassembled and ordered
+    by time, following the requested reach and ensemble order for equal times.
+
+    Without a reference time, the latest cycle is selected by the query
+    itself, saving a separate lookup, and its units are cached under the
+    reference time found in the results.
+
+    Args:
+
+        forecast_type (str): The forecast run to extract data from.
+        reference_time (datetime, optional): The reference time of the
+            forecast, None for the latest available cycle.
+        comids (list): The reach IDs of the forecast.
+        ensembles (list, optional): The ensembles of the forecast, None for
+            the average of all ensembles.
+
+    Returns:
+
+        The forecast results, readable like the results of the query backends.
+    """
+    # Decompose the request, keeping the requested order of reaches and ensembles
+    members = list(dict.fromkeys(ensembles)) if ensembles else ['average']
+    units = [(comid, member) for comid in dict.fromkeys(comids) for member in members]
+
+    if reference_time is None:
+        # Without a reference time the cached units cannot be looked up
+        tables = dict.fromkeys(units)
+    else:
+        tables = await limits.run(_read_units, forecast_type, reference_time, units)
+
+    missing = [unit for unit, table in tables.items() if table is None]
+    if missing:
+        # Retrieve every missing unit with one query, shared by the identical
+        # requests running concurrently
+        missing_comids = list(dict.fromkeys(comid for comid, _ in missing))
+        missing_ensembles = list(dict.fromkeys(member for _, member in missing)) if ensembles else None
+        key = (
+            'forecast',
+            forecast_type,
+            normalize_reference_time(reference_time) if reference_time else 'latest',
+            tuple(sorted(missing_comids)),
+            tuple(sorted(missing_ensembles)) if missing_ensembles else None,
+        )
+        fetched = await single_flight.do(key, lambda: _fetch_units(
+            forecast_type, reference_time, missing_comids, missing_ensembles
+        ))
+
+        for unit, table in fetched.items():
+            if unit in tables:
+                tables[unit] = table
+
+    # Reassemble the units and order them by time
+    tables = [tables[unit] for unit in units if tables[unit] is not None and tables[unit].num_rows]
+    if not tables:
+        return ArrowRows(pa.table({}))
+
+    return ArrowRows(pa.concat_tables(tables).sort_by([('time', 'ascending')]))
@@ -0,0 +1,147 @@
+# Import libraries required for data processing
+import asyncio
+import time
+from collections import OrderedDict
+
+import httpx
+
+from .config import settings
+
+# Location of the comid list inside a HydroShare resource
+HYDROSHARE_URL = "https://www.hydroshare.org/resource/{hydroshare_id}/data/contents/nwm_comids.json"
+
+
+class ComidResolver:
+    """Resolve the comids listed in HydroShare resources.
+
+    The comid lists are kept in a size-bounded LRU cache. An entry is served
+    as is for ttl seconds. Once expired, it is still served while a background
+    request revalidates it with its ETag / Last-Modified validators, and it
+    keeps being served when HydroShare fails, up to max_stale seconds after
+    it expired. Older entries are fetched again before answering.
+
+    Requests to HydroShare are sent with a pooled asynchronous HTTP client, so
+    waiting on HydroShare does not hold a worker thread.
+
+    Args:
+
+        timeout (float): Timeout in seconds of the requests to HydroShare.
+        cache_size (int): Maximum number of HydroShare resources kept in cache.
+        ttl (float): Number of seconds a comid list is used without revalidation.
+        max_stale (float): Number of seconds an expired comid list can still be
+            served while it is revalidated or HydroShare is unavailable.
+    """
+
+    def __init__(self, timeout: float, cache_size: int, ttl: float, max_stale: float):
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.max_stale = max_stale
+
+        # The client is created on the event loop of the first request
+        self.client = None
+
+        # Entries are only accessed from the event loop, so no lock is needed
+        self._entries = OrderedDict()
+        self._revalidating = {}
+
+    def _client(self):
+        # Reuse keep-alive connections to HydroShare across requests
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_keepalive_connections=16),
+            )
+        return self.client
+
+    async def get(self, hydroshare_id: str) -> list:
+        """Return the comids listed in the nwm_comids.json file of a resource."""
+        entry = self._entries.get(hydroshare_id)
+        if entry is not None:
+            self._entries.move_to_end(hydroshare_id)
+
+        if entry is None:
+            return await self._fetch(hydroshare_id, None)
+
+        age = time.monotonic() - entry['fetched_at']
+        if age < self.ttl:
+            return entry['comids']
+
+        if age < self.ttl + self.max_stale:
+            # Serve the stale list and revalidate it in the background
+            self._revalidate_in_background(hydroshare_id, entry)
+            return entry['comids']
+
+        return await self._fetch(hydroshare_id, entry)
+
+    def _revalidate_in_background(self, hydroshare_id, entry):
+        if hydroshare_id in self._revalidating:
+            return
+
+        async def revalidate():
+            try:
+                await self._fetch(hydroshare_id, entry)
+            except Exception:
+                # The stale list keeps being served until max_stale is reached
+                pass
+            finally:
+                self._revalidating.pop(hydroshare_id, None)
+
+        # Keep a reference to the task until it is done
+        self._revalidating[hydroshare_id] = asyncio.ensure_future(revalidate())
+
+    async def _fetch(self, hydroshare_id, entry):
+        # Send the validators of the cached list so HydroShare can answer 304
+        headers = {}
+        if entry is not None and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        hydroshare_response = await self._client().get(
+            HYDROSHARE_URL.format(hydroshare_id=hydroshare_id),
+            headers=headers,
+            follow_redirects=True,
+        )
+
+        if hydroshare_response.status_code == 304 and entry is not None:
+            comids = entry['comids']
+        else:
+            hydroshare_response.raise_for_status()
+            # Extract comids from the HydroShare data
+            comids = [item.get('comid') for item in hydroshare_response.json()]
+
+        self._store(hydroshare_id, dict(
+            comids=comids,
+            etag=hydroshare_response.headers.get('ETag', entry['etag'] if entry else None),
+            last_modified=hydroshare_response.headers.get('Last-Modified', entry['last_modified'] if entry else None),
+            fetched_at=time.monotonic(),
+        ))
+
+        return comids
+
+    def _store(self, hydroshare_id, entry):
+        self._entries[hydroshare_id] = entry
+        self._entries.move_to_end(hydroshare_id)
+
+        # Evict the least recently used resources
+        while len(self._entries) > self.cache_size:
+            self._entries.popitem(last=False)
+
+    async def aclose(self):
+        """Close the pooled HTTP client."""
+        for task in list(self._revalidating.values()):
+            task.cancel()
+
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+
+# Create the resolver shared by the application
+comid_resolver = ComidResolver(
+    timeout=settings.hydroshare_timeout_seconds,
+    cache_size=settings.hydroshare_cache_size,
+    ttl=settings.hydroshare_cache_ttl_seconds,
+    max_stale=settings.hydroshare_max_stale_seconds,
+)
@@ -1,26 +1,61 @@
 # Import libraries required for data processing
-import csv
+import asyncio
+from contextlib import asynccontextmanager
 from datetime import datetime
 from dateutil import parser
-from io import StringIO
-import requests
 
 # Import libraries associated with FastAPI and BIGQUERY
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse, RedirectResponse, StreamingResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from fastapi.openapi.utils import get_openapi
-from google.cloud import bigquery
 from typing import Union
 
-# Strings corresponding to BIGQUERY table names for different forecast options
-FORECAST_OPTS = dict(
-    long_range = 'bigquery-public-data.national_water_model.long_range_channel_rt',
-    medium_range = 'bigquery-public-data.national_water_model.medium_range_channel_rt',
-    short_range = 'bigquery-public-data.national_water_model.short_range_channel_rt',
+from .backends import close_backend, get_backend
+from .config import settings
+from .concurrency import RequestLimitMiddleware, limits
+from .downsampling import downsample
+from .ensemble_stats import (
+    ENSEMBLE_FORECASTS, ensemble_stats, fetch_ensemble_statistics, parse_ensemble_statistics, read_ensemble_average,
 )
+from .exceedance import classify_exceedance, filter_exceedance
+from .export import exports, parse_bbox
+from .forecasts import fetch_forecast
+from .hydroshare import comid_resolver
+from .metrics import MetricsMiddleware, metrics, stage
+from .queries import AGGREGATE_INTERVALS, FORECAST_OPTS, RETURN_PERIODS, parse_statistics
+from .reference_times import latest_reference_times
+from .responses import format_response, read_arrow_table
+from .result_cache import ArrowRows, result_cache
+from .singleflight import single_flight
+from .static_tables import read_return_periods, read_stream_network, static_tables
+from .spatial import join_points, reach_index, read_points, snap_points
+from .topology import network_topology
+
+# Share one query backend, and its connection pool, for the lifetime of the app
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    limits.open()
+    get_backend()
+    latest_reference_times.start()
+    reach_index.start()
+    network_topology.start()
+    static_tables.start()
+    if settings.ensemble_stats_update:
+        ensemble_stats.start(settings.reference_time_poll_seconds)
+    yield
+    ensemble_stats.stop()
+    latest_reference_times.stop()
+    await comid_resolver.aclose()
+    close_backend()
 
 # Create an app instance of the class FastAPI
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Bound the number of requests processed at once by each instance
+app.add_middleware(RequestLimitMiddleware, limits=limits)
+
+# Measure every request, including the time spent waiting for a request slot
+app.add_middleware(MetricsMiddleware)
 
 # Customize the documentation page as per the OpenAPI framework
 def custom_openapi():
@@ -52,20 +87,55 @@ app.openapi = custom_openapi
 @app.get("/")
 
 # Define the ROOT function
-def root():
+async def root():
     return RedirectResponse("/docs")
 
+# Create path operation decorator for the backend STATUS API
+@app.get("/status", include_in_schema=False)
+
+# Define the STATUS function
+async def status():
+    """Report the query backend in use, its client and connection reuse counters,
+    the result cache counters, the number of coalesced queries, the
+    concurrency counters, the state of the spatial index, of the network
+    topology and of the local snapshots of the static tables, the
+    materialized ensemble statistics and the bulk exports."""
+    backend = get_backend()
+    return dict(
+        backend=type(backend).__name__,
+        **backend.stats(),
+        result_cache=result_cache.stats(),
+        single_flight=single_flight.stats(),
+        concurrency=limits.stats(),
+        spatial_index=reach_index.stats(),
+        network_topology=network_topology.stats(),
+        static_tables=static_tables.stats(),
+        ensemble_stats=ensemble_stats.stats(),
+        exports=exports.stats(),
+    )
+
+# Create path operation decorator for the METRICS API
+@app.get("/metrics", include_in_schema=False)
+
+# Define the METRICS function
+async def metrics_endpoint():
+    """Export the request, stage and query metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Create path operation decorator for the FORECAST API
 @app.get("/forecast")
 
 # Define the FORECAST function
-def forecast(
+async def forecast(
     forecast_type: str,
     reference_time: str | None = None,
     comids: str | None = None,
     hydroshare_id: str | None = None,
+    upstream_of: int | None = None,
+    downstream_of: int | None = None,
     ensemble: str | None = None,
     output_format: str = 'json',
+    dry_run: bool = False,
 ):
     """Retrieve forecast data from the National Water Model based on the provided parameters.
 
@@ -86,6 +156,16 @@ def forecast(
             to extract comids.
             Defaults to None.
             Example: "643dc03878704a30849536e302bdb2c0"
+        upstream_of (int, optional): A reach ID whose upstream basin, the reach
+            included, is selected instead of comids and hydroshare_id.
+            Requires the network topology of the instance.
+            Defaults to None.
+            Example: 15039097
+        downstream_of (int, optional): A reach ID whose downstream path to the
+            outlet, the reach included, is selected instead of comids and
+            hydroshare_id. Combined with upstream_of, both sets are returned.
+            Defaults to None.
+            Example: 15039097
         ensemble (str, optional): A comma-separated list of ensembles for the forecast.
             If None then the average of all available ensembles will be taken.
             Defaults to None.
@@ -93,7 +173,11 @@ def forecast(
             0 to 3 for long_range
         output_format (str, optional): The output format for the forecast dataset.
             Defaults to 'json'.
-            Supported values are 'json' and 'csv'.
+            Supported values are 'json', 'csv', 'parquet' and 'arrow'.
+        dry_run (bool, optional): If True, the query is validated but not run
+            and the number of bytes it would scan is returned instead.
+            Only supported by the BigQuery backend.
+            Defaults to False.
 
 
     Returns:
@@ -101,121 +185,447 @@ def forecast(
         The forecast data in the specified output format.
     """
 
-    # Select the appropriate table based on the "type" parameter
-    if forecast_type in FORECAST_OPTS.keys():
-        table_name = FORECAST_OPTS[forecast_type]
-    else:
+    # Validate the forecast run based on the "type" parameter
+    if forecast_type not in FORECAST_OPTS.keys():
+        raise HTTPException(status_code=400, detail=f"Invalid forecast type. Supported values are {FORECAST_OPTS.keys()}.")
+
+    # Resolve the reference time and the comids concurrently
+    reference_time, comids = await asyncio.gather(
+        resolve_reference_time(forecast_type, reference_time),
+        extract_comid_input(comids, hydroshare_id, upstream_of, downstream_of),
+    )
+
+    # If ensemble is provided, split by comma
+    ensembles = parse_integers(ensemble, 'ensemble') if ensemble else None
+
+    if dry_run:
+        return await estimate_query('forecast', forecast_type, reference_time, comids, ensembles)
+
+    # Read the ensemble average of the materialized cycles, otherwise retrieve
+    # the data, reusing the cached forecasts of individual reaches
+    results = None
+    if ensembles is None:
+        results = await read_ensemble_average(forecast_type, reference_time, comids)
+    if results is None:
+        results = await fetch_forecast(forecast_type, reference_time, comids, ensembles)
+
+    response = await format_response(results, output_format)
+
+    return response
+
+# Create path operation decorator for the FORECAST EXCEEDANCE API
+@app.get("/forecast-exceedance")
+
+# Define the FORECAST EXCEEDANCE function
+async def forecast_exceedance(
+    forecast_type: str,
+    reference_time: str | None = None,
+    comids: str | None = None,
+    hydroshare_id: str | None = None,
+    ensemble: str | None = None,
+    return_periods: str | None = None,
+    min_return_period: int | None = None,
+    output_format: str = 'json',
+):
+    """Classify the forecast of every reach by the highest flood return period its peak exceeds.
+
+    The forecast is joined with the flood return periods of its reaches on the
+    server, so one row per reach and ensemble is returned instead of the
+    whole time series.
+
+    Args:
+
+        forecast_type (str): The forecast run to extract data from.
+            Supported values are 'long_range', 'medium_range', and 'short_range'.
+        reference_time (str, optional): The reference time for the forecast.
+            If None then defaults to the latest available forecast reference time
+            in specified table.
+            Defaults to None.
+            Example: "2023-11-25 06:00:00 UTC"
+        comids (str, optional): A comma-separated list of reach IDs for the forecast.
+            Defaults to None.
+            Example: "15039097,1239657"
+        hydroshare_id (str, optional): The hydroshare id with specified comids to
+            extract the forecast. If comids is not provided, this will be used
+            to extract comids.
+            Defaults to None.
+            Example: "643dc03878704a30849536e302bdb2c0"
+        ensemble (str, optional): A comma-separated list of ensembles for the forecast.
+            If None then the average of all available ensembles will be taken.
+            Defaults to None.
+            Supported values are 0 for short_range, 0 to 5 for medium_range, and
+            0 to 3 for long_range
+        return_periods (str, optional): A comma-separated list of the return
+            periods to compare the peaks with.
+            Defaults to None, for all six return periods.
+            Example: "2,10,100"
+        min_return_period (int, optional): If provided, only the reaches and
+            ensembles whose peak exceeds at least this return period are returned.
+            Defaults to None.
+            Example: 10
+        output_format (str, optional): The output format for the classification.
+            Defaults to 'json'.
+            Supported values are 'json', 'csv', 'parquet' and 'arrow'.
+
+    Returns:
+
+        The feature_id, reference_time, ensemble, peak_time, peak_streamflow,
+        return_period and return_period_streamflow of every reach and ensemble,
+        return_period being the highest return period exceeded by the peak,
+        or null if none is exceeded, in the specified output format.
+    """
+
+    # Validate the forecast run based on the "type" parameter
+    if forecast_type not in FORECAST_OPTS.keys():
         raise HTTPException(status_code=400, detail=f"Invalid forecast type. Supported values are {FORECAST_OPTS.keys()}.")
 
-    # Default reference_time to the latest available if not specified
+    # Only the known return periods can be compared with
+    return_periods = return_periods.split(",") if return_periods else None
+    if return_periods and not set(return_periods) <= set(map(str, RETURN_PERIODS)):
+        raise HTTPException(status_code=400, detail=f"Invalid return_periods. Supported values are {list(RETURN_PERIODS)}.")
+    if min_return_period is not None and min_return_period not in RETURN_PERIODS:
+        raise HTTPException(status_code=400, detail=f"Invalid min_return_period. Supported values are {list(RETURN_PERIODS)}.")
+
+    # Resolve the reference time and the comids concurrently
+    reference_time, comids = await asyncio.gather(
+        resolve_reference_time(forecast_type, reference_time),
+        extract_comid_input(comids, hydroshare_id),
+    )
+
+    # If ensemble is provided, split by comma
+    ensembles = parse_integers(ensemble, 'ensemble') if ensemble else None
+
+    # Retrieve the forecast and the return periods concurrently
+    forecast_results, return_period_results = await asyncio.gather(
+        fetch_forecast(forecast_type, reference_time, comids, ensembles),
+        read_return_periods(comids, return_periods),
+    )
+
+    # Reduce every series to its peak and compare it with the return periods
+    table = await limits.run(
+        classify_exceedance, forecast_results.table, return_period_results.table, return_periods
+    )
+    if min_return_period is not None:
+        table = await limits.run(filter_exceedance, table, min_return_period)
+
+    response = await format_response(ArrowRows(table), output_format)
+
+    return response
+
+# Create path operation decorator for the FORECAST STATISTICS API
+@app.get("/forecast-statistics")
+
+# Define the FORECAST STATISTICS function
+async def forecast_statistics(
+    forecast_type: str,
+    reference_time: str | None = None,
+    comids: str | None = None,
+    hydroshare_id: str | None = None,
+    statistics: str | None = None,
+    output_format: str = 'json',
+):
+    """Retrieve statistics of the members of a medium or long range forecast.
+
+    The statistics of the recent cycles are materialized once per cycle and
+    read from that store; the other cycles are computed from the members of
+    the requested reaches.
+
+    Args:
+
+        forecast_type (str): The forecast run to extract data from.
+            Supported values are 'long_range' and 'medium_range'.
+        reference_time (str, optional): The reference time for the forecast.
+            If None then defaults to the latest available forecast reference time
+            in specified table.
+            Defaults to None.
+            Example: "2023-11-25 06:00:00 UTC"
+        comids (str, optional): A comma-separated list of reach IDs for the forecast.
+            Defaults to None.
+            Example: "15039097,1239657"
+        hydroshare_id (str, optional): The hydroshare id with specified comids to
+            extract the forecast. If comids is not provided, this will be used
+            to extract comids.
+            Defaults to None.
+            Example: "643dc03878704a30849536e302bdb2c0"
+        statistics (str, optional): A comma-separated list of the statistics
+            computed over the members for every reach and time.
+            Defaults to None, for 'mean,median,min,max,std'.
+            Supported values are 'mean', 'median', 'min', 'max', 'std' and the
+            percentiles 'p1' to 'p99'.
+            Example: "mean,p10,p90"
+        output_format (str, optional): The output format for the statistics.
+            Defaults to 'json'.
+            Supported values are 'json', 'csv', 'parquet' and 'arrow'.
+
+    Returns:
+
+        The feature_id, reference_time, time, number of members and a
+        streamflow_<statistic> and velocity_<statistic> column for each
+        statistic, in the specified output format.
+    """
+
+    # Only the medium and long range forecasts have several members
+    if forecast_type not in ENSEMBLE_FORECASTS:
+        raise HTTPException(status_code=400, detail=f"Invalid forecast type. Supported values are {list(ENSEMBLE_FORECASTS)}.")
+
+    # Split the requested statistics by comma
+    try:
+        statistics = parse_ensemble_statistics(statistics.split(",") if statistics else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Resolve the reference time and the comids concurrently
+    reference_time, comids = await asyncio.gather(
+        resolve_reference_time(forecast_type, reference_time),
+        extract_comid_input(comids, hydroshare_id),
+    )
+
+    # The store is organized by cycle, so the latest cycle is looked up when not cached
     if reference_time is None:
-        # Query to get the latest reference_time
-        latest_reference_time_query = f"""
-            SELECT
-                MAX(reference_time) AS latest_reference_time
-            FROM
-                `{table_name}`
-            WHERE
-                DATETIME(reference_time) >= DATE_SUB(CURRENT_DATE(), INTERVAL 1 DAY)
-                AND feature_id = 101
-                AND ensemble = 0
-        """
-        latest_reference_time_result = run_query(latest_reference_time_query)
-
-        # Iterate over the results to get the latest reference_time
-        for row in latest_reference_time_result:
-            reference_time = row['latest_reference_time']
+        reference_time = await limits.run(latest_reference_times.get, forecast_type)
+        if reference_time is None:
+            raise HTTPException(status_code=404, detail="No forecast cycle is available.")
 
-    else:
-        # Convert the input reference_time string to a datetime object
-        try:
-            reference_time = parser.parse(reference_time)
+    results = await fetch_ensemble_statistics(forecast_type, reference_time, comids, statistics)
 
-        except ValueError as e:
-            raise HTTPException(status_code=400, detail=f"Error parsing reference_time: {str(e)}")
+    response = await format_response(results, output_format)
+
+    return response
+
+# Create path operation decorator for the FORECAST CYCLES API
+@app.get("/forecast-cycles")
+
+# Define the FORECAST CYCLES function
+async def forecast_cycles(
+    forecast_type: str,
+    start_reference_time: str | None = None,
+    end_reference_time: str | None = None,
+    reference_times: str | None = None,
+    comids: str | None = None,
+    hydroshare_id: str | None = None,
+    ensemble: str | None = None,
+    output_format: str = 'json',
+    dry_run: bool = False,
+):
+    """Retrieve the forecasts of several cycles of the National Water Model at once.
+
+    Every cycle is read by a single query, so hindcasts and forecast skill
+    can be computed without one request per cycle.
+
+    Args:
+
+        forecast_type (str): The forecast run to extract data from.
+            Supported values are 'long_range', 'medium_range', and 'short_range'.
+        start_reference_time (str, optional): The reference time of the first
+            cycle of the window. Must be provided with end_reference_time if
+            reference_times is not.
+            Defaults to None.
+            Example: "2023-11-01 00:00:00 UTC"
+        end_reference_time (str, optional): The reference time of the last
+            cycle of the window.
+            Defaults to None.
+            Example: "2023-11-30 18:00:00 UTC"
+        reference_times (str, optional): A comma-separated list of the reference
+            times of the cycles, instead of a window.
+            Defaults to None.
+            Example: "2023-11-25 00:00:00,2023-11-25 06:00:00"
+        comids (str, optional): A comma-separated list of reach IDs for the forecast.
+            Defaults to None.
+            Example: "15039097,1239657"
+        hydroshare_id (str, optional): The hydroshare id with specified comids to
+            extract the forecast. If comids is not provided, this will be used
+            to extract comids.
+            Defaults to None.
+            Example: "643dc03878704a30849536e302bdb2c0"
+        ensemble (str, optional): A comma-separated list of ensembles for the forecast.
+            If None then the average of all available ensembles will be taken.
+            Defaults to None.
+            Supported values are 0 for short_range, 0 to 5 for medium_range, and
+            0 to 3 for long_range
+        output_format (str, optional): The output format for the forecast dataset.
+            Defaults to 'json'.
+            Supported values are 'json', 'csv', 'parquet' and 'arrow'.
+        dry_run (bool, optional): If True, the query is validated but not run
+            and the number of bytes it would scan is returned instead.
+            Only supported by the BigQuery backend.
+            Defaults to False.
+
+    Returns:
+
+        The forecast data of every cycle in the specified output format, with a
+        lead_time column holding the number of hours since the reference time,
+        ordered by reference time, reach, ensemble and lead time.
+    """
+
+    # Validate the forecast run based on the "type" parameter
+    if forecast_type not in FORECAST_OPTS.keys():
+        raise HTTPException(status_code=400, detail=f"Invalid forecast type. Supported values are {FORECAST_OPTS.keys()}.")
+
+    # Select the cycles from either the list or the window
+    try:
+        if reference_times:
+            reference_times = [parser.parse(value) for value in reference_times.split(',')]
+            start_reference_time, end_reference_time = min(reference_times), max(reference_times)
+        elif start_reference_time and end_reference_time:
+            start_reference_time, end_reference_time = parser.parse(start_reference_time), parser.parse(end_reference_time)
+            reference_times = None
+        else:
+            raise HTTPException(status_code=400, detail="Provide reference_times or both start_reference_time and end_reference_time.")
+
+        window_is_empty = start_reference_time > end_reference_time
+
+    except (ValueError, OverflowError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=f"Error parsing the reference times: {str(e)}")
+
+    if window_is_empty:
+        raise HTTPException(status_code=400, detail="start_reference_time must not be after end_reference_time.")
 
     # Extract comids from either the comid or hydroshare_id input
-    comids = extract_comid_input(comids, hydroshare_id)
+    comids = await extract_comid_input(comids, hydroshare_id)
 
     # If ensemble is provided, split by comma
-    ensembles = list(map(int, ensemble.split(','))) if ensemble else None
-
-    if not ensembles:
-        # If no ensemble specified, create a new roll with "average" in the "ensemble" column
-        # Combine rolls with the same values for "feature_id", "reference_time", and "time"
-        # Calculate the average for the columns "streamflow" and "velocity"
-        query = f"""
-            WITH average_rolls AS (
-                SELECT
-                    feature_id,
-                    reference_time,
-                    time,
-                    'average' AS ensemble,
-                    AVG(streamflow) AS streamflow,
-                    AVG(velocity) AS velocity
-                FROM
-                    `{table_name}`
-                WHERE
-                    feature_id IN ({", ".join(map(str, comids))})
-                    AND reference_time = '{reference_time}'
-                GROUP BY
-                    feature_id, reference_time, time
-            )
-            SELECT *
-            FROM average_rolls
-            ORDER BY time
-        """
-    else:
-        # If ensemble(s) is specified, use them in the query
-        query = f"""
-            SELECT
-                feature_id,
-                reference_time,
-                time,
-                ensemble,
-                streamflow,
-                velocity
-            FROM
-                `{table_name}`
-            WHERE
-                feature_id IN ({", ".join(map(str, comids))})
-                AND reference_time = '{reference_time}'
-                AND ensemble IN ({", ".join(map(str, ensembles))})
-            ORDER BY
-                time
-        """
-
-    # Make API request to BigQuery and retrieve data
-    results = run_query(query)
-
-    # Create a list of JSON objects with the selected columns
-    response_data = []
-    for row in results:
-        # Convert the BigQuery Row object to a dictionary
-        json_obj = dict(row.items())
-
-        # Convert datetime objects to string
-        for key, value in json_obj.items():
-            if isinstance(value, datetime):
-                json_obj[key] = value.strftime("%Y-%m-%dT%H:%M:%S")
-
-        response_data.append(json_obj)
-
-    response = format_response(response_data, output_format)
+    ensembles = parse_integers(ensemble, 'ensemble') if ensemble else None
+
+    args = (forecast_type, start_reference_time, end_reference_time, reference_times, comids, ensembles)
+    if dry_run:
+        return await estimate_query('forecast_cycles', *args)
+
+    # Make API request to the query backend, streaming the records of every cycle
+    results = await limits.query(get_backend().forecast_cycles, *args)
+
+    response = await format_response(results, output_format)
 
     return response
 
+# Create path operation decorator for the EXPORT API
+@app.post("/export", status_code=202)
+
+# Define the EXPORT function
+async def export(
+    forecast_type: str,
+    reference_time: str | None = None,
+    comids: str | None = None,
+    hydroshare_id: str | None = None,
+    bbox: str | None = None,
+    ensemble: str | None = None,
+):
+    """Start the bulk export of a forecast cycle to sharded Parquet files.
+
+    The export runs in the background and writes one zstd compressed Parquet
+    file per shard of reaches in the export directory of the instance. The
+    same request returns the progress of the export instead of starting it
+    again, and resumes it when it was interrupted.
+
+    Args:
+
+        forecast_type (str): The forecast run to extract data from.
+            Supported values are 'long_range', 'medium_range', and 'short_range'.
+        reference_time (str, optional): The reference time for the forecast.
+            If None then defaults to the latest available forecast reference time
+            in specified table.
+            Defaults to None.
+            Example: "2023-11-25 06:00:00 UTC"
+        comids (str, optional): A comma-separated list of reach IDs for the forecast.
+            Defaults to None.
+            Example: "15039097,1239657"
+        hydroshare_id (str, optional): The hydroshare id with specified comids to
+            extract the forecast. If comids is not provided, this will be used
+            to extract comids.
+            Defaults to None.
+            Example: "643dc03878704a30849536e302bdb2c0"
+        bbox (str, optional): A bounding box selecting the reaches with a vertex
+            inside it, as 'min_lon,min_lat,max_lon,max_lat'. Takes precedence
+            over comids and hydroshare_id.
+            Defaults to None.
+            Example: "-112.0,40.0,-111.5,40.5"
+        ensemble (str, optional): A comma-separated list of ensembles for the forecast.
+            If None then the average of all available ensembles will be taken.
+            Defaults to None.
+
+    Returns:
+
+        The id, status and progress of the export.
+    """
+
+    if not exports.directory:
+        raise HTTPException(status_code=400, detail="Bulk exports are not enabled on this instance.")
+
+    # Validate the forecast run based on the "type" parameter
+    if forecast_type not in FORECAST_OPTS.keys():
+        raise HTTPException(status_code=400, detail=f"Invalid forecast type. Supported values are {FORECAST_OPTS.keys()}.")
+
+    # Select the reaches of the bounding box from the spatial index, otherwise
+    # resolve the comids
+    if bbox:
+        try:
+            bbox = parse_bbox(bbox)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        index = reach_index.get()
+        if index is None:
+            raise HTTPException(status_code=503, detail="The spatial index is not available.")
+        reference_time = await resolve_reference_time(forecast_type, reference_time)
+        comids = (await limits.run(index.in_bbox, *bbox)).tolist()
+    else:
+        reference_time, comids = await asyncio.gather(
+            resolve_reference_time(forecast_type, reference_time),
+            extract_comid_input(comids, hydroshare_id),
+        )
+    if not comids:
+        raise HTTPException(status_code=400, detail="No reach to export.")
+
+    # If ensemble is provided, split by comma
+    ensembles = parse_integers(ensemble, 'ensemble') if ensemble else None
+
+    # The export is identified by its cycle, so the latest cycle is looked up when not cached
+    if reference_time is None:
+        reference_time = await limits.run(latest_reference_times.get, forecast_type)
+        if reference_time is None:
+            raise HTTPException(status_code=404, detail="No forecast cycle is available.")
+
+    return await limits.run(exports.submit, forecast_type, reference_time, comids, ensembles)
+
+# Create path operation decorator for the EXPORT STATUS API
+@app.get("/export/{export_id}")
+
+# Define the EXPORT STATUS function
+async def export_status(export_id: str):
+    """Report the progress of a bulk export.
+
+    Args:
+
+        export_id (str): The id returned when the export was started.
+
+    Returns:
+
+        The status of the export, 'queued', 'running', 'done', 'failed' or
+        'interrupted', its number of exported shards, rows and bytes and the
+        directory of its Parquet files.
+    """
+
+    progress = await limits.run(exports.status, export_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Unknown export.")
+
+    return progress
+
 # Create path operation decorator for the Analysis-Assimilation API
 @app.get("/analysis-assim")
 
 # Define the Analysis-Assimilation app function
-def analysis_assim(
+async def analysis_assim(
     start_time: str | None = None,
     end_time: str | None = None,
     comids: str | None = None,
     hydroshare_id: str | None = None,
+    upstream_of: int | None = None,
+    downstream_of: int | None = None,
     output_format: str = 'json',
     run_offset: int = 1,
+    aggregate: str | None = None,
+    statistics: str | None = None,
+    max_points: int | None = None,
+    dry_run: bool = False,
 ):
     """
     Retrieve the analysis assimilation data from the National Water Model for the specified parameters.
@@ -234,12 +644,43 @@ def analysis_assim(
             to extract comids.
             Defaults to None.
             Example: "643dc03878704a30849536e302bdb2c0"
+        upstream_of (int, optional): A reach ID whose upstream basin, the reach
+            included, is selected instead of comids and hydroshare_id.
+            Requires the network topology of the instance.
+            Defaults to None.
+            Example: 15039097
+        downstream_of (int, optional): A reach ID whose downstream path to the
+            outlet, the reach included, is selected instead of comids and
+            hydroshare_id. Combined with upstream_of, both sets are returned.
+            Defaults to None.
+            Example: 15039097
         output_format (str): The format of the analysis-assimilation response data.
             Defaults to 'json'.
-            Supported values are 'json' and 'csv'.
+            Supported values are 'json', 'csv', 'parquet' and 'arrow'.
         run_offset (int): The analysis_assim result time offset.
             Defaults to 1.
             Supported values are 1, 2, and 3.
+        aggregate (str, optional): The interval the records of every reach are
+            aggregated over. The response then holds one record per reach and
+            interval with a streamflow_<statistic> and velocity_<statistic>
+            column for each statistic and the number of records aggregated.
+            Defaults to None, which returns every record.
+            Supported values are 'hourly', 'daily' and 'monthly'.
+        statistics (str, optional): A comma-separated list of the statistics
+            computed over every interval when aggregate is provided.
+            Defaults to None, for the mean.
+            Supported values are 'mean', 'min', 'max' and the percentiles 'p1'
+            to 'p99'. The BigQuery backend approximates the percentiles.
+            Example: "mean,max,p95"
+        max_points (int, optional): The largest number of records returned for
+            every reach. The records preserving the shape of the streamflow
+            series are selected with the Largest-Triangle-Three-Buckets
+            algorithm, after the aggregation if any.
+            Defaults to None, for no limit. Must be at least 3.
+        dry_run (bool, optional): If True, the query is validated but not run
+            and the number of bytes it would scan is returned instead.
+            Only supported by the BigQuery backend.
+            Defaults to False.
 
     Returns:
 
@@ -248,7 +689,7 @@ def analysis_assim(
     """
 
     # Extract comids from either the comid or hydroshare_id input
-    comids = extract_comid_input(comids, hydroshare_id)
+    comids = await extract_comid_input(comids, hydroshare_id, upstream_of, downstream_of)
 
     if run_offset not in range(1,4):
         raise HTTPException(status_code=400, detail="Invalid run_offset. Supported values are 1, 2, and 3.")
@@ -259,40 +700,33 @@ def analysis_assim(
     if end_time is None:
         end_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
-    query = f"""
-        SELECT
-            feature_id,
-            time,
-            streamflow,
-            velocity
-        FROM
-            `bigquery-public-data.national_water_model.analysis_assim_channel_rt`
-        WHERE
-            feature_id IN ({", ".join(map(str, comids))})
-            AND forecast_offset = {run_offset}
-            AND time >= '{start_time}'
-            AND time <= '{end_time}'
-        ORDER BY
-            time
-    """
+    if aggregate is not None and aggregate not in AGGREGATE_INTERVALS:
+        raise HTTPException(status_code=400, detail=f"Invalid aggregate. Supported values are {list(AGGREGATE_INTERVALS)}.")
+
+    # Split the requested statistics by comma
+    try:
+        statistics = parse_statistics(statistics.split(",") if statistics else None)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    # Make API request to BigQuery and retrieve data
-    results = run_query(query)
+    if max_points is not None and max_points < 3:
+        raise HTTPException(status_code=400, detail="Invalid max_points. It must be at least 3.")
 
-     # Create a list of JSON objects with the selected columns
-    response_data = []
-    for row in results:
-        # Convert the BigQuery Row object to a dictionary
-        json_obj = dict(row.items())
+    if dry_run:
+        return await estimate_query('analysis_assim', comids, run_offset, start_time, end_time, aggregate, statistics)
 
-        # Convert datetime objects to string
-        for key, value in json_obj.items():
-            if isinstance(value, datetime):
-                json_obj[key] = value.strftime("%Y-%m-%dT%H:%M:%S")
+    # Make API request to the query backend and retrieve data, aggregated by the query engine
+    results = await limits.query(
+        get_backend().analysis_assim, comids, run_offset, start_time, end_time, aggregate, statistics
+    )
 
-        response_data.append(json_obj)
+    if max_points is not None:
+        # Keep the records preserving the shape of the streamflow of every reach
+        table = await limits.run(read_arrow_table, results)
+        column = f"streamflow_{statistics[0]}" if aggregate else "streamflow"
+        results = ArrowRows(await limits.run(downsample, table, max_points, column))
 
-    response = format_response(response_data, output_format)
+    response = await format_response(results, output_format)
 
     return response
 
@@ -301,12 +735,15 @@ def analysis_assim(
 @app.get("/geometry")
 
 # Define the GEOMETRY app function
-def geometry(
+async def geometry(
     comids: str | None = None,
     hydroshare_id: str | None = None,
     lat: float | None = None,
     lon: float | None = None,
-    output_format: str = 'json'
+    k: int = 1,
+    max_distance: float | None = None,
+    output_format: str = 'json',
+    dry_run: bool = False,
 ):
     """Retrieve reach spatial geometry and attribute data from the National Water
       Model based on the provided parameters.
@@ -329,9 +766,20 @@ def geometry(
             Must provide lat as well if provided.
             Defaults to None.
             Example: -111.0
+        k (int, optional): The number of reaches closest to the point (lat, lon)
+            to return, ordered by distance.
+            Defaults to 1. Supported values are 1 to 100.
+        max_distance (float, optional): The distance in meters from the point
+            (lat, lon) beyond which reaches are not returned.
+            Defaults to None, for no limit.
         output_format (str, optional): The output format of the geometry data.
             Defaults to 'json'.
-            Supported values are 'json' and 'csv'.
+            Supported values are 'json', 'csv', 'parquet' and 'arrow'.
+        dry_run (bool, optional): If True, the query is validated but not run
+            and the number of bytes it would scan is returned instead.
+            Only supported by the BigQuery backend.
+            Defaults to False.
+
     Returns:
 
         The geometry data in the specified output format.
@@ -339,76 +787,119 @@ def geometry(
     # Validate input combinations
     if comids:
         # If comids are provided, use them
-        station_ids = comids.split(',')
+        station_ids = parse_integers(comids, 'comids')
         hydroshare_id = None
         lat = None
         lon = None
 
-        # Construct the BigQuery query to select specific columns with a JOIN statement
-        query = f"""
-            SELECT
-                *
-            FROM
-                `bigquery-public-data.national_water_model.stream_network`
-            WHERE
-                station_id IN ({", ".join(map(str, station_ids))})
-            ORDER BY
-                station_id
-        """
+        if dry_run:
+            return await estimate_query('stream_network', station_ids)
+
+        # Read the records from the local snapshot or the query backend
+        results = await read_stream_network(station_ids)
 
     elif hydroshare_id:
         # If hydroshare_id is provided, fetch comids from HydroShare
-        hydroshare_url = f"https://www.hydroshare.org/resource/{hydroshare_id}/data/contents/nwm_comids.json"
-        try:
-            hydroshare_response = requests.get(hydroshare_url)
-            hydroshare_data = hydroshare_response.json()
-        except Exception as e:
-            return f"Error retrieving HydroShare data: {str(e)}"
-
-        station_ids = [item.get('comid') for item in hydroshare_data]
+        station_ids = await extract_comid_input(None, hydroshare_id)
 
         if not station_ids:
             raise HTTPException(status_code=500, detail="No feature IDs found in HydroShare data.")
 
-        # Construct the BigQuery query to select specific columns with a JOIN statement
-        query = f"""
-            SELECT
-                *
-            FROM
-                `bigquery-public-data.national_water_model.stream_network`
-            WHERE
-                station_id IN ({", ".join(map(str, station_ids))})
-            ORDER BY
-                station_id
-        """
+        if dry_run:
+            return await estimate_query('stream_network', station_ids)
+
+        # Read the records from the local snapshot or the query backend
+        results = await read_stream_network(station_ids)
 
     elif lat and lon:
-        # If lat and lon are provided, find the closest 'to' using Haversine formula
-        query = f"""
-            SELECT
-                streams.*,
-                ST_DISTANCE(streams.geometry, ST_GEOGPOINT({lon}, {lat})) AS distance
-            FROM
-                `bigquery-public-data.national_water_model.stream_network` AS streams
-            ORDER BY distance
-            LIMIT 1
-        """
+        # If lat and lon are provided, find the closest reaches to the point
+        if k not in range(1, 101):
+            raise HTTPException(status_code=400, detail="Invalid k. Supported values are 1 to 100.")
+
+        if dry_run:
+            return await estimate_query('nearest_reach', lat, lon, k, max_distance)
+
+        index = reach_index.get()
+        if index is not None:
+            # Look the reaches up in the spatial index rather than scanning the network
+            results = ArrowRows((await snap_points(index, [lat], [lon], k, max_distance)).drop_columns(['point']))
+        else:
+            results = await limits.query(get_backend().nearest_reach, lat, lon, k, max_distance)
 
     else:
         # If none of the input combinations match, return an error
         raise HTTPException(status_code=400, detail='Please provide either "comids", "hs_resource", or (lat and lon) query parameters.')
 
-    # Make API request to BigQuery and retrieve data
-    results = run_query(query)
+    response = await format_response(results, output_format)
+
+    return response
+
+
+# Create path operation decorator for the Point-Snapping API
+@app.post("/snap")
 
-    # Create a list of JSON objects with the selected columns
-    response_data = []
-    for row in results:
-        # Convert the BigQuery Row object to a dictionary
-        json_obj = dict(row.items())
-        response_data.append(json_obj)
+# Define the SNAP app function
+async def snap(
+    request: Request,
+    k: int = 1,
+    max_distance: float | None = None,
+    attributes: bool = False,
+    output_format: str = 'json',
+):
+    """Find the reaches closest to many points at once.
 
-    response = format_response(response_data, output_format)
+    The points are sent in the request body, either as CSV ('text/csv') with
+    lat and lon columns, or as JSON ('application/json' or
+    'application/geo+json') holding a list of {"lat", "lon"} objects or a
+    GeoJSON FeatureCollection of points. An optional id column or field is
+    returned with the matches of each point. Every point is resolved in a
+    single pass over the spatial index.
+
+    Args:
+
+        k (int, optional): The number of reaches closest to each point to
+            return, ordered by distance.
+            Defaults to 1. Supported values are 1 to 100.
+        max_distance (float, optional): The distance in meters beyond which
+            reaches are not returned. Points without any reach within
+            max_distance are returned without a station_id.
+            Defaults to None, for no limit.
+        attributes (bool, optional): Whether to include the stream_network
+            attributes of the matched reaches.
+            Defaults to False, which only returns their station_id and distance.
+        output_format (str, optional): The output format of the matches.
+            Defaults to 'json'.
+            Supported values are 'json', 'csv', 'parquet' and 'arrow'.
+
+    Returns:
+
+        The point index, id, lat, lon, station_id and distance in meters of
+        every match, in the specified output format.
+    """
+    if k not in range(1, 101):
+        raise HTTPException(status_code=400, detail="Invalid k. Supported values are 1 to 100.")
+
+    index = reach_index.get()
+    if index is None:
+        raise HTTPException(status_code=503, detail="The spatial index is not available. Set NWM_API_SPATIAL_INDEX_PATH or retry once it is loaded.")
+
+    # Read the points from the request body
+    try:
+        points = await limits.run(read_points, await request.body(), request.headers.get('content-type', 'application/json'))
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Error reading the points: {str(e)}")
+
+    if points.num_rows > settings.snap_max_points:
+        raise HTTPException(status_code=400, detail=f"Too many points. At most {settings.snap_max_points} points can be snapped at once.")
+
+    # Snap every point in one pass and attach the matches to the points
+    matches = await snap_points(
+        index, points['lat'].to_numpy(), points['lon'].to_numpy(), k, max_distance, attributes
+    )
+    results = ArrowRows(await limits.run(join_points, points, matches))
+
+    response = await format_response(results, output_format)
 
     return response
 
@@ -417,12 +908,15 @@ def geometry(
 @app.get("/return-period")
 
 # Define the Flood Return-Periods app function
-def flood_return_periods(
+async def flood_return_periods(
     comids: str | None = None,
     hydroshare_id: str | None = None,
+    upstream_of: int | None = None,
+    downstream_of: int | None = None,
     return_periods: str | None = None,
     output_format: str = 'json',
     order_by_comid: bool = False,
+    dry_run: bool = False,
 ):
     """
     Retrieve the flood return-periods data for specified reach IDs in desired output format.
@@ -439,6 +933,16 @@ def flood_return_periods(
             to extract comids.
             Defaults to None.
             Example: "643dc03878704a30849536e302bdb2c0"
+        upstream_of (int, optional): A reach ID whose upstream basin, the reach
+            included, is selected instead of comids and hydroshare_id.
+            Requires the network topology of the instance.
+            Defaults to None.
+            Example: 15039097
+        downstream_of (int, optional): A reach ID whose downstream path to the
+            outlet, the reach included, is selected instead of comids and
+            hydroshare_id. Combined with upstream_of, both sets are returned.
+            Defaults to None.
+            Example: 15039097
         return_periods (str, optional): A comma-separated list of return-period
             fields to be included in the response.
             Defaults to None. None will extract all six return-periods namely
@@ -446,10 +950,14 @@ def flood_return_periods(
             Example: "10,50,100"
         output_format (str): The format of the return-period response data.
             Defaults to 'json'.
-            Supported values are 'json' and 'csv'.
+            Supported values are 'json', 'csv', 'parquet' and 'arrow'.
         order_by_comid (bool, optional): Whether to order the results by comids.
             Defaults to False. The records will be in the order of input comids
             If True, the results will be ordered by comids in ascending order.
+        dry_run (bool, optional): If True, the query is validated but not run
+            and the number of bytes it would scan is returned instead.
+            Only supported by the BigQuery backend.
+            Defaults to False.
 
     Returns:
 
@@ -458,111 +966,99 @@ def flood_return_periods(
     """
 
     # Extract comids from either the comid or hydroshare_id input
-    comids = extract_comid_input(comids, hydroshare_id)
-
-    # Customize extracted fields based on return_periods chosen
-    selected_fields = "feature_id"
-    tabs = "\t    "
-    if return_periods == None:
-      # Extract all six return periods data by default
-      selected_fields = (selected_fields +
-                        (f",\n{tabs}return_period_2,\n{tabs}return_period_5," +
-                        f"\n{tabs}return_period_10,\n{tabs}return_period_25," +
-                        f"\n{tabs}return_period_50, \n{tabs}return_period_100"))
-    else:
-      # Extract only the listed return periods data
-      requested_return_periods = return_periods.split(",")
-      for return_period in requested_return_periods:
-          selected_fields = selected_fields + f",\n{tabs}return_period_{return_period}"
-
-    # Assemble the main body of the flood return-period data query
-    query = f"""
-            SELECT
-                {selected_fields}
-            FROM
-                `bigquery-public-data.national_water_model.flood_return_periods`
-            WHERE
-                feature_id IN ({", ".join(map(str, comids))})
-        """
-
-    if order_by_comid:
-      #  Add the sorting statement if order_by_comid is True
-      query += "    ORDER BY feature_id"
-
-
-    # Make API request to BigQuery and retrieve data
-    results = run_query(query)
-
-     # Create a list of JSON objects with the selected columns
-    response_data = []
-    for row in results:
-        # Convert the BigQuery Row object to a dictionary
-        json_obj = dict(row.items())
-        response_data.append(json_obj)
-
-    response = format_response(response_data, output_format)
+    comids = await extract_comid_input(comids, hydroshare_id, upstream_of, downstream_of)
+
+    # Split the requested return periods by comma
+    return_periods = return_periods.split(",") if return_periods else None
+
+    # Only the known return periods can be written as column names
+    if return_periods and not set(return_periods) <= set(map(str, RETURN_PERIODS)):
+        raise HTTPException(status_code=400, detail=f"Invalid return_periods. Supported values are {list(RETURN_PERIODS)}.")
+
+    if dry_run:
+        return await estimate_query('return_periods', comids, return_periods, order_by_comid)
+
+    # Read the records from the local snapshot or the cached backend results
+    results = await read_return_periods(comids, return_periods, order_by_comid)
+
+    response = await format_response(results, output_format)
 
     return response
 
-def run_query(query):
-    # Set up BigQuery client
-    client = bigquery.Client()
-    job_config = bigquery.QueryJobConfig(use_query_cache=True)
+async def estimate_query(method: str, *args):
 
-    # Make API request to BigQuery and retrieve data
-    query_job = client.query(query, job_config=job_config)
-    results = query_job.result()
+    # Report the cost of the query instead of running it
+    try:
+        estimate = await limits.run(get_backend().dry_run, method, *args)
 
-    return results
+    except NotImplementedError:
+        raise HTTPException(status_code=400, detail="Dry runs are only supported by the bigquery backend.")
 
+    return dict(query=method, **estimate)
 
-def extract_comid_input(comids: str | None, hydroshare_id: str | None):
+async def resolve_reference_time(forecast_type: str, reference_time: str | None):
 
-    # If hydroshare_id is provided, use it to retrieve comids
-    if hydroshare_id:
-        hydroshare_url = f"https://www.hydroshare.org/resource/{hydroshare_id}/data/contents/nwm_comids.json"
+    with stage('reference_time'):
+        # Default reference_time to the latest available if not specified
+        if reference_time is None:
+            # Use the cached latest reference_time; when the cache is cold the
+            # forecast query selects the latest cycle itself instead of waiting
+            # on a separate lookup
+            return latest_reference_times.peek(forecast_type)
+
+        # Convert the input reference_time string to a datetime object
         try:
-            hydroshare_response = requests.get(hydroshare_url)
-            hydroshare_data = hydroshare_response.json()
-            # Extract comids from the HydroShare data
-            comids = [item.get('comid') for item in hydroshare_data]
+            return parser.parse(reference_time)
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error retrieving HydroShare data: {str(e)}")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Error parsing reference_time: {str(e)}")
 
-    elif comids:
-        # If comids is provided, split by comma
-        comids = list(map(int, comids.split(','))) if comids else None
+async def extract_comid_input(
+    comids: str | None,
+    hydroshare_id: str | None,
+    upstream_of: int | None = None,
+    downstream_of: int | None = None,
+):
 
-    else:
-        raise HTTPException(status_code=400, detail="No valid comids found. Please provide valid comids or a valid HydroShare resource ID.")
+    with stage('comid_resolution'):
+        # If upstream_of or downstream_of is provided, expand the reaches from the network topology
+        if upstream_of is not None or downstream_of is not None:
+            if not settings.network_topology_path:
+                raise HTTPException(status_code=400, detail="Network queries are not enabled. Set NWM_API_NETWORK_TOPOLOGY_PATH.")
 
-    return comids
+            topology = network_topology.get()
+            if topology is None:
+                raise HTTPException(status_code=503, detail="The network topology is not available.")
 
-def format_response(response_data, output_format):
-    # Check the output format and return the corresponding response
-    if output_format.lower() == 'json':
-        # Return results as a JSON response
-        response = JSONResponse(content=response_data)
+            try:
+                comids = await limits.run(topology.reaches, upstream_of, downstream_of, settings.network_max_reaches)
+            except KeyError as e:
+                raise HTTPException(status_code=404, detail=e.args[0])
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
 
-    elif output_format.lower() == 'csv':
-        # Return results as a CSV response
-        csv_output = StringIO()
-        csv_writer = csv.DictWriter(csv_output, fieldnames=response_data[0].keys())
+        # If hydroshare_id is provided, use it to retrieve comids
+        elif hydroshare_id:
+            try:
+                # Extract comids from the cached HydroShare data
+                comids = await comid_resolver.get(hydroshare_id)
 
-        # Write header
-        csv_writer.writeheader()
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Error retrieving HydroShare data: {str(e)}")
 
-        # Write rows
-        csv_writer.writerows(response_data)
+        elif comids:
+            # If comids is provided, split by comma
+            comids = parse_integers(comids, 'comids')
 
-        response = StreamingResponse(
-            iter([csv_output.getvalue()]),
-            media_type="text/csv"
-        )
+        else:
+            raise HTTPException(status_code=400, detail="No valid comids found. Please provide valid comids or a valid HydroShare resource ID.")
 
-        csv_output.close()
-    else:
-        raise HTTPException(status_code=400, detail='Unsupported output format. Supported formats are JSON and CSV.')
+        return comids
 
-    return response
+def parse_integers(values: str, name: str) -> list:
+    # Split a comma separated list of IDs, rejecting the values that are not integers
+    try:
+        return [int(value) for value in values.split(',')]
+
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}. Provide comma separated integers.")
@@ -0,0 +1,266 @@
+# Import libraries required for recording the metrics
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from .config import settings
+
+# Upper bounds of the histogram buckets
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+ROW_BUCKETS = (1, 10, 100, 1e3, 1e4, 1e5, 1e6)
+
+# Type and description of the exported metrics
+METRICS = dict(
+    nwm_api_requests_total = ('counter', 'Requests processed, by endpoint and status code.'),
+    nwm_api_request_duration_seconds = ('histogram', 'Time to process a request, including streaming the response.'),
+    nwm_api_stage_duration_seconds = ('histogram', 'Time spent in each stage of a request.'),
+    nwm_api_response_bytes = ('histogram', 'Size of the response bodies.'),
+    nwm_api_response_rows = ('histogram', 'Number of result rows sent in a response.'),
+    nwm_api_queries_total = ('counter', 'Backend queries, by endpoint and BigQuery cache hit.'),
+    nwm_api_query_bytes_processed_total = ('counter', 'Bytes scanned by the BigQuery jobs.'),
+    nwm_api_query_bytes_billed_total = ('counter', 'Bytes billed for the BigQuery jobs.'),
+    nwm_api_query_slot_milliseconds_total = ('counter', 'Slot time consumed by the BigQuery jobs.'),
+    nwm_api_query_queue_seconds = ('histogram', 'Time BigQuery jobs waited before starting.'),
+)
+
+# Structured request logs, one JSON object per line as parsed by Cloud Logging
+logger = logging.getLogger('app.requests')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stdout)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+
+
+class MetricsRegistry:
+    """In-process counters and histograms exported in the Prometheus text format."""
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, labels: dict, value: float = 1):
+        """Add value to the counter name."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: dict, value: float, buckets: tuple):
+        """Add an observation to the histogram name."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = dict(buckets=buckets, counts=[0] * len(buckets), sum=0, count=0)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: dict(value, counts=list(value['counts'])) for key, value in self._histograms.items()}
+
+        lines = []
+        for name, (kind, description) in METRICS.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{_labels(labels)} {value:g}')
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric == name:
+                    for bound, count in zip(histogram['buckets'], histogram['counts']):
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", f"{bound:g}"),))} {count}')
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {histogram["count"]}')
+                    lines.append(f'{name}_sum{_labels(labels)} {histogram["sum"]:g}')
+                    lines.append(f'{name}_count{_labels(labels)} {histogram["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ''
+    values = ','.join(
+        f'{key}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for key, value in labels
+    )
+    return '{' + values + '}'
+
+
+class RequestMetrics:
+    """Measurements of a single request.
+
+    Stage timings are summed over the request, so the 'query' stage of a
+    request running several queries concurrently can exceed its duration.
+
+    Args:
+
+        method (str): The HTTP method of the request.
+        path (str): The path of the request.
+        scope (dict, optional): The ASGI scope of the request, holding the
+            matched route once it has been routed.
+    """
+
+    def __init__(self, method: str, path: str, scope: dict | None = None):
+        self.method = method
+        self.path = path
+        self.scope = scope if scope is not None else {}
+        self.started_at = time.perf_counter()
+        self.stages = {}
+        self.queries = []
+        self.rows = 0
+        self.response_bytes = 0
+        self.status = None
+
+    def add(self, stage: str, seconds: float):
+        """Add the time spent in a stage."""
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def timed(self, iterable, stage: str, nested: str | None = None, count_rows: bool = False):
+        """Iterate over iterable, adding the time spent producing each item to stage.
+
+        The time spent in the nested stage while producing an item is not
+        counted twice. With count_rows, the rows of the record batches read
+        are added to the row count.
+        """
+        iterator = iter(iterable)
+        while True:
+            start, nested_before = time.perf_counter(), self.stages.get(nested, 0)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                nested_seconds = self.stages.get(nested, 0) - nested_before
+                self.add(stage, time.perf_counter() - start - nested_seconds)
+
+            if count_rows and item is not None:
+                self.rows += item.num_rows
+            yield item
+
+    def record_query(self, statistics: dict):
+        """Record the statistics of a completed BigQuery job."""
+        self.queries.append(statistics)
+
+        labels = dict(endpoint=self.endpoint, cache_hit=str(bool(statistics.get('cache_hit'))).lower())
+        metrics.inc('nwm_api_queries_total', labels)
+
+        labels = dict(endpoint=self.endpoint)
+        metrics.inc('nwm_api_query_bytes_processed_total', labels, statistics.get('total_bytes_processed') or 0)
+        metrics.inc('nwm_api_query_bytes_billed_total', labels, statistics.get('total_bytes_billed') or 0)
+        metrics.inc('nwm_api_query_slot_milliseconds_total', labels, statistics.get('slot_millis') or 0)
+        if statistics.get('queue_seconds') is not None:
+            metrics.observe('nwm_api_query_queue_seconds', labels, statistics['queue_seconds'], DURATION_BUCKETS)
+
+    @property
+    def endpoint(self) -> str:
+        # The route template bounds the number of series, e.g. /export/{export_id}
+        # for every export, and the paths matching no route share one label
+        route = self.scope.get('route')
+        return getattr(route, 'path', None) or 'other'
+
+    def finish(self):
+        """Record the metrics of the completed request and log it."""
+        duration = time.perf_counter() - self.started_at
+        labels = dict(endpoint=self.endpoint)
+
+        metrics.inc('nwm_api_requests_total', dict(labels, status=str(self.status)))
+        metrics.observe('nwm_api_request_duration_seconds', labels, duration, DURATION_BUCKETS)
+        metrics.observe('nwm_api_response_bytes', labels, self.response_bytes, SIZE_BUCKETS)
+        if self.rows:
+            metrics.observe('nwm_api_response_rows', labels, self.rows, ROW_BUCKETS)
+        for stage, seconds in self.stages.items():
+            metrics.observe('nwm_api_stage_duration_seconds', dict(labels, stage=stage), seconds, DURATION_BUCKETS)
+
+        # Log slow requests as warnings so they can be alerted on
+        slow = duration >= settings.slow_request_seconds
+        logger.info(json.dumps(dict(
+            severity='WARNING' if slow else 'INFO',
+            message=f'{self.method} {self.path} {self.status} {duration:.3f}s',
+            endpoint=self.endpoint,
+            status=self.status,
+            duration_seconds=round(duration, 6),
+            stages={stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+            rows=self.rows,
+            response_bytes=self.response_bytes,
+            queries=self.queries,
+        ), default=str))
+
+
+# The measurements of the request being processed
+_current_request = ContextVar('current_request', default=None)
+
+
+def current_request() -> RequestMetrics | None:
+    """Return the measurements of the request being processed, if any.
+
+    The request is tracked with a context variable, so it must be looked up
+    on the event loop and handed over explicitly to worker threads.
+    """
+    return _current_request.get()
+
+
+@contextmanager
+def stage(name: str):
+    """Add the time spent in the block to a stage of the current request."""
+    request = current_request()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if request is not None:
+            request.add(name, time.perf_counter() - start)
+
+
+class MetricsMiddleware:
+    """ASGI middleware measuring every HTTP request.
+
+    The request is measured until its response, streamed or not, has been
+    sent completely.
+
+    Args:
+
+        app (ASGIApp): The wrapped application.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        request = RequestMetrics(scope['method'], scope['path'], scope)
+        token = _current_request.set(request)
+
+        async def measured_send(message):
+            if message['type'] == 'http.response.start':
+                request.status = message['status']
+            elif message['type'] == 'http.response.body':
+                request.response_bytes += len(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, measured_send)
+        except Exception:
+            request.status = request.status or 500
+            raise
+        finally:
+            _current_request.reset(token)
+            request.finish()
+
+
+# Create the registry shared by the application
+metrics = MetricsRegistry()
@@ -0,0 +1,447 @@
+# Import libraries required for building the queries
+import re
+from datetime import datetime, timedelta, timezone
+from dateutil import parser
+
+# Import libraries associated with BIGQUERY
+from google.cloud import bigquery
+
+# Strings corresponding to BIGQUERY table names for different forecast options
+FORECAST_OPTS = dict(
+    long_range = 'bigquery-public-data.national_water_model.long_range_channel_rt',
+    medium_range = 'bigquery-public-data.national_water_model.medium_range_channel_rt',
+    short_range = 'bigquery-public-data.national_water_model.short_range_channel_rt',
+)
+
+ANALYSIS_ASSIM_TABLE = 'bigquery-public-data.national_water_model.analysis_assim_channel_rt'
+STREAM_NETWORK_TABLE = 'bigquery-public-data.national_water_model.stream_network'
+RETURN_PERIODS_TABLE = 'bigquery-public-data.national_water_model.flood_return_periods'
+
+# Return periods, in years, available in the flood_return_periods table
+RETURN_PERIODS = (2, 5, 10, 25, 50, 100)
+
+# Intervals the analysis-assimilation records can be aggregated over, with
+# their BigQuery TIMESTAMP_TRUNC part
+AGGREGATE_INTERVALS = dict(
+    hourly = 'HOUR',
+    daily = 'DAY',
+    monthly = 'MONTH',
+)
+
+# Aggregation statistics besides the percentiles, written p1 to p99
+STATISTICS = ('mean', 'min', 'max')
+
+
+class Query:
+    """Parameterized BigQuery query.
+
+    The values of a request are passed as typed query parameters rather than
+    written in the SQL, so equivalent requests send the same query text and
+    parameters and can be answered from the BigQuery query cache.
+
+    Args:
+
+        sql (str): The query, referring to its parameters as @name.
+        parameters (list): The ScalarQueryParameter and ArrayQueryParameter
+            values of the query.
+    """
+
+    def __init__(self, sql: str, parameters: list):
+        self.sql = sql
+        self.parameters = parameters
+
+
+def _ids(values) -> list:
+    # Deduplicate and sort the ids so their order does not change the query
+    return sorted({int(value) for value in values})
+
+
+def _timestamp(value) -> datetime:
+    # Accept both datetime objects and strings, time zone naive values being in UTC
+    if not isinstance(value, datetime):
+        value = parser.parse(str(value))
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def parse_statistics(statistics: list | None, supported: tuple = STATISTICS) -> list:
+    """Validate the aggregation statistics, defaulting to the mean.
+
+    Statistic names are written in the queries as column names, so they are
+    checked against supported and the p1 to p99 percentiles.
+    """
+    statistics = list(dict.fromkeys(statistics)) if statistics else ['mean']
+    invalid = [
+        statistic for statistic in statistics
+        if statistic not in supported and not re.fullmatch(r'p[1-9][0-9]?', statistic)
+    ]
+    if invalid:
+        raise ValueError(f"Invalid statistics {invalid}. Supported values are {list(supported)} and p1 to p99.")
+
+    return statistics
+
+
+def _statistic_sql(statistic: str, column: str) -> str:
+    # BigQuery only approximates percentiles in aggregations, from 100 quantiles
+    if statistic.startswith('p'):
+        return f"APPROX_QUANTILES({column}, 100)[OFFSET({int(statistic[1:])})]"
+    return dict(mean='AVG', min='MIN', max='MAX')[statistic] + f"({column})"
+
+
+def _latest_window_start() -> datetime:
+    # Start of the previous day in UTC, fixed for the whole day so the query
+    # text and parameters stay the same and the query cache can be used
+    today = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=1)
+
+
+def _latest_reference_time_sql(table_name) -> str:
+    # Filter on the partitioning column itself so only the recent partitions are read
+    return f"""
+        SELECT
+            MAX(reference_time) AS latest_reference_time
+        FROM
+            `{table_name}`
+        WHERE
+            reference_time >= @since
+            AND feature_id = 101
+            AND ensemble = 0
+    """
+
+
+def latest_reference_time(forecast_type: str) -> Query:
+    """Build the query of the most recent reference time of a forecast run."""
+    return Query(
+        _latest_reference_time_sql(FORECAST_OPTS[forecast_type]),
+        [bigquery.ScalarQueryParameter('since', 'TIMESTAMP', _latest_window_start())],
+    )
+
+
+def forecast(forecast_type: str, reference_time, comids: list, ensembles: list | None) -> Query:
+    """Build the query of the forecast of the given cycle, reaches and ensembles.
+
+    If reference_time is None the latest cycle is selected within the same
+    query. If ensembles is None the members are averaged and reported with
+    an ensemble value of 'average'.
+    """
+    table_name = FORECAST_OPTS[forecast_type]
+    parameters = [bigquery.ArrayQueryParameter('comids', 'INT64', _ids(comids))]
+
+    if reference_time is None:
+        # Select the latest cycle, bounding the scan to the recent partitions
+        reference_time_sql = f"""reference_time >= @since
+                AND reference_time = ({_latest_reference_time_sql(table_name)})"""
+        parameters.append(bigquery.ScalarQueryParameter('since', 'TIMESTAMP', _latest_window_start()))
+    else:
+        reference_time_sql = "reference_time = @reference_time"
+        parameters.append(bigquery.ScalarQueryParameter('reference_time', 'TIMESTAMP', _timestamp(reference_time)))
+
+    if not ensembles:
+        # Average the members of each time step and report them as "average"
+        sql = f"""
+            SELECT
+                feature_id,
+                reference_time,
+                time,
+                'average' AS ensemble,
+                AVG(streamflow) AS streamflow,
+                AVG(velocity) AS velocity
+            FROM
+                `{table_name}`
+            WHERE
+                {reference_time_sql}
+                AND feature_id IN UNNEST(@comids)
+            GROUP BY
+                feature_id, reference_time, time
+            ORDER BY
+                time, feature_id
+        """
+    else:
+        sql = f"""
+            SELECT
+                feature_id,
+                reference_time,
+                time,
+                ensemble,
+                streamflow,
+                velocity
+            FROM
+                `{table_name}`
+            WHERE
+                {reference_time_sql}
+                AND feature_id IN UNNEST(@comids)
+                AND ensemble IN UNNEST(@ensembles)
+            ORDER BY
+                time, feature_id, ensemble
+        """
+        parameters.append(bigquery.ArrayQueryParameter('ensembles', 'INT64', _ids(ensembles)))
+
+    return Query(sql, parameters)
+
+
+def forecast_cycles(forecast_type: str, start_time, end_time, reference_times: list | None, comids: list, ensembles: list | None) -> Query:
+    """Build the query of the forecasts of every cycle between start_time and end_time.
+
+    If reference_times is given only these cycles are selected, start_time and
+    end_time then being their earliest and latest, so the scan is still
+    limited to their partitions. The records are ordered by cycle, reach,
+    ensemble and lead time, the lead time being the number of hours since the
+    reference time. If ensembles is None the members are averaged and
+    reported with an ensemble value of 'average'.
+    """
+    table_name = FORECAST_OPTS[forecast_type]
+    parameters = [
+        bigquery.ScalarQueryParameter('start_time', 'TIMESTAMP', _timestamp(start_time)),
+        bigquery.ScalarQueryParameter('end_time', 'TIMESTAMP', _timestamp(end_time)),
+        bigquery.ArrayQueryParameter('comids', 'INT64', _ids(comids)),
+    ]
+
+    # Bound the scan to the partitions of the window, then select the cycles of the list
+    reference_time_sql = "reference_time >= @start_time\n                AND reference_time <= @end_time"
+    if reference_times:
+        reference_time_sql += "\n                AND reference_time IN UNNEST(@reference_times)"
+        parameters.append(bigquery.ArrayQueryParameter(
+            'reference_times', 'TIMESTAMP', sorted({_timestamp(value) for value in reference_times})
+        ))
+
+    if not ensembles:
+        # Average the members of each time step and report them as "average"
+        sql = f"""
+            SELECT
+                feature_id,
+                reference_time,
+                TIMESTAMP_DIFF(time, reference_time, HOUR) AS lead_time,
+                time,
+                'average' AS ensemble,
+                AVG(streamflow) AS streamflow,
+                AVG(velocity) AS velocity
+            FROM
+                `{table_name}`
+            WHERE
+                {reference_time_sql}
+                AND feature_id IN UNNEST(@comids)
+            GROUP BY
+                feature_id, reference_time, time
+            ORDER BY
+                reference_time, feature_id, lead_time
+        """
+    else:
+        sql = f"""
+            SELECT
+                feature_id,
+                reference_time,
+                TIMESTAMP_DIFF(time, reference_time, HOUR) AS lead_time,
+                time,
+                ensemble,
+                streamflow,
+                velocity
+            FROM
+                `{table_name}`
+            WHERE
+                {reference_time_sql}
+                AND feature_id IN UNNEST(@comids)
+                AND ensemble IN UNNEST(@ensembles)
+            ORDER BY
+                reference_time, feature_id, ensemble, lead_time
+        """
+        parameters.append(bigquery.ArrayQueryParameter('ensembles', 'INT64', _ids(ensembles)))
+
+    return Query(sql, parameters)
+
+
+def ensemble_members(forecast_type: str, reference_time, comids: list | None = None) -> Query:
+    """Build the query of the members of a forecast cycle, one row per reach and time.
+
+    The streamflow and velocity of the members are gathered in lists ordered
+    by ensemble. If comids is None every reach of the cycle is returned.
+    """
+    parameters = [bigquery.ScalarQueryParameter('reference_time', 'TIMESTAMP', _timestamp(reference_time))]
+
+    comids_sql = ""
+    if comids is not None:
+        comids_sql = "AND feature_id IN UNNEST(@comids)"
+        parameters.append(bigquery.ArrayQueryParameter('comids', 'INT64', _ids(comids)))
+
+    sql = f"""
+        SELECT
+            feature_id,
+            reference_time,
+            time,
+            ARRAY_AGG(streamflow IGNORE NULLS ORDER BY ensemble) AS streamflow,
+            ARRAY_AGG(velocity IGNORE NULLS ORDER BY ensemble) AS velocity
+        FROM
+            `{FORECAST_OPTS[forecast_type]}`
+        WHERE
+            reference_time = @reference_time
+            {comids_sql}
+        GROUP BY
+            feature_id, reference_time, time
+    """
+
+    return Query(sql, parameters)
+
+
+def analysis_assim(
+    comids: list, run_offset: int, start_time, end_time, aggregate: str | None = None, statistics: list | None = None
+) -> Query:
+    """Build the query of the analysis-assimilation records between start_time and end_time.
+
+    If aggregate is one of AGGREGATE_INTERVALS, the records of every reach are
+    grouped by interval and each statistic of the streamflow and velocity is
+    returned as a streamflow_<statistic> and velocity_<statistic> column,
+    along with the number of records of the interval.
+    """
+    if aggregate is None:
+        sql = f"""
+            SELECT
+                feature_id,
+                time,
+                streamflow,
+                velocity
+            FROM
+                `{ANALYSIS_ASSIM_TABLE}`
+            WHERE
+                time >= @start_time
+                AND time <= @end_time
+                AND feature_id IN UNNEST(@comids)
+                AND forecast_offset = @run_offset
+            ORDER BY
+                time, feature_id
+        """
+    else:
+        # Group the records of every reach by interval, the statistic names
+        # being validated before they are written as column names
+        fields = ["feature_id", f"TIMESTAMP_TRUNC(time, {AGGREGATE_INTERVALS[aggregate]}) AS time"]
+        for statistic in parse_statistics(statistics):
+            fields += [f"{_statistic_sql(statistic, column)} AS {column}_{statistic}" for column in ("streamflow", "velocity")]
+        selected_fields = ",\n                ".join(fields + ["COUNT(*) AS count"])
+
+        sql = f"""
+            SELECT
+                {selected_fields}
+            FROM
+                `{ANALYSIS_ASSIM_TABLE}`
+            WHERE
+                time >= @start_time
+                AND time <= @end_time
+                AND feature_id IN UNNEST(@comids)
+                AND forecast_offset = @run_offset
+            GROUP BY
+                1, 2
+            ORDER BY
+                2, 1
+        """
+
+    return Query(sql, [
+        bigquery.ScalarQueryParameter('start_time', 'TIMESTAMP', _timestamp(start_time)),
+        bigquery.ScalarQueryParameter('end_time', 'TIMESTAMP', _timestamp(end_time)),
+        bigquery.ArrayQueryParameter('comids', 'INT64', _ids(comids)),
+        bigquery.ScalarQueryParameter('run_offset', 'INT64', int(run_offset)),
+    ])
+
+
+def stream_network(station_ids: list) -> Query:
+    """Build the query of the stream_network records of the given reaches."""
+    sql = f"""
+        SELECT
+            *
+        FROM
+            `{STREAM_NETWORK_TABLE}`
+        WHERE
+            station_id IN UNNEST(@station_ids)
+        ORDER BY
+            station_id
+    """
+
+    return Query(sql, [bigquery.ArrayQueryParameter('station_ids', 'INT64', _ids(station_ids))])
+
+
+def nearest_reach(lat: float, lon: float, k: int = 1, max_distance: float | None = None) -> Query:
+    """Build the query of the k stream_network records closest to a point."""
+    parameters = [
+        bigquery.ScalarQueryParameter('lat', 'FLOAT64', float(lat)),
+        bigquery.ScalarQueryParameter('lon', 'FLOAT64', float(lon)),
+        bigquery.ScalarQueryParameter('k', 'INT64', int(k)),
+    ]
+
+    # Only measure the distance to the reaches around the point when possible
+    where = ""
+    if max_distance is not None:
+        where = "WHERE ST_DWITHIN(streams.geometry, ST_GEOGPOINT(@lon, @lat), @max_distance)"
+        parameters.append(bigquery.ScalarQueryParameter('max_distance', 'FLOAT64', float(max_distance)))
+
+    sql = f"""
+        SELECT
+            streams.*,
+            ST_DISTANCE(streams.geometry, ST_GEOGPOINT(@lon, @lat)) AS distance
+        FROM
+            `{STREAM_NETWORK_TABLE}` AS streams
+        {where}
+        ORDER BY distance
+        LIMIT @k
+    """
+
+    return Query(sql, parameters)
+
+
+def static_table(name: str) -> Query:
+    """Build the query of every record of the stream_network or flood_return_periods table."""
+    table_name = dict(stream_network=STREAM_NETWORK_TABLE, flood_return_periods=RETURN_PERIODS_TABLE)[name]
+    return Query(f"SELECT * FROM `{table_name}`", [])
+
+
+def reach_geometries() -> Query:
+    """Build the query of the station_id and WKT geometry of every reach."""
+    sql = f"""
+        SELECT
+            station_id,
+            ST_ASTEXT(geometry) AS geometry
+        FROM
+            `{STREAM_NETWORK_TABLE}`
+    """
+
+    return Query(sql, [])
+
+
+def reach_topology() -> Query:
+    """Build the query of the station_id and downstream station_id of every reach."""
+    sql = f"""
+        SELECT
+            station_id,
+            `to`
+        FROM
+            `{STREAM_NETWORK_TABLE}`
+    """
+
+    return Query(sql, [])
+
+
+def return_periods(comids: list, return_periods: list | None, order_by_comid: bool) -> Query:
+    """Build the query of the flood return-period records of the given reaches.
+
+    Column names cannot be passed as parameters, so the return periods are
+    checked against RETURN_PERIODS before they are written in the query.
+    """
+    # Extract all six return periods data by default
+    return_periods = list(dict.fromkeys(int(rp) for rp in return_periods)) if return_periods else RETURN_PERIODS
+    invalid = [rp for rp in return_periods if rp not in RETURN_PERIODS]
+    if invalid:
+        raise ValueError(f"Invalid return periods {invalid}. Supported values are {list(RETURN_PERIODS)}.")
+
+    selected_fields = ",\n            ".join(["feature_id"] + [f"return_period_{rp}" for rp in return_periods])
+
+    sql = f"""
+        SELECT
+            {selected_fields}
+        FROM
+            `{RETURN_PERIODS_TABLE}`
+        WHERE
+            feature_id IN UNNEST(@comids)
+    """
+
+    if order_by_comid:
+        #  Add the sorting statement if order_by_comid is True
+        sql += "    ORDER BY feature_id\n"
+
+    return Query(sql, [bigquery.ArrayQueryParameter('comids', 'INT64', _ids(comids))])
@@ -0,0 +1,121 @@
+# Import libraries required for data processing
+import threading
+from datetime import datetime, timedelta, timezone
+
+from .backends import FORECAST_OPTS, get_backend
+from .config import settings
+
+# Interval between two consecutive cycles of each forecast run
+FORECAST_CADENCE = dict(
+    long_range = timedelta(hours=6),
+    medium_range = timedelta(hours=6),
+    short_range = timedelta(hours=1),
+)
+
+
+class LatestReferenceTimeCache:
+    """In-process cache of the latest reference time of each forecast run.
+
+    A cached reference time cannot be outdated before the next cycle is due,
+    i.e. until reference_time + cadence. From then on the backend is polled
+    every poll_interval until the next cycle shows up. A background thread
+    performs these refreshes so requests only wait on the lookup when the
+    cache is cold.
+
+    Args:
+
+        poll_interval (timedelta): Delay between two lookups once the next
+            cycle of a forecast run is due.
+    """
+
+    def __init__(self, poll_interval: timedelta):
+        self.poll_interval = poll_interval
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self, forecast_type: str):
+        """Return the latest reference time of forecast_type.
+
+        The cached value is returned even when it is due for a refresh; the
+        background thread takes care of updating it.
+        """
+        with self._lock:
+            entry = self._entries.get(forecast_type)
+
+        if entry is None:
+            return self.refresh(forecast_type)
+
+        return entry[0]
+
+    def peek(self, forecast_type: str):
+        """Return the cached latest reference time of forecast_type, or None
+        when the cache is cold, without querying the backend."""
+        with self._lock:
+            entry = self._entries.get(forecast_type)
+
+        return entry[0] if entry is not None else None
+
+    def refresh(self, forecast_type: str):
+        """Look up the latest reference time of forecast_type in the backend."""
+        reference_time = get_backend().latest_reference_time(forecast_type)
+
+        # Keep the previous value if the lookup window came back empty
+        with self._lock:
+            if reference_time is None and forecast_type in self._entries:
+                reference_time = self._entries[forecast_type][0]
+            self._entries[forecast_type] = (reference_time, self._expires_at(forecast_type, reference_time))
+
+        return reference_time
+
+    def _expires_at(self, forecast_type, reference_time):
+        now = datetime.now(timezone.utc)
+        if reference_time is None:
+            return now + self.poll_interval
+
+        # Reference times without a time zone are in UTC
+        if reference_time.tzinfo is None:
+            reference_time = reference_time.replace(tzinfo=timezone.utc)
+
+        return max(reference_time + FORECAST_CADENCE[forecast_type], now + self.poll_interval)
+
+    def start(self):
+        """Start the background thread keeping every forecast run up to date."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='reference-time-refresh', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            now = datetime.now(timezone.utc)
+            for forecast_type in FORECAST_OPTS:
+                with self._lock:
+                    entry = self._entries.get(forecast_type)
+
+                # Refresh the missing and expired entries
+                if entry is None or entry[1] <= now:
+                    try:
+                        self.refresh(forecast_type)
+                    except Exception:
+                        # Keep serving the cached value and retry at the next poll
+                        if entry is not None:
+                            with self._lock:
+                                self._entries[forecast_type] = (entry[0], now + self.poll_interval)
+
+            # Sleep until the next entry expires, checking at least every poll_interval
+            with self._lock:
+                expirations = [entry[1] for entry in self._entries.values()]
+            wait = min(expirations + [now + self.poll_interval]) - datetime.now(timezone.utc)
+            self._stop.wait(max(wait.total_seconds(), 1))
+
+
+# Create the cache shared by the application
+latest_reference_times = LatestReferenceTimeCache(timedelta(seconds=settings.reference_time_poll_seconds))
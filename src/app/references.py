@@ -0,0 +1,530 @@
+# Import libraries required for data processing
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dateutil import parser as date_parser
+
+import fsspec
+import numcodecs
+import numpy as np
+
+# Version of the reference index files, increased when their content changes
+INDEX_VERSION = 1
+
+# Variables of the NetCDF files kept in the reference indexes
+VARIABLES = ('feature_id', 'time', 'streamflow', 'velocity')
+
+# Length in seconds of the units of the CF time coordinates
+_TIME_UNITS = dict(seconds=1, minutes=60, hours=3600, days=86400)
+
+
+class ChunkCache:
+    """Size-bounded LRU cache of NetCDF chunks on the local disk.
+
+    Chunks are stored compressed, as read from the NetCDF files, under the
+    digest of their file and byte range, so the indexes of different cycles
+    share the chunks of the files they have in common. The least recently
+    used chunks are evicted first.
+
+    Args:
+
+        directory (str, optional): The directory of the cache. Defaults to
+            None, which disables the cache.
+        max_bytes (int): Size limit of the cache.
+    """
+
+    def __init__(self, directory: str | None, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._counters = dict(hits=0, misses=0, evictions=0)
+
+        if directory:
+            # Resume from the chunks of the previous runs, oldest first
+            os.makedirs(directory, exist_ok=True)
+            files = [entry for entry in os.scandir(directory) if entry.name.endswith('.chunk')]
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+                self._entries[entry.name] = entry.stat().st_size
+                self._nbytes += entry.stat().st_size
+
+    @staticmethod
+    def _name(reference):
+        return hashlib.sha256(json.dumps(reference).encode()).hexdigest() + '.chunk'
+
+    def get(self, reference: list) -> bytes | None:
+        """Return the cached bytes of a [url, offset, length] reference, or None."""
+        if not self.directory:
+            return None
+
+        name = self._name(reference)
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self._counters['misses'] += 1
+            return None
+
+        with self._lock:
+            self._counters['hits'] += 1
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        return data
+
+    def put(self, reference: list, data: bytes):
+        """Cache the bytes of a reference, evicting the least recently used chunks."""
+        if not self.directory:
+            return
+
+        name = self._name(reference)
+        path = os.path.join(self.directory, name)
+        temporary_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+
+        with self._lock:
+            self._nbytes += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            evicted = []
+            while self._nbytes > self.max_bytes and len(self._entries) > 1:
+                old_name, size = self._entries.popitem(last=False)
+                self._nbytes -= size
+                self._counters['evictions'] += 1
+                evicted.append(old_name)
+
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old_name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        """Return whether the cache is enabled, its counters and its size."""
+        with self._lock:
+            return dict(enabled=bool(self.directory), **self._counters, chunks=len(self._entries), bytes=self._nbytes)
+
+
+class ChunkReader:
+    """Read the byte ranges referenced by kerchunk indexes.
+
+    Ranges missing from the chunk cache are fetched from the NetCDF files
+    together, with one concurrent cat_ranges call per filesystem.
+
+    Args:
+
+        storage_options (dict): The options of the fsspec filesystem of the
+            NetCDF files.
+        cache (ChunkCache): The local cache of the chunks.
+    """
+
+    def __init__(self, storage_options: dict, cache: ChunkCache):
+        self.storage_options = storage_options
+        self.cache = cache
+        self._filesystems = {}
+        self._lock = threading.Lock()
+        self._fetched_bytes = 0
+
+    def filesystem(self, url: str):
+        """Return the shared fsspec filesystem of a URL."""
+        protocol = fsspec.utils.get_protocol(url)
+        with self._lock:
+            if protocol not in self._filesystems:
+                self._filesystems[protocol] = fsspec.filesystem(protocol, **self.storage_options)
+            return self._filesystems[protocol]
+
+    def read(self, references: list) -> list:
+        """Return the bytes of every reference, inline data or [url, offset, length]."""
+        data = [None] * len(references)
+        missing = {}
+        for position, reference in enumerate(references):
+            if isinstance(reference, (str, bytes)):
+                data[position] = _inline_bytes(reference)
+            else:
+                data[position] = self.cache.get(reference)
+                if data[position] is None:
+                    missing.setdefault(fsspec.utils.get_protocol(reference[0]), []).append(position)
+
+        for protocol, positions in missing.items():
+            urls = [references[position][0] for position in positions]
+            starts = [references[position][1] if len(references[position]) > 1 else None for position in positions]
+            ends = [
+                references[position][1] + references[position][2] if len(references[position]) > 1 else None
+                for position in positions
+            ]
+            fetched = self.filesystem(urls[0]).cat_ranges(urls, starts, ends)
+            for position, chunk in zip(positions, fetched):
+                if isinstance(chunk, Exception):
+                    raise chunk
+                data[position] = chunk
+                self.cache.put(references[position], chunk)
+            with self._lock:
+                self._fetched_bytes += sum(map(len, fetched))
+
+        return data
+
+    def stats(self) -> dict:
+        """Return the chunk cache counters and the number of bytes fetched from the files."""
+        return dict(self.cache.stats(), fetched_bytes=self._fetched_bytes)
+
+
+def _inline_bytes(value):
+    # Decode the data embedded in the index, as written by kerchunk
+    if isinstance(value, bytes):
+        return value
+    if value.startswith('base64:'):
+        return base64.b64decode(value[len('base64:'):])
+    return value.encode()
+
+
+def _keep_variables(references):
+    # Drop the variables of the NetCDF files that are never read
+    return {
+        key: value for key, value in references.items()
+        if '/' not in key or key.split('/')[0] in VARIABLES
+    }
+
+
+class ReferenceIndex:
+    """Kerchunk reference index of a set of NWM NetCDF files, combined along time.
+
+    The index maps every chunk of the streamflow and velocity variables to
+    its byte range in the NetCDF files, so the records of a few reaches are
+    read by fetching and decoding only the chunks holding them, without
+    opening the files.
+
+    Args:
+
+        references (dict): The kerchunk references, in the version 1 format.
+    """
+
+    def __init__(self, references: dict):
+        self.references = references
+        self.refs = references['refs']
+        self.attributes = json.loads(self.refs.get('.zattrs', '{}'))
+        self._feature_ids = None
+
+    @property
+    def files(self) -> list:
+        """Return the NetCDF files of the index."""
+        return self.attributes.get('files', [])
+
+    @classmethod
+    def build(cls, files: list, storage_options: dict | None = None, workers: int = 16, **attributes):
+        """Scan the NetCDF files and combine their references along time.
+
+        Args:
+
+            files (list): The URLs of the NetCDF files.
+            storage_options (dict, optional): The options of the fsspec
+                filesystem of the files.
+            workers (int): The number of files scanned at once.
+            attributes: Attributes stored with the index.
+        """
+        from kerchunk.combine import MultiZarrToZarr
+        from kerchunk.hdf import SingleHdf5ToZarr
+
+        storage_options = storage_options or {}
+
+        def scan(url):
+            # Keep every chunk as a byte range, the chunks being read lazily
+            with fsspec.open(url, 'rb', **storage_options) as f:
+                return SingleHdf5ToZarr(f, url, inline_threshold=0).translate()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            singles = list(pool.map(scan, files))
+
+        combined = MultiZarrToZarr(
+            singles,
+            remote_protocol=fsspec.utils.get_protocol(files[0]),
+            remote_options=storage_options,
+            concat_dims=['time'],
+            identical_dims=['feature_id'],
+            preprocess=_keep_variables,
+        ).translate()
+
+        combined['refs']['.zattrs'] = json.dumps(dict(version=INDEX_VERSION, files=list(files), **attributes))
+        return cls(combined)
+
+    @classmethod
+    def load(cls, path: str):
+        """Load an index written by save(), or return None if it is missing or outdated."""
+        try:
+            with open(path) as f:
+                index = cls(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return index if index.attributes.get('version') == INDEX_VERSION else None
+
+    def save(self, path: str):
+        """Write the index, replacing the previous one atomically."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'w') as f:
+            json.dump(self.references, f)
+        os.replace(temporary_path, path)
+
+    def _metadata(self, variable):
+        return json.loads(self.refs[f'{variable}/.zarray']), json.loads(self.refs.get(f'{variable}/.zattrs', '{}'))
+
+    def _decode(self, data, metadata):
+        # Undo the compressor then the filters, like zarr does for version 2 arrays
+        if metadata.get('compressor'):
+            data = numcodecs.get_codec(metadata['compressor']).decode(data)
+        for codec in reversed(metadata.get('filters') or []):
+            data = numcodecs.get_codec(codec).decode(data)
+        return np.frombuffer(data, dtype=np.dtype(metadata['dtype'])).reshape(metadata['chunks'], order=metadata.get('order', 'C'))
+
+    def _read_array(self, variable, reader, column_chunks=None) -> np.ndarray:
+        # Read the raw values of the given chunk columns of a 1 or 2 dimensional
+        # variable, the last chunk column being padded to the chunk size
+        metadata, _ = self._metadata(variable)
+        separator = metadata.get('dimension_separator') or '.'
+        if len(metadata['shape']) == 1:
+            # Read 1 dimensional variables as a single row
+            shape, chunks = [1, *metadata['shape']], [1, *metadata['chunks']]
+            key = lambda row, column: f'{variable}/{column}'
+        else:
+            shape, chunks = metadata['shape'], metadata['chunks']
+            key = lambda row, column: f'{variable}/{row}{separator}{column}'
+        if column_chunks is None:
+            column_chunks = range(-(-shape[1] // chunks[1]))
+        keys = [[key(row, column) for column in column_chunks] for row in range(-(-shape[0] // chunks[0]))]
+
+        # Chunks without a reference hold the fill value
+        present = [name for row in keys for name in row if name in self.refs]
+        data = dict(zip(present, reader.read([self.refs[name] for name in present])))
+        fill = metadata.get('fill_value')
+        dtype = np.dtype(metadata['dtype'])
+        values = np.block([
+            [
+                self._decode(data[name], metadata).reshape(chunks) if name in data
+                else np.full(chunks, 0 if fill is None else fill, dtype=dtype)
+                for name in row
+            ]
+            for row in keys
+        ])[:shape[0]]
+        return values[0, :shape[1]] if len(metadata['shape']) == 1 else values
+
+    def times(self, reader: ChunkReader) -> np.ndarray:
+        """Return the times of the index as datetime64[s] values."""
+        _, attributes = self._metadata('time')
+        match = re.match(r'\s*(\w+)\s+since\s+(.+)', attributes.get('units', ''))
+        if match is None or match.group(1) not in _TIME_UNITS:
+            raise ValueError(f"Unsupported time units {attributes.get('units')!r}.")
+        origin = date_parser.parse(match.group(2)).replace(tzinfo=None)
+        seconds = self._read_array('time', reader).astype(np.int64) * _TIME_UNITS[match.group(1)]
+        return np.datetime64(origin, 's') + seconds.astype('timedelta64[s]')
+
+    def read(self, variables: list, comids: list | None, reader: ChunkReader):
+        """Read the values of variables for the given reaches.
+
+        Only the chunks holding the requested reaches are read. The values
+        are unpacked with their scale factor and offset, and the fill values
+        are replaced by NaN.
+
+        Args:
+
+            variables (list): The names of the variables.
+            comids (list, optional): The reach IDs. Defaults to None, for
+                every reach of the files.
+            reader (ChunkReader): The reader of the chunks.
+
+        Returns:
+
+            tuple: The feature_id of the reaches found in the files, the times
+            and a dictionary of the (time, reach) arrays of the variables.
+        """
+        feature_ids = _feature_lookup(self, reader)
+        if comids is None:
+            positions = np.arange(len(feature_ids.ids))
+        else:
+            comids = np.unique(np.asarray(comids, dtype=np.int64))
+            found = np.searchsorted(feature_ids.sorted_ids, comids)
+            found = np.minimum(found, len(feature_ids.sorted_ids) - 1)
+            known = feature_ids.sorted_ids[found] == comids
+            positions = np.sort(feature_ids.order[found[known]])
+
+        times = self.times(reader)
+        values = {}
+        for variable in variables:
+            metadata, attributes = self._metadata(variable)
+            if not len(positions):
+                values[variable] = np.zeros((len(times), 0))
+                continue
+            column_chunks = np.unique(positions // metadata['chunks'][1])
+            raw = self._read_array(variable, reader, column_chunks)
+
+            # Map the positions of the reaches to the columns of the chunks read
+            offsets = np.searchsorted(column_chunks, positions // metadata['chunks'][1])
+            raw = raw[:, offsets * metadata['chunks'][1] + positions % metadata['chunks'][1]]
+
+            array = raw.astype(np.float64)
+            for name in ('_FillValue', 'missing_value'):
+                if attributes.get(name) is not None:
+                    array[raw == attributes[name]] = np.nan
+            if metadata.get('fill_value') is not None:
+                array[raw == metadata['fill_value']] = np.nan
+            values[variable] = array * attributes.get('scale_factor', 1) + attributes.get('add_offset', 0)
+
+        return feature_ids.ids[positions], times, values
+
+
+class _FeatureIds:
+    # Position of every reach in the NetCDF files, shared by the indexes of
+    # files with the same feature_id variable
+    def __init__(self, ids):
+        self.ids = ids.astype(np.int64)
+        self.order = np.argsort(self.ids, kind='stable')
+        self.sorted_ids = self.ids[self.order]
+
+
+# Lookups by digest of the feature_id data, and by the references of the
+# feature_id chunks of an index so their data is only hashed once
+_feature_ids = OrderedDict()
+_feature_id_references = OrderedDict()
+_feature_ids_lock = threading.Lock()
+
+
+def _feature_lookup(index, reader):
+    if index._feature_ids is not None:
+        return index._feature_ids
+
+    keys = sorted(key for key in index.refs if key.startswith('feature_id/') and not key.split('/')[1].startswith('.'))
+    references = json.dumps([index.refs[key] for key in keys])
+    with _feature_ids_lock:
+        lookup = _feature_id_references.get(references)
+        if lookup is not None:
+            _feature_id_references.move_to_end(references)
+    if lookup is None:
+        lookup = _build_feature_lookup(index, reader, [index.refs[key] for key in keys])
+        with _feature_ids_lock:
+            _feature_id_references[references] = lookup
+            while len(_feature_id_references) > 256:
+                _feature_id_references.popitem(last=False)
+
+    index._feature_ids = lookup
+    return lookup
+
+
+def _build_feature_lookup(index, reader, references):
+    # The feature_id chunks are identified by their content, as the files of
+    # different indexes differ while their reaches are the same
+    digest = hashlib.sha256(b''.join(reader.read(references))).hexdigest()
+    with _feature_ids_lock:
+        if digest in _feature_ids:
+            _feature_ids.move_to_end(digest)
+            return _feature_ids[digest]
+
+    lookup = _FeatureIds(index._read_array('feature_id', reader))
+    with _feature_ids_lock:
+        _feature_ids[digest] = lookup
+        while len(_feature_ids) > 4:
+            _feature_ids.popitem(last=False)
+    return lookup
+
+
+class ReferenceIndexes:
+    """Reference indexes of the NWM NetCDF files, built on first use and persisted.
+
+    An index covers a group of files, e.g. the lead times of a forecast
+    member or the cycles of a day of analysis. Indexes are kept in memory in
+    an LRU dictionary and, when a directory is given, saved as kerchunk JSON
+    files reloaded by the next instances. The files of a group that may
+    still change are listed again once the ttl of its index expires, and the
+    index is rebuilt when they differ. Indexes built once a group no longer
+    changes are used without listing its files.
+
+    Args:
+
+        directory (str, optional): The directory of the persisted indexes.
+            Defaults to None, which keeps the indexes in memory only.
+        reader (ChunkReader): The reader of the chunks of the files.
+        max_indexes (int): The number of indexes kept in memory.
+    """
+
+    def __init__(self, directory: str | None, reader: ChunkReader, max_indexes: int = 64):
+        self.directory = directory
+        self.reader = reader
+        self.max_indexes = max_indexes
+
+        self._entries = OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._counters = dict(hits=0, loads=0, builds=0)
+
+    def _path(self, name):
+        return os.path.join(self.directory, f'{name}.json')
+
+    def get(self, name: str, list_files, ttl: float | None) -> ReferenceIndex | None:
+        """Return the index of a group of files, or None if the group has no file.
+
+        Args:
+
+            name (str): The name of the group, a relative path.
+            list_files (callable): Returns the sorted URLs of the files of the group.
+            ttl (float, optional): Number of seconds the files of the group
+                are not listed again. None when the group no longer changes.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self._entries.move_to_end(name)
+                self._counters['hits'] += 1
+                return entry[0]
+            lock = self._locks.setdefault(name, threading.Lock())
+
+        # Build every index once for the concurrent requests
+        with lock:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None and (entry[1] is None or entry[1] > time.time()):
+                    return entry[0]
+
+            index = entry[0] if entry is not None else None
+            if index is None and self.directory:
+                index = ReferenceIndex.load(self._path(name))
+                if index is not None:
+                    with self._lock:
+                        self._counters['loads'] += 1
+
+            # Indexes built once the group stopped changing are complete
+            if index is None or not (ttl is None and index.attributes.get('complete')):
+                files = list_files()
+                if not files:
+                    return None
+                if index is None or index.files != files:
+                    index = ReferenceIndex.build(files, self.reader.storage_options, complete=ttl is None)
+                    with self._lock:
+                        self._counters['builds'] += 1
+                    if self.directory:
+                        index.save(self._path(name))
+                elif ttl is None and self.directory:
+                    # Mark the unchanged index as complete
+                    index.attributes['complete'] = True
+                    index.refs['.zattrs'] = json.dumps(index.attributes)
+                    index.save(self._path(name))
+
+            with self._lock:
+                self._entries[name] = (index, time.time() + ttl if ttl is not None else None)
+                self._entries.move_to_end(name)
+                while len(self._entries) > self.max_indexes:
+                    self._entries.popitem(last=False)
+                self._locks.pop(name, None)
+
+        return index
+
+    def stats(self) -> dict:
+        """Return the index counters and the chunk reader counters."""
+        with self._lock:
+            return dict(persisted=bool(self.directory), indexes=len(self._entries), **self._counters, chunks=self.reader.stats())
@@ -0,0 +1,240 @@
+# Import libraries required for data processing
+import csv
+import json
+from io import StringIO
+from itertools import chain, islice
+
+# Import libraries associated with FastAPI and ARROW
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from .concurrency import limits
+from .metrics import current_request
+
+# Number of rows gathered in each record batch when results only provide rows
+CHUNK_ROWS = 1000
+
+# Media types of the supported output formats
+MEDIA_TYPES = dict(
+    json = "application/json",
+    csv = "text/csv",
+    parquet = "application/vnd.apache.parquet",
+    arrow = "application/vnd.apache.arrow.stream",
+)
+
+
+def iter_record_batches(results):
+    """Read the backend results as Arrow record batches.
+
+    Results providing ``to_arrow_iterable()`` are read column-wise without
+    building any per-row object; other results are converted in chunks.
+
+    Args:
+
+        results (Iterable): The rows returned by the query backend.
+
+    Yields:
+
+        pyarrow.RecordBatch: The results, one batch at a time.
+    """
+    if hasattr(results, "to_arrow_iterable"):
+        yield from results.to_arrow_iterable()
+        return
+
+    rows = iter(results)
+    while True:
+        # Convert the BigQuery Row objects to dictionaries
+        chunk = [dict(row.items()) for row in islice(rows, CHUNK_ROWS)]
+        if not chunk:
+            return
+        yield pa.RecordBatch.from_pylist(chunk)
+
+
+def read_arrow_table(results):
+    """Read all the backend results into a single Arrow table.
+
+    Args:
+
+        results (Iterable): The rows returned by the query backend.
+
+    Returns:
+
+        pyarrow.Table: The results, or an empty table without columns when
+            there are no results.
+    """
+    batches = list(iter_record_batches(results))
+    return pa.Table.from_batches(batches) if batches else pa.table({})
+
+
+def format_datetimes(batch):
+    """Format every timestamp column of a record batch as strings.
+
+    Each column is converted at once with NumPy, so the cost does not depend
+    on a Python loop over the rows. Time zone aware timestamps are formatted
+    in UTC.
+
+    Args:
+
+        batch (pyarrow.RecordBatch): The batch of results.
+
+    Returns:
+
+        pyarrow.RecordBatch: The batch with timestamps formatted as
+            "%Y-%m-%dT%H:%M:%S" strings.
+    """
+    for index, field in enumerate(batch.schema):
+        if pa.types.is_timestamp(field.type):
+            # Format the whole column to the second, keeping the null values
+            column = batch.column(index)
+            values = column.to_numpy(zero_copy_only=False).astype("datetime64[s]")
+            formatted = pa.array(
+                np.datetime_as_string(values, unit="s"),
+                mask=column.is_null().to_numpy(zero_copy_only=False),
+            )
+            batch = batch.set_column(index, field.name, formatted)
+
+    return batch
+
+
+def _encode_json(batches):
+    # Write the batches as one JSON array, encoding each batch in a single call
+    separator = "["
+    for batch in batches:
+        if not batch.num_rows:
+            continue
+        encoded = json.dumps(
+            format_datetimes(batch).to_pylist(),
+            ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=str,
+        )
+        yield separator + encoded[1:-1]
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+def _encode_csv(batches, schema):
+    csv_output = StringIO()
+    csv_writer = csv.writer(csv_output, lineterminator="\r\n")
+
+    # Write header
+    csv_writer.writerow(schema.names)
+
+    # Write rows, transposing whole columns at once
+    for batch in batches:
+        columns = [column.to_pylist() for column in format_datetimes(batch).columns]
+        csv_writer.writerows(zip(*columns))
+        yield csv_output.getvalue()
+        csv_output.seek(0)
+        csv_output.truncate()
+
+    yield csv_output.getvalue()
+    csv_output.close()
+
+
+class _ChunkSink:
+    # Minimal writable file collecting the bytes written by the Arrow writers
+    # so they can be streamed as soon as each batch is encoded
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _encode_arrow(batches, schema, output_format):
+    sink = _ChunkSink()
+
+    # Write every record batch as a Parquet row group or an IPC stream message
+    if output_format == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+
+    for batch in batches:
+        if batch.num_rows:
+            writer.write_batch(batch)
+            yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
+
+
+async def format_response(results, output_format):
+    """Stream the query results in the requested output format.
+
+    The results are consumed lazily as Arrow record batches, so the first
+    chunk is sent before the last page of results is retrieved and the full
+    result is never held in memory. Batches are read and encoded in worker
+    threads, leaving the event loop free for other requests. Reading the
+    batches and encoding them are timed as the 'conversion' and
+    'serialization' stages of the current request. The 'parquet' and 'arrow' formats keep
+    the native column types; the 'json' and 'csv' formats convert the
+    timestamps to strings column by column.
+
+    Args:
+
+        results (Iterable): The rows returned by the query backend.
+        output_format (str): The output format of the response.
+            Supported values are 'json', 'csv', 'parquet' and 'arrow'
+            (Arrow IPC stream).
+
+    Returns:
+
+        StreamingResponse: The encoded results.
+    """
+    output_format = output_format.lower()
+    if output_format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail='Unsupported output format. Supported formats are JSON, CSV, Parquet and Arrow.')
+
+    # Retrieve the first batch before sending the headers so query errors
+    # are still reported with an error status
+    batches = iter_record_batches(results)
+    request = current_request()
+    if request is not None:
+        batches = request.timed(batches, 'conversion', count_rows=True)
+    first_batch = await limits.run(next, batches, None)
+    schema = first_batch.schema if first_batch is not None else pa.schema([])
+    batches = chain([first_batch], batches) if first_batch is not None else batches
+
+    # Check the output format and return the corresponding response
+    if output_format == 'json':
+        # Return results as a JSON response
+        content = _encode_json(batches)
+
+    elif output_format == 'csv':
+        # Return results as a CSV response
+        content = _encode_csv(batches, schema) if first_batch is not None else iter([""])
+
+    else:
+        # Return results as a Parquet file or an Arrow IPC stream
+        content = _encode_arrow(batches, schema, output_format)
+
+    if request is not None:
+        content = request.timed(content, 'serialization', nested='conversion')
+
+    headers = {}
+    if output_format in ('parquet', 'arrow'):
+        headers["Content-Disposition"] = f"attachment; filename=nwm.{output_format}"
+
+    return StreamingResponse(content, media_type=MEDIA_TYPES[output_format], headers=headers)
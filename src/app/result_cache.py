@@ -0,0 +1,276 @@
+# Import libraries required for data processing
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import pyarrow as pa
+
+from .concurrency import limits
+from .config import settings
+from .responses import read_arrow_table
+from .singleflight import single_flight
+
+
+class ArrowRows:
+    """Query result held in memory as an Arrow table.
+
+    It can be read any number of times, row by row or as record batches, like
+    the results of the query backends.
+
+    Args:
+
+        table (pyarrow.Table): The rows of the result.
+    """
+
+    def __init__(self, table: pa.Table):
+        self.table = table
+
+    def __iter__(self):
+        for batch in self.table.to_batches():
+            yield from batch.to_pylist()
+
+    def to_arrow_iterable(self):
+        """Yield the result as pyarrow RecordBatches."""
+        return iter(self.table.to_batches())
+
+
+class ResultCache:
+    """Two-tier LRU cache of query results.
+
+    Results are kept as Arrow tables in memory up to max_bytes and, when a
+    directory is given, as Arrow IPC files on disk up to disk_max_bytes. The
+    least recently used entries are evicted first; entries evicted from
+    memory remain available on disk.
+
+    Args:
+
+        max_bytes (int): Size limit of the memory tier.
+        directory (str, optional): Directory of the disk tier.
+            Defaults to None, which disables the disk tier.
+        disk_max_bytes (int): Size limit of the disk tier.
+    """
+
+    def __init__(self, max_bytes: int, directory: str | None = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._counters = dict(memory_hits=0, disk_hits=0, misses=0, evictions=0)
+
+        # Size of every file of the disk tier, least recently used first
+        self._files = OrderedDict()
+        self._disk_nbytes = 0
+
+        if directory:
+            # Resume from the files of the previous runs, oldest first
+            os.makedirs(directory, exist_ok=True)
+            files = []
+            for entry in os.scandir(directory):
+                if entry.name.endswith('.arrow'):
+                    try:
+                        files.append((entry.stat().st_mtime, entry.name, entry.stat().st_size))
+                    except FileNotFoundError:
+                        pass
+            for _, name, size in sorted(files):
+                self._files[name] = size
+                self._disk_nbytes += size
+
+    async def cached_table(self, key: tuple, fetch, ttl: float | None = None):
+        """Return the cached result of key, or fetch it once for all concurrent callers.
+
+        A missing result is read completely before it is returned, so
+        identical concurrent requests share a single query.
+
+        Args:
+
+            key (tuple): The normalized parameters of the query.
+            fetch (Callable): Blocking function submitting the query on a
+                cache miss.
+            ttl (float, optional): Number of seconds the result stays valid.
+                Defaults to None, for results that never change.
+
+        Returns:
+
+            ArrowRows: The query results.
+        """
+        table = await limits.run(self.get, key)
+        if table is None:
+            table = await single_flight.do(key, lambda: self._fetch_table(key, fetch, ttl))
+
+        return ArrowRows(table)
+
+    async def _fetch_table(self, key, fetch, ttl):
+        results = await limits.query(fetch)
+        table = await limits.run(read_arrow_table, results)
+
+        # Empty results are not cached, the data may not be published yet
+        if table.num_rows:
+            await limits.run(self.put, key, table, ttl)
+
+        return table
+
+    def get(self, key: tuple):
+        """Return the cached Arrow table of key, or None on a cache miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[2] is None or entry[2] > now):
+                self._entries.move_to_end(key)
+                self._counters['memory_hits'] += 1
+                return entry[0]
+
+            # Free an expired result instead of keeping it in the LRU
+            if entry is not None:
+                self._nbytes -= self._entries.pop(key)[1]
+
+        if entry is not None:
+            # A copy on disk is as outdated as the expired result
+            self._remove_disk(key)
+            table = None
+        else:
+            table = self._read_disk(key, now)
+
+        with self._lock:
+            if table is None:
+                self._counters['misses'] += 1
+            else:
+                self._counters['disk_hits'] += 1
+
+        if table is not None:
+            self._put_memory(key, table, None)
+
+        return table
+
+    def put(self, key: tuple, table: pa.Table, ttl: float | None = None):
+        """Cache the Arrow table of key for ttl seconds, or forever if ttl is None."""
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._put_memory(key, table, expires_at)
+
+        # Only results that never change are persisted on disk
+        if self.directory and expires_at is None:
+            self._write_disk(key, table)
+
+    def _put_memory(self, key, table, expires_at):
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (table, table.nbytes, expires_at)
+            self._nbytes += table.nbytes
+
+            # Evict the least recently used results
+            while self._nbytes > self.max_bytes and self._entries:
+                self._nbytes -= self._entries.popitem(last=False)[1][1]
+                self._counters['evictions'] += 1
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(repr(key).encode()).hexdigest() + '.arrow')
+
+    def _read_disk(self, key, now):
+        if not self.directory:
+            return None
+
+        path = self._path(key)
+        try:
+            with pa.memory_map(path) as source:
+                table = pa.ipc.open_file(source).read_all()
+            # Refresh the modification time used to resume the eviction order
+            os.utime(path, (now, now))
+        except (FileNotFoundError, pa.ArrowInvalid):
+            return None
+
+        with self._lock:
+            if os.path.basename(path) in self._files:
+                self._files.move_to_end(os.path.basename(path))
+
+        return table
+
+    def _remove_disk(self, key):
+        if self.directory:
+            path = self._path(key)
+            with self._lock:
+                self._disk_nbytes -= self._files.pop(os.path.basename(path), 0)
+            _remove_file(path)
+
+    def _write_disk(self, key, table):
+        path = self._path(key)
+        temporary_path = f'{path}.{threading.get_ident()}.tmp'
+        with pa.OSFile(temporary_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        size = os.path.getsize(temporary_path)
+        os.replace(temporary_path, path)
+
+        # Evict the least recently used files, the size of the tier being
+        # tracked as files are written instead of listing the directory
+        name = os.path.basename(path)
+        with self._lock:
+            self._disk_nbytes += size - self._files.pop(name, 0)
+            self._files[name] = size
+            evicted = []
+            while self._disk_nbytes > self.disk_max_bytes and len(self._files) > 1:
+                old_name, old_size = self._files.popitem(last=False)
+                self._disk_nbytes -= old_size
+                evicted.append(old_name)
+
+        # Another worker sharing the directory may have removed them already
+        for old_name in evicted:
+            _remove_file(os.path.join(self.directory, old_name))
+
+    def stats(self) -> dict:
+        """Return the hit, miss and eviction counters and the memory usage."""
+        with self._lock:
+            return dict(self._counters, entries=len(self._entries), memory_bytes=self._nbytes, disk_bytes=self._disk_nbytes)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def normalize_reference_time(reference_time) -> str:
+    """Return the reference time as an ISO formatted string in UTC."""
+    if reference_time.tzinfo is not None:
+        reference_time = reference_time.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return reference_time.isoformat()
+
+
+def forecast_key(forecast_type, reference_time, comid, ensemble) -> tuple:
+    """Return the normalized cache key of the forecast of one reach.
+
+    The reference time is converted to UTC so equivalent requests share the
+    same entry. The ensemble is a member number or 'average'.
+    """
+    return ('forecast', forecast_type, normalize_reference_time(reference_time), comid, ensemble)
+
+
+def forecast_ttl(reference_time) -> float | None:
+    """Return how long the results of a forecast cycle can be cached.
+
+    A cycle is still being loaded for a while after its reference time, so
+    recent cycles are only cached for a short time; older cycles never change.
+    """
+    if reference_time.tzinfo is None:
+        reference_time = reference_time.replace(tzinfo=timezone.utc)
+
+    age = (datetime.now(timezone.utc) - reference_time).total_seconds()
+    if age < settings.result_cache_immutable_after_seconds:
+        return settings.result_cache_recent_ttl_seconds
+
+    return None
+
+
+# Create the cache shared by the application
+result_cache = ResultCache(
+    max_bytes=settings.result_cache_max_bytes,
+    directory=settings.result_cache_dir,
+    disk_max_bytes=settings.result_cache_disk_max_bytes,
+)
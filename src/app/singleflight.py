@@ -0,0 +1,38 @@
+# Import libraries required for data processing
+import asyncio
+
+
+class SingleFlight:
+    """Coalesce concurrent calls made with the same key.
+
+    The first caller of a key starts the coroutine; callers arriving while it
+    is running await the same task and receive the same result, or the same
+    exception. The task is shielded, so a caller going away does not cancel
+    it for the others. The result must therefore be safe to share, e.g. an
+    Arrow table rather than a row iterator.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._counters = dict(calls=0, coalesced=0)
+
+    async def do(self, key: tuple, fn):
+        """Run the coroutine function fn once for all the concurrent callers of key."""
+        self._counters['calls'] += 1
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = asyncio.ensure_future(fn())
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        else:
+            self._counters['coalesced'] += 1
+
+        return await asyncio.shield(flight)
+
+    def stats(self) -> dict:
+        """Return the number of calls and of calls served by another caller's flight."""
+        return dict(self._counters, in_flight=len(self._flights))
+
+
+# Create the coalescer shared by the application
+single_flight = SingleFlight()
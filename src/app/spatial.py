@@ -0,0 +1,533 @@
+# Import libraries required for data processing
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from scipy.spatial import cKDTree
+
+from .backends import get_backend
+from .concurrency import limits
+from .config import settings
+from .responses import read_arrow_table
+from .static_tables import read_stream_network
+
+# Mean radius of the Earth in meters
+EARTH_RADIUS = 6371008.8
+
+# Version of the layout of the snapshot files
+SNAPSHOT_VERSION = 2
+
+# Quantile of the segment lengths used as the spacing of the points sampled
+# along the segments, so only the longest segments get extra points
+SAMPLE_SPACING_QUANTILE = 0.9
+
+# Smallest spacing of the sampled points, one meter in radians
+MIN_SAMPLE_SPACING = 1 / EARTH_RADIUS
+
+
+def _unit_vectors(lons, lats):
+    # Project the points on the unit sphere, where the straight-line (chord)
+    # distance grows monotonically with the great-circle distance
+    lons, lats = np.radians(np.asarray(lons, dtype=np.float64)), np.radians(np.asarray(lats, dtype=np.float64))
+    cos_lats = np.cos(lats)
+    return np.column_stack([cos_lats * np.cos(lons), cos_lats * np.sin(lons), np.sin(lats)])
+
+
+def _cross(u, v):
+    # Cross products of the rows of two arrays of 3D vectors
+    return np.column_stack([
+        u[:, 1] * v[:, 2] - u[:, 2] * v[:, 1],
+        u[:, 2] * v[:, 0] - u[:, 0] * v[:, 2],
+        u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0],
+    ])
+
+
+def _angles(u, v):
+    # Great-circle angle in radians between unit vectors, accurate at any distance
+    return np.arctan2(np.linalg.norm(_cross(u, v), axis=1), np.einsum('ij,ij->i', u, v))
+
+
+def _angle_to_chord(angle):
+    return 2 * np.sin(np.minimum(angle, np.pi) / 2)
+
+
+def _chord_to_angle(chord):
+    return 2 * np.arcsin(np.clip(np.asarray(chord) / 2, 0, 1))
+
+
+def _arc_distances(points, starts, ends):
+    """Return the great-circle angle between every point and the arc of its segment.
+
+    The point is projected on the great circle of the segment; when the
+    projection falls between the ends the distance is measured to the great
+    circle, otherwise to the closest end.
+    """
+    normals = _cross(starts, ends)
+    norms = np.linalg.norm(normals, axis=1)
+    degenerate = norms < 1e-15
+    normals = normals / np.where(degenerate, 1, norms)[:, None]
+
+    offsets = np.einsum('ij,ij->i', points, normals)
+    projections = points - offsets[:, None] * normals
+    inside = (
+        ~degenerate
+        & (np.einsum('ij,ij->i', _cross(starts, projections), normals) >= 0)
+        & (np.einsum('ij,ij->i', _cross(projections, ends), normals) >= 0)
+    )
+
+    to_ends = np.minimum(_angles(points, starts), _angles(points, ends))
+    return np.where(inside, np.arcsin(np.clip(np.abs(offsets), 0, 1)), to_ends)
+
+
+def parse_vertices(geometries):
+    """Extract the vertices of WKT geometries.
+
+    The strings are split column-wise with Arrow compute functions, so
+    millions of geometries are parsed without a Python loop. Null and empty
+    geometries have no vertices.
+
+    Args:
+
+        geometries (pyarrow.Array): The WKT geometries, e.g. LINESTRING or
+            MULTILINESTRING.
+
+    Returns:
+
+        tuple: The index of the geometry and of the line, counted over all the
+            geometries, of every vertex, and the longitudes and latitudes of
+            the vertices as NumPy arrays.
+    """
+    if isinstance(geometries, pa.ChunkedArray):
+        geometries = geometries.combine_chunks()
+
+    # Split the lines of the multi-part geometries
+    lines = pc.split_pattern_regex(geometries, r'\)\s*,\s*\(')
+    line_parents = pc.list_parent_indices(lines).to_numpy()
+    lines = pc.list_flatten(lines)
+
+    # Keep the "x y, x y" coordinates, without the geometry types and parentheses
+    coordinates = pc.utf8_trim_whitespace(pc.replace_substring_regex(lines, r'[A-Za-z()]', ''))
+    coordinates = pc.if_else(pc.equal(coordinates, ''), pa.scalar(None, coordinates.type), coordinates)
+
+    # One list of "x y" strings per line, the null ones giving empty lists
+    points = pc.split_pattern_regex(coordinates, r'\s*,\s*')
+    parts = pc.list_parent_indices(points).to_numpy()
+    values = pc.split_pattern_regex(pc.utf8_trim_whitespace(pc.list_flatten(points)), r'\s+')
+
+    lons = pc.cast(pc.list_element(values, 0), pa.float64()).to_numpy()
+    lats = pc.cast(pc.list_element(values, 1), pa.float64()).to_numpy()
+    return line_parents[parts], parts, lons, lats
+
+
+class ReachIndex:
+    """Nearest-neighbour index of the reaches of the stream network.
+
+    Every reach geometry is split into the great-circle segments between its
+    consecutive vertices. Points sampled along the segments, at least at every
+    vertex and at most SAMPLE_SPACING_QUANTILE segment lengths apart, are held
+    in a KD-tree built on their position on the unit sphere. The tree gives
+    the candidate segments of a point in logarithmic time, then the exact
+    distance to each candidate segment is measured and ranked. Distances are
+    great-circle distances in meters to the closest point of the reach line,
+    like the ST_DISTANCE of the BigQuery backend.
+
+    Args:
+
+        station_ids (numpy.ndarray): The station_id of every reach.
+        vertex_reaches (numpy.ndarray): The index in station_ids of the reach
+            of every vertex.
+        vertex_lines (numpy.ndarray): The index of the line of every vertex,
+            the vertices of a line, and the lines of a reach, being
+            consecutive.
+        lons (numpy.ndarray): The longitude of every vertex.
+        lats (numpy.ndarray): The latitude of every vertex.
+    """
+
+    def __init__(self, station_ids, vertex_reaches, vertex_lines, lons, lats):
+        self.station_ids = np.asarray(station_ids, dtype=np.int64)
+        self.vertex_reaches = np.asarray(vertex_reaches, dtype=np.int64)
+        self.vertex_lines = np.asarray(vertex_lines, dtype=np.int64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.vectors = _unit_vectors(self.lons, self.lats)
+
+        # Segments between the consecutive vertices of every line, lines of a
+        # single vertex giving a segment from the vertex to itself
+        same_line = self.vertex_lines[1:] == self.vertex_lines[:-1]
+        single = ~(np.append(same_line, False) | np.insert(same_line, 0, False))
+        starts = np.sort(np.concatenate([np.flatnonzero(same_line), np.flatnonzero(single)]))
+        ends = np.where(single[starts], starts, starts + 1)
+        self.segment_starts, self.segment_ends = starts, ends
+        self.segment_reaches = self.vertex_reaches[starts]
+
+        # Sample every segment from its start, and the last segment of every line up to its end
+        lengths = _angles(self.vectors[starts], self.vectors[ends])
+        self.spacing = max(float(np.quantile(lengths, SAMPLE_SPACING_QUANTILE)) if len(lengths) else 0, MIN_SAMPLE_SPACING)
+        counts = np.maximum(np.ceil(lengths / self.spacing), 1).astype(np.int64)
+        closing = np.append(starts[1:] != ends[:-1], True) & (starts != ends)
+        samples = counts + closing
+        self.sample_segments = np.repeat(np.arange(len(starts)), samples)
+        steps = np.arange(samples.sum()) - np.repeat(np.cumsum(samples) - samples, samples)
+        fractions = steps / counts[self.sample_segments]
+
+        # The vertex between two segments is only sampled at the start of the
+        # second one, but it belongs to the first one as well
+        following = np.insert(starts[1:] == ends[:-1], 0, False) & (starts != ends)
+        self.sample_previous = np.where((steps == 0) & following[self.sample_segments], self.sample_segments - 1, -1)
+
+        # Interpolate along the great circle of the segments
+        angles = lengths[self.sample_segments]
+        sines = np.sin(angles)
+        short = sines < 1e-12
+        start_weights = np.where(short, 1 - fractions, np.sin((1 - fractions) * angles) / np.where(short, 1, sines))
+        end_weights = np.where(short, fractions, np.sin(fractions * angles) / np.where(short, 1, sines))
+        points = (
+            start_weights[:, None] * self.vectors[starts[self.sample_segments]]
+            + end_weights[:, None] * self.vectors[ends[self.sample_segments]]
+        )
+        norms = np.linalg.norm(points, axis=1)
+        self.tree = cKDTree(points / np.where(norms > 0, norms, 1)[:, None])
+
+    @classmethod
+    def from_table(cls, table: pa.Table):
+        """Build the index from a table of station_id and WKT geometry columns."""
+        parents, lines, lons, lats = parse_vertices(table['geometry'])
+
+        # Drop the vertices that could not be parsed
+        valid = np.isfinite(lons) & np.isfinite(lats)
+        return cls(table['station_id'].to_numpy(), parents[valid], lines[valid], lons[valid], lats[valid])
+
+    @classmethod
+    def load(cls, path: str):
+        """Load the index from a snapshot written by save()."""
+        with np.load(path) as snapshot:
+            if int(snapshot['version']) != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported spatial index snapshot version {int(snapshot['version'])}.")
+            return cls(
+                snapshot['station_ids'], snapshot['vertex_reaches'], snapshot['vertex_lines'],
+                snapshot['lons'], snapshot['lats'],
+            )
+
+    def save(self, path: str):
+        """Write a snapshot of the index, replacing the previous one atomically."""
+        temporary_path = f'{path}.{threading.get_ident()}.tmp.npz'
+        np.savez(
+            temporary_path,
+            version=SNAPSHOT_VERSION,
+            station_ids=self.station_ids,
+            vertex_reaches=self.vertex_reaches,
+            vertex_lines=self.vertex_lines,
+            lons=self.lons,
+            lats=self.lats,
+        )
+        os.replace(temporary_path, path)
+
+    def _table(self, points, reaches, angles):
+        return pa.table(dict(
+            point=pa.array(points, pa.int64()),
+            station_id=pa.array(self.station_ids[reaches], pa.int64()),
+            distance=pa.array(np.asarray(angles) * EARTH_RADIUS, pa.float64()),
+        ))
+
+    def nearest(self, lats, lons, k: int = 1, max_distance: float | None = None) -> pa.Table:
+        """Find the k nearest reaches of every point.
+
+        The KD-tree is queried for all the points at once. The segments of
+        the sampled points it returns are the candidates, ranked by their
+        exact distance. A reach closer than the k-th candidate would have a
+        sampled point within that distance plus half the sample spacing, so
+        the points whose query did not reach that far are queried again with
+        more samples.
+
+        Args:
+
+            lats (array-like): The latitudes of the points.
+            lons (array-like): The longitudes of the points.
+            k (int): The number of reaches returned for each point.
+            max_distance (float, optional): The distance in meters beyond
+                which reaches are ignored.
+
+        Returns:
+
+            pyarrow.Table: The point index, station_id and distance of the
+                matches, ordered by point then distance. Points without any
+                reach within max_distance have no match.
+        """
+        vectors = _unit_vectors(lons, lats)
+        limit = max_distance / EARTH_RADIUS if max_distance is not None else np.inf
+        margin = self.spacing / 2
+        upper_bound = _angle_to_chord(limit + margin) if np.isfinite(limit) else np.inf
+
+        matches = []
+        pending = np.arange(len(vectors))
+        count = min(8 * k, self.tree.n)
+        while len(pending) and count:
+            chords, samples = self.tree.query(vectors[pending], k=count, distance_upper_bound=upper_bound)
+            chords, samples = chords.reshape(len(pending), count), samples.reshape(len(pending), count)
+
+            found = samples < self.tree.n
+            sample_angles = np.where(found, _chord_to_angle(chords), np.inf)
+            segments = self.sample_segments[np.where(found, samples, 0)]
+
+            # Every sample lies on its reach, so the k-th closest distinct reach of the
+            # samples bounds the k-th distance. Every point of a segment is within
+            # the margin of one of its samples or of its end vertex, so the segments
+            # whose samples are farther than the bound plus the margin are dropped
+            sample_reaches = self.segment_reaches[segments]
+            order = np.argsort(sample_reaches, axis=1, kind='stable')
+            sorted_reaches = np.take_along_axis(sample_reaches, order, axis=1)
+            first = np.ones_like(found)
+            first[:, 1:] = sorted_reaches[:, 1:] != sorted_reaches[:, :-1]
+            reach_angles = np.where(first, np.take_along_axis(sample_angles, order, axis=1), np.inf)
+            bounds = np.partition(reach_angles, k - 1, axis=1)[:, k - 1] if count >= k else np.full(len(pending), np.inf)
+            candidates = sample_angles <= np.minimum(bounds, limit)[:, None] + margin
+
+            # Measure the exact distance to every distinct candidate segment of every point
+            rows, columns = np.nonzero(candidates)
+            previous = self.sample_previous[samples[rows, columns]]
+            shared = previous >= 0
+            rows = np.concatenate([rows, rows[shared]])
+            segments = np.concatenate([segments[candidates], previous[shared]])
+            pairs = np.sort(rows * len(self.segment_starts) + segments)
+            pairs = pairs[np.append(True, pairs[1:] != pairs[:-1])]
+            rows, segments = pairs // len(self.segment_starts), pairs % len(self.segment_starts)
+            angles = _arc_distances(
+                vectors[pending[rows]], self.vectors[self.segment_starts[segments]], self.vectors[self.segment_ends[segments]],
+            )
+            reaches = self.segment_reaches[segments]
+
+            # Keep the closest segment of every reach, the segments of a reach being
+            # consecutive, then rank the reaches of every point
+            first = np.flatnonzero(np.append(True, (rows[1:] != rows[:-1]) | (reaches[1:] != reaches[:-1])))
+            rows, reaches = rows[first], reaches[first]
+            angles = np.minimum.reduceat(angles, first) if len(first) else angles
+            order = np.lexsort((reaches, angles, rows))
+            rows, reaches, angles = rows[order], reaches[order], angles[order]
+            group_starts = np.searchsorted(rows, rows)
+            ranks = np.arange(len(rows)) - group_starts
+
+            # The k-th distance of every point, bounded by max_distance
+            kth = np.full(len(pending), limit)
+            kth_rows = ranks == k - 1
+            kth[rows[kth_rows]] = np.minimum(angles[kth_rows], limit)
+
+            # A point is answered once its query reached beyond that distance plus the margin
+            full = samples[:, -1] < self.tree.n
+            searched = np.where(full, _chord_to_angle(chords[:, -1]), np.inf)
+            done = (searched >= kth + margin) | (count == self.tree.n)
+
+            keep = done[rows] & (ranks < k) & (angles <= limit)
+            matches.append((pending[rows[keep]], reaches[keep], angles[keep]))
+
+            pending = pending[~done]
+            count = min(count * 4, self.tree.n)
+
+        if not matches:
+            return self._table([], np.array([], dtype=np.int64), [])
+
+        points, reaches, angles = (np.concatenate(values) for values in zip(*matches))
+        order = np.lexsort((angles, points))
+        return self._table(points[order], reaches[order], angles[order])
+
+    def in_bbox(self, min_lon: float, min_lat: float, max_lon: float, max_lat: float) -> np.ndarray:
+        """Return the sorted station_id of the reaches with a vertex inside a bounding box."""
+        inside = (self.lons >= min_lon) & (self.lons <= max_lon) & (self.lats >= min_lat) & (self.lats <= max_lat)
+        return np.unique(self.station_ids[self.vertex_reaches[inside]])
+
+    def stats(self) -> dict:
+        """Return the number of reaches, vertices, segments and sampled points in the index."""
+        return dict(
+            reaches=len(self.station_ids),
+            vertices=len(self.lons),
+            segments=len(self.segment_starts),
+            samples=self.tree.n,
+        )
+
+
+def build_reach_index() -> ReachIndex:
+    """Build the index from the stream_network geometries of the query backend."""
+    return ReachIndex.from_table(read_arrow_table(get_backend().reach_geometries()))
+
+
+class SharedReachIndex:
+    """Reach index of the instance, loaded in the background at startup.
+
+    The index is loaded from the snapshot at path, or built from the query
+    backend and saved there when the snapshot does not exist yet. Until it is
+    ready, get() returns None and the endpoints fall back to the backend.
+
+    Args:
+
+        path (str, optional): The snapshot file of the index. Defaults to
+            None, which disables the index.
+    """
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self._index = None
+        self._error = None
+        self._thread = None
+
+    def start(self):
+        """Load the index in a background thread."""
+        if self.path and self._thread is None:
+            self._thread = threading.Thread(target=self._load, name='reach-index-load', daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        try:
+            index = None
+            if os.path.exists(self.path):
+                try:
+                    index = ReachIndex.load(self.path)
+                except ValueError:
+                    # Rebuild the snapshots of an older layout
+                    pass
+            if index is None:
+                index = build_reach_index()
+                index.save(self.path)
+            self._index = index
+        except Exception as e:
+            # Keep answering from the backend
+            self._error = repr(e)
+
+    def get(self) -> ReachIndex | None:
+        """Return the index, or None while it is not available."""
+        return self._index
+
+    def stats(self) -> dict:
+        """Return whether the index is enabled and ready, and its size."""
+        stats = dict(enabled=bool(self.path), ready=self._index is not None, error=self._error)
+        if self._index is not None:
+            stats.update(self._index.stats())
+        return stats
+
+
+def join_attributes(matches: pa.Table, records: pa.Table) -> pa.Table:
+    """Attach the stream_network records of the matched reaches.
+
+    Returns the point index, the columns of the records and the distance of
+    every match, ordered by point then distance.
+    """
+    if not records.num_rows:
+        return matches
+
+    joined = matches.join(records, keys='station_id', join_type='left outer')
+    columns = ['point'] + records.column_names + ['distance']
+    return joined.select(columns).sort_by([('point', 'ascending'), ('distance', 'ascending')])
+
+
+def read_points(body: bytes, content_type: str) -> pa.Table:
+    """Read the points of a batch snapping request.
+
+    Args:
+
+        body (bytes): The content of the request.
+        content_type (str): The media type of the content, either 'text/csv'
+            with lat and lon columns, or JSON holding a list of objects with
+            lat and lon fields or a GeoJSON FeatureCollection of points.
+            An optional id column or field, or the GeoJSON feature id, is
+            returned with the matches of each point.
+
+    Returns:
+
+        pyarrow.Table: The lat and lon of every point, and their id if given.
+
+    Raises:
+
+        ValueError: If the points cannot be read.
+    """
+    try:
+        return _read_points(body, content_type)
+    except (KeyError, IndexError, TypeError, AttributeError, pa.ArrowException) as e:
+        raise ValueError(f'Invalid points: {e!r}') from e
+
+
+def _read_points(body, content_type):
+    if content_type.split(';')[0].strip().lower() == 'text/csv':
+        table = pa_csv.read_csv(pa.BufferReader(body))
+        table = table.rename_columns([name.strip().lower() for name in table.column_names])
+    else:
+        content = json.loads(body)
+        if isinstance(content, dict) and content.get('type') == 'FeatureCollection':
+            # Read the GeoJSON points, whose coordinates are [lon, lat]
+            rows = []
+            for feature in content.get('features', []):
+                geometry = feature.get('geometry') or {}
+                if geometry.get('type') != 'Point':
+                    raise ValueError('Only GeoJSON Point features are supported.')
+                identifier = feature.get('id', (feature.get('properties') or {}).get('id'))
+                rows.append(dict(id=identifier, lon=geometry['coordinates'][0], lat=geometry['coordinates'][1]))
+        elif isinstance(content, dict):
+            rows = content.get('points', [])
+        else:
+            rows = content
+        table = pa.Table.from_pylist(rows)
+        if 'id' in table.column_names and table['id'].null_count == table.num_rows:
+            table = table.drop_columns(['id'])
+
+    if 'lat' not in table.column_names or 'lon' not in table.column_names:
+        raise ValueError('Every point must have a lat and a lon.')
+
+    columns = ['id', 'lat', 'lon'] if 'id' in table.column_names else ['lat', 'lon']
+    table = table.select(columns)
+    for name in ('lat', 'lon'):
+        table = table.set_column(table.column_names.index(name), name, pc.cast(table[name], pa.float64()))
+        if table[name].null_count:
+            raise ValueError('Every point must have a lat and a lon.')
+
+    return table
+
+
+def join_points(points: pa.Table, matches: pa.Table) -> pa.Table:
+    """Attach the matches of every point to its id and coordinates.
+
+    Points without any match are kept with null match columns.
+    """
+    points = points.append_column('point', pa.array(np.arange(points.num_rows), pa.int64()))
+    joined = points.join(matches, keys='point', join_type='left outer')
+    columns = ['point'] + points.column_names[:-1] + [name for name in matches.column_names if name != 'point']
+    return joined.select(columns).sort_by([('point', 'ascending'), ('distance', 'ascending')])
+
+
+async def snap_points(
+    index: ReachIndex, lats, lons, k: int = 1, max_distance: float | None = None, attributes: bool = True,
+) -> pa.Table:
+    """Find the k nearest reaches of every point, with their stream_network
+    records unless attributes is False."""
+    matches = await limits.run(index.nearest, lats, lons, k, max_distance)
+    if not matches.num_rows or not attributes:
+        return matches
+
+    # Read the records of the matched reaches once, whatever the number of points
+    station_ids = np.unique(matches['station_id'].to_numpy()).tolist()
+    results = await read_stream_network(station_ids)
+    records = await limits.run(read_arrow_table, results)
+
+    return await limits.run(join_attributes, matches, records)
+
+
+# Create the index shared by the application
+reach_index = SharedReachIndex(settings.spatial_index_path)
+
+
+def main(argv=None):
+    """Build the snapshot of the reach index from the configured query backend."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('path', nargs='?', default=settings.spatial_index_path, help='The snapshot file to write.')
+    args = parser.parse_args(argv)
+    if not args.path:
+        parser.error('Provide the snapshot path or set NWM_API_SPATIAL_INDEX_PATH.')
+
+    index = build_reach_index()
+    index.save(args.path)
+    print(f"Indexed {index.stats()['reaches']} reaches and {index.stats()['vertices']} vertices in {args.path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+# Import libraries required for data processing
+import argparse
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+import numpy as np
+import pyarrow as pa
+
+from .backends import get_backend
+from .concurrency import limits
+from .config import settings
+from .queries import RETURN_PERIODS
+from .responses import read_arrow_table
+from .result_cache import ArrowRows, result_cache
+
+# Static tables kept locally, with the id column they are indexed by
+STATIC_TABLES = dict(
+    stream_network = 'station_id',
+    flood_return_periods = 'feature_id',
+)
+
+# Name of the file describing the current version of every snapshot
+MANIFEST = 'manifest.json'
+
+
+class StaticTable:
+    """Table memory-mapped from an Arrow IPC snapshot, sorted by its id column.
+
+    The ids are held as a sorted NumPy array, so the records of any number of
+    ids are found with a binary search and read without copying the table.
+
+    Args:
+
+        table (pyarrow.Table): The records, sorted by id_column.
+        id_column (str): The column identifying the records.
+        version (int): The version of the snapshot.
+    """
+
+    def __init__(self, table: pa.Table, id_column: str, version: int):
+        self.table = table
+        self.id_column = id_column
+        self.version = version
+        self.ids = table[id_column].to_numpy()
+
+    @classmethod
+    def open(cls, path: str, id_column: str, version: int):
+        """Memory-map a snapshot written by write()."""
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+        return cls(table, id_column, version)
+
+    @staticmethod
+    def write(path: str, table: pa.Table, id_column: str):
+        """Write the records sorted by id_column as an Arrow IPC file."""
+        table = table.sort_by([(id_column, 'ascending')])
+        temporary_path = f'{path}.{threading.get_ident()}.tmp'
+        with pa.OSFile(temporary_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temporary_path, path)
+
+    def take(self, ids: list, columns: list | None = None) -> pa.Table:
+        """Return the records of ids, in the order of ids, skipping the unknown ones."""
+        ids = np.asarray(ids, dtype=self.ids.dtype)
+        positions = np.searchsorted(self.ids, ids)
+        positions[positions == len(self.ids)] = 0
+        positions = positions[self.ids[positions] == ids] if len(self.ids) else positions[:0]
+
+        table = self.table.select(columns) if columns else self.table
+        return table.take(pa.array(positions, pa.int64()))
+
+
+class StaticTables:
+    """Local snapshots of the tables that only change with NWM upgrades.
+
+    Each table is stored as a versioned Arrow IPC file in directory, the
+    current versions being listed in a manifest. At startup the snapshots are
+    memory-mapped in a background thread, or built from the query backend
+    when they do not exist yet. Until a table is ready, get() returns None and
+    the endpoints fall back to the backend.
+
+    Args:
+
+        directory (str, optional): The directory of the snapshots. Defaults to
+            None, which disables the snapshots.
+    """
+
+    def __init__(self, directory: str | None):
+        self.directory = directory
+        self._tables = {}
+        self._errors = {}
+        self._reserved = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Load the snapshots in a background thread."""
+        if self.directory and self._thread is None:
+            self._thread = threading.Thread(target=self._load, name='static-tables-load', daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = self._read_manifest()
+        for name, id_column in STATIC_TABLES.items():
+            try:
+                entry = manifest.get(name)
+                if entry is not None and os.path.exists(os.path.join(self.directory, entry['file'])):
+                    table = StaticTable.open(os.path.join(self.directory, entry['file']), id_column, entry['version'])
+                    with self._lock:
+                        self._tables[name] = table
+                else:
+                    self.refresh(name)
+            except Exception as e:
+                # Keep answering from the backend
+                self._errors[name] = repr(e)
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self, manifest):
+        path = os.path.join(self.directory, MANIFEST)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f'{path}.tmp', path)
+
+    def refresh(self, name: str) -> dict:
+        """Write a new version of the snapshot of a table from the query backend.
+
+        The new version replaces the one in use once it is complete; the
+        previous version is kept for the instances still reading it, and
+        older ones are removed.
+
+        Returns:
+
+            dict: The manifest entry of the new version.
+        """
+        id_column = STATIC_TABLES[name]
+        table = read_arrow_table(get_backend().static_table(name))
+        if not table.num_rows:
+            raise ValueError(f"The {name} table of the backend is empty.")
+
+        # The lock only covers the version numbers, the manifest and the swap of
+        # the table in use: the snapshot is written and opened without it
+        with self._lock:
+            previous = self._read_manifest().get(name)
+            version = max(previous['version'] if previous else 0, self._reserved.get(name, 0)) + 1
+            self._reserved[name] = version
+        entry = dict(
+            version=version,
+            file=f'{name}.v{version}.arrow',
+            rows=table.num_rows,
+            backend=type(get_backend()).__name__,
+            refreshed_at=datetime.now(timezone.utc).isoformat(),
+        )
+        StaticTable.write(os.path.join(self.directory, entry['file']), table, id_column)
+        snapshot = StaticTable.open(os.path.join(self.directory, entry['file']), id_column, version)
+
+        with self._lock:
+            manifest = self._read_manifest()
+            # A concurrent refresh may have published a newer version already
+            if name not in manifest or manifest[name]['version'] < version:
+                manifest[name] = entry
+                self._write_manifest(manifest)
+                self._tables[name] = snapshot
+                self._errors.pop(name, None)
+            current = manifest[name]['version']
+
+        # Remove the versions older than the previous one
+        for file in os.listdir(self.directory):
+            if file.startswith(f'{name}.v') and file.endswith('.arrow'):
+                file_version = int(file[len(name) + 2:-len('.arrow')])
+                if file_version < current - 1:
+                    try:
+                        os.remove(os.path.join(self.directory, file))
+                    except FileNotFoundError:
+                        pass
+
+        return entry
+
+    def get(self, name: str) -> StaticTable | None:
+        """Return the snapshot of a table, or None while it is not available.
+
+        The snapshots in use are only swapped, never modified, so this is a
+        plain dict read that does not wait for a refresh.
+        """
+        return self._tables.get(name)
+
+    def stats(self) -> dict:
+        """Return the version and number of rows of the snapshots in use."""
+        stats = {}
+        for name in STATIC_TABLES:
+            table = self.get(name)
+            stats[name] = dict(
+                ready=table is not None,
+                version=table.version if table is not None else None,
+                rows=table.table.num_rows if table is not None else None,
+                error=self._errors.get(name),
+            )
+        return dict(enabled=bool(self.directory), **stats)
+
+
+async def read_stream_network(station_ids: list):
+    """Return the stream_network records of the given reaches ordered by
+    station_id, from the local snapshot when it is available."""
+    table = static_tables.get('stream_network')
+    if table is None:
+        return await limits.query(get_backend().stream_network, station_ids)
+
+    return ArrowRows(await limits.run(table.take, sorted({int(station_id) for station_id in station_ids})))
+
+
+async def read_return_periods(comids: list, return_periods: list | None = None, order_by_comid: bool = False):
+    """Return the flood return periods of the given reaches, from the local
+    snapshot when it is available and from the cached backend results otherwise.
+
+    The records follow the order of comids, or are ordered by comid if
+    order_by_comid is True. If return_periods is None all six return periods
+    are returned.
+    """
+    table = static_tables.get('flood_return_periods')
+    if table is not None:
+        ids = sorted(set(comids)) if order_by_comid else list(dict.fromkeys(comids))
+        columns = ['feature_id'] + [f'return_period_{rp}' for rp in dict.fromkeys(return_periods or RETURN_PERIODS)]
+        return ArrowRows(await limits.run(table.take, ids, columns))
+
+    # The return periods are static so their results are served from cache
+    # and concurrent identical requests share one query
+    key = ('return_periods', tuple(sorted(set(comids))), tuple(return_periods or ()), order_by_comid)
+    return await result_cache.cached_table(
+        key, lambda: get_backend().return_periods(comids, return_periods, order_by_comid)
+    )
+
+
+# Create the snapshots shared by the application
+static_tables = StaticTables(settings.static_tables_dir)
+
+
+def main(argv=None):
+    """Write a new version of the local snapshots from the configured query backend."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('command', choices=['refresh'], help='The operation to run.')
+    parser.add_argument('tables', nargs='*', help=f'The tables to refresh among {list(STATIC_TABLES)}, all of them by default.')
+    parser.add_argument('--directory', default=settings.static_tables_dir, help='The directory of the snapshots.')
+    args = parser.parse_args(argv)
+    if not args.directory:
+        parser.error('Provide the directory or set NWM_API_STATIC_TABLES_DIR.')
+    for name in args.tables:
+        if name not in STATIC_TABLES:
+            parser.error(f'Invalid table {name!r}. Supported values are {list(STATIC_TABLES)}.')
+
+    tables = StaticTables(args.directory)
+    os.makedirs(args.directory, exist_ok=True)
+    for name in args.tables or STATIC_TABLES:
+        entry = tables.refresh(name)
+        print(f"{name}: version {entry['version']}, {entry['rows']} rows in {entry['file']}")
+
+
+if __name__ == '__main__':
+    main()
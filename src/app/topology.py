@@ -0,0 +1,225 @@
+# Import libraries required for data processing
+import argparse
+import os
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from .backends import get_backend
+from .config import settings
+from .responses import read_arrow_table
+from .static_tables import static_tables
+
+# Version of the layout of the snapshot files
+SNAPSHOT_VERSION = 1
+
+# Column of the stream_network table holding the downstream reach
+DOWNSTREAM_COLUMN = 'to'
+
+
+class NetworkTopology:
+    """Upstream and downstream connectivity of the reaches of the stream network.
+
+    Reaches are identified by their position in the sorted station_ids. The
+    downstream reach of every reach is held in one array, and the upstream
+    reaches in a compressed sparse row (CSR) adjacency: the upstream reaches
+    of the reach at position i are upstream[indptr[i]:indptr[i + 1]]. Basins
+    and paths are found in memory by walking these arrays, one level of the
+    network at a time.
+
+    Args:
+
+        station_ids (numpy.ndarray): The sorted station_id of every reach.
+        downstream (numpy.ndarray): The position in station_ids of the
+            downstream reach of every reach, -1 for the outlets.
+    """
+
+    def __init__(self, station_ids, downstream):
+        self.station_ids = np.asarray(station_ids, dtype=np.int64)
+        self.downstream = np.asarray(downstream, dtype=np.int64)
+
+        # Group the reaches by downstream reach to build the upstream adjacency
+        children = np.flatnonzero(self.downstream >= 0)
+        self.upstream = children[np.argsort(self.downstream[children], kind='stable')]
+        counts = np.bincount(self.downstream[children], minlength=len(self.station_ids))
+        self.indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    @classmethod
+    def from_table(cls, table: pa.Table):
+        """Build the topology from a table of station_id and to columns."""
+        table = table.sort_by([('station_id', 'ascending')])
+        station_ids = table['station_id'].to_numpy()
+        targets = pc.fill_null(table[DOWNSTREAM_COLUMN].cast(pa.int64()), -1).to_numpy()
+
+        # Reaches flowing out of the network or into themselves are outlets
+        positions = np.minimum(np.searchsorted(station_ids, targets), max(len(station_ids) - 1, 0))
+        known = (station_ids[positions] == targets) & (positions != np.arange(len(station_ids)))
+        return cls(station_ids, np.where(known, positions, -1))
+
+    @classmethod
+    def load(cls, path: str):
+        """Load the topology from a snapshot written by save()."""
+        with np.load(path) as snapshot:
+            if int(snapshot['version']) != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported network topology snapshot version {int(snapshot['version'])}.")
+            return cls(snapshot['station_ids'], snapshot['downstream'])
+
+    def save(self, path: str):
+        """Write a snapshot of the topology, replacing the previous one atomically."""
+        temporary_path = f'{path}.{threading.get_ident()}.tmp.npz'
+        np.savez(temporary_path, version=SNAPSHOT_VERSION, station_ids=self.station_ids, downstream=self.downstream)
+        os.replace(temporary_path, path)
+
+    def _position(self, comid):
+        position = int(np.searchsorted(self.station_ids, comid))
+        if position == len(self.station_ids) or self.station_ids[position] != comid:
+            raise KeyError(f'Unknown reach {comid}.')
+        return position
+
+    def upstream_of(self, comid: int, max_reaches: int | None = None) -> np.ndarray:
+        """Return the station_id of a reach and of every reach upstream of it.
+
+        The reaches are ordered from the reach itself up to the headwaters,
+        level by level.
+
+        Raises:
+
+            KeyError: If the reach is not in the network.
+            ValueError: If the basin has more than max_reaches reaches.
+        """
+        visited = np.zeros(len(self.station_ids), dtype=bool)
+        frontier = np.array([self._position(comid)], dtype=np.int64)
+        levels, count = [], 0
+        while len(frontier):
+            visited[frontier] = True
+            levels.append(frontier)
+            count += len(frontier)
+            if max_reaches is not None and count > max_reaches:
+                raise ValueError(f'The basin of reach {comid} has more than {max_reaches} reaches.')
+
+            # Gather the upstream reaches of the whole level at once
+            starts, ends = self.indptr[frontier], self.indptr[frontier + 1]
+            lengths = ends - starts
+            offsets = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+            frontier = self.upstream[offsets + np.arange(lengths.sum())]
+            frontier = frontier[~visited[frontier]]
+
+        return self.station_ids[np.concatenate(levels)]
+
+    def downstream_of(self, comid: int, max_reaches: int | None = None) -> np.ndarray:
+        """Return the station_id of a reach and of every reach down to its outlet, in flow order.
+
+        Raises:
+
+            KeyError: If the reach is not in the network.
+            ValueError: If the path has more than max_reaches reaches.
+        """
+        path = [self._position(comid)]
+        visited = {path[0]}
+        while self.downstream[path[-1]] >= 0 and int(self.downstream[path[-1]]) not in visited:
+            if max_reaches is not None and len(path) >= max_reaches:
+                raise ValueError(f'The path down from reach {comid} has more than {max_reaches} reaches.')
+            path.append(int(self.downstream[path[-1]]))
+            visited.add(path[-1])
+
+        return self.station_ids[np.array(path, dtype=np.int64)]
+
+    def reaches(self, upstream_of: int | None = None, downstream_of: int | None = None, max_reaches: int | None = None) -> list:
+        """Return the reaches of the basin upstream of a reach and of the path downstream of a reach.
+
+        The basin comes first, followed by the reaches of the path that are
+        not in it.
+        """
+        reaches = []
+        if upstream_of is not None:
+            reaches.extend(self.upstream_of(upstream_of, max_reaches).tolist())
+        if downstream_of is not None:
+            reaches.extend(self.downstream_of(downstream_of, max_reaches).tolist())
+        reaches = list(dict.fromkeys(reaches))
+        if max_reaches is not None and len(reaches) > max_reaches:
+            raise ValueError(f'The network query selects more than {max_reaches} reaches.')
+        return reaches
+
+    def stats(self) -> dict:
+        """Return the number of reaches and of outlets in the topology."""
+        return dict(reaches=len(self.station_ids), outlets=int((self.downstream < 0).sum()))
+
+
+def build_topology() -> NetworkTopology:
+    """Build the topology from the local stream_network snapshot, or the query backend."""
+    snapshot = static_tables.get('stream_network')
+    if snapshot is not None and DOWNSTREAM_COLUMN in snapshot.table.column_names:
+        return NetworkTopology.from_table(snapshot.table.select(['station_id', DOWNSTREAM_COLUMN]))
+
+    return NetworkTopology.from_table(read_arrow_table(get_backend().reach_topology()))
+
+
+class SharedTopology:
+    """Network topology of the instance, loaded in the background at startup.
+
+    The topology is loaded from the snapshot at path, or built and saved
+    there when the snapshot does not exist yet. Until it is ready, get()
+    returns None.
+
+    Args:
+
+        path (str, optional): The snapshot file of the topology. Defaults to
+            None, which disables the network queries.
+    """
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self._topology = None
+        self._error = None
+        self._thread = None
+
+    def start(self):
+        """Load the topology in a background thread."""
+        if self.path and self._thread is None:
+            self._thread = threading.Thread(target=self._load, name='network-topology-load', daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        try:
+            if os.path.exists(self.path):
+                self._topology = NetworkTopology.load(self.path)
+            else:
+                topology = build_topology()
+                topology.save(self.path)
+                self._topology = topology
+        except Exception as e:
+            self._error = repr(e)
+
+    def get(self) -> NetworkTopology | None:
+        """Return the topology, or None while it is not available."""
+        return self._topology
+
+    def stats(self) -> dict:
+        """Return whether the topology is enabled and ready, and its size."""
+        stats = dict(enabled=bool(self.path), ready=self._topology is not None, error=self._error)
+        if self._topology is not None:
+            stats.update(self._topology.stats())
+        return stats
+
+
+# Create the topology shared by the application
+network_topology = SharedTopology(settings.network_topology_path)
+
+
+def main(argv=None):
+    """Build the snapshot of the network topology from the configured query backend."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('path', nargs='?', default=settings.network_topology_path, help='The snapshot file to write.')
+    args = parser.parse_args(argv)
+    if not args.path:
+        parser.error('Provide the snapshot path or set NWM_API_NETWORK_TOPOLOGY_PATH.')
+
+    topology = build_topology()
+    topology.save(args.path)
+    print(f"Indexed {topology.stats()['reaches']} reaches and {topology.stats()['outlets']} outlets in {args.path}")
+
+
+if __name__ == '__main__':
+    main()
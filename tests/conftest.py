@@ -0,0 +1,135 @@
+"""Shared fixtures of the test suite.
+
+The tests run offline against the DuckDB backend, reading a small NWM-shaped
+Parquet dataset written to a temporary directory before the application is
+imported, since its settings are read at import time.
+"""
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+# Reaches of the synthetic network, reach p flowing into reach (p - 1) // 2
+COMIDS = list(range(1000001, 1000016))
+DOWNSTREAM = [None] + [COMIDS[(position - 1) // 2] for position in range(1, len(COMIDS))]
+
+# Cycle of every forecast run, and number of members and lead times written for each
+REFERENCE_TIME = datetime(2023, 1, 1, 6)
+FORECAST_LAYOUT = dict(
+    short_range = dict(members=1, lead_times=3, step=1),
+    medium_range = dict(members=2, lead_times=3, step=3),
+    long_range = dict(members=2, lead_times=2, step=6),
+)
+
+# Hours of analysis-assimilation records, ending at the forecast cycle
+ANALYSIS_ASSIM_HOURS = 6
+
+RETURN_PERIODS = (2, 5, 10, 25, 50, 100)
+
+
+def streamflow(position, member, lead_time):
+    """Return the synthetic streamflow of a reach, member and lead time."""
+    return 10.0 * (position + 1) + member + lead_time
+
+
+def return_period_flow(position, return_period):
+    """Return the synthetic flow of a return period of a reach."""
+    return 10.0 * (position + 1) + return_period / 10
+
+
+def geometry(position):
+    """Return the WKT geometry of a reach, a short west-east line."""
+    lon = -111.0 + 0.1 * position
+    return f'LINESTRING ({lon:.5f} 40.00000, {lon + 0.05:.5f} 40.00000, {lon + 0.05:.5f} 40.05000)'
+
+
+def write_records(path, time, values):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    values = np.asarray(values, dtype=np.float32)
+    pq.write_table(pa.table(dict(
+        feature_id=pa.array(COMIDS, pa.int64()),
+        time=pa.array(np.full(len(COMIDS), np.datetime64(time, 's'))),
+        streamflow=values,
+        velocity=values / 10,
+    )), path)
+
+
+def generate_data(root):
+    """Write the synthetic Parquet files in the layout read by the DuckDB backend."""
+    positions = np.arange(len(COMIDS))
+
+    for forecast_type, layout in FORECAST_LAYOUT.items():
+        for member in range(1, layout['members'] + 1):
+            if forecast_type == 'short_range':
+                folder, suffix = 'short_range', 'channel_rt'
+            else:
+                folder, suffix = f'{forecast_type}_mem{member}', f'channel_rt_{member}'
+            for lead_time in range(1, layout['lead_times'] + 1):
+                hours = lead_time * layout['step']
+                write_records(
+                    f'{root}/channel_rt/{folder}/nwm.{REFERENCE_TIME:%Y%m%d}.t{REFERENCE_TIME:%H}z.'
+                    f'{forecast_type}.{suffix}.f{hours:03d}.conus.parq',
+                    REFERENCE_TIME + timedelta(hours=hours),
+                    streamflow(positions, member - 1, lead_time),
+                )
+
+    for hour in range(ANALYSIS_ASSIM_HOURS):
+        cycle = REFERENCE_TIME - timedelta(hours=ANALYSIS_ASSIM_HOURS - 1 - hour)
+        write_records(
+            f'{root}/channel_rt/analysis_assim/nwm.{cycle:%Y%m%d}.t{cycle:%H}z.analysis_assim.channel_rt.tm01.conus.parq',
+            cycle - timedelta(hours=1),
+            streamflow(positions, 0, hour),
+        )
+
+    pq.write_table(pa.table(dict(
+        station_id=pa.array(COMIDS, pa.int64()),
+        to=pa.array(DOWNSTREAM, pa.int64()),
+        geometry=[geometry(position) for position in positions],
+    )), f'{root}/stream_network.parquet')
+
+    pq.write_table(pa.table(dict(
+        feature_id=pa.array(COMIDS, pa.int64()),
+        **{f'return_period_{rp}': return_period_flow(positions, rp) for rp in RETURN_PERIODS},
+    )), f'{root}/flood_return_periods.parquet')
+
+
+DATA_DIR = tempfile.mkdtemp(prefix='nwm-api-tests-')
+generate_data(DATA_DIR)
+
+# The settings are read when the application is imported
+os.environ.update(
+    NWM_API_BACKEND='duckdb',
+    NWM_API_PARQUET_ROOT=DATA_DIR,
+    NWM_API_SPATIAL_INDEX_PATH=os.path.join(DATA_DIR, 'reach_index.npz'),
+    NWM_API_NETWORK_TOPOLOGY_PATH=os.path.join(DATA_DIR, 'network_topology.npz'),
+)
+for name in ('NWM_API_RESULT_CACHE_DIR', 'NWM_API_STATIC_TABLES_DIR', 'NWM_API_ENSEMBLE_STATS_DIR', 'NWM_API_EXPORT_DIR'):
+    os.environ.pop(name, None)
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def client():
+    """Return a client of the application, started once for the whole session."""
+    import time
+
+    from fastapi.testclient import TestClient
+
+    from app.main import app
+    from app.spatial import reach_index
+    from app.topology import network_topology
+
+    with TestClient(app) as client:
+        # Wait for the indexes loaded in the background at startup
+        deadline = time.monotonic() + 30
+        while (reach_index.get() is None or network_topology.get() is None) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        yield client
@@ -0,0 +1,140 @@
+import io
+from datetime import timedelta
+
+import pyarrow.parquet as pq
+import pytest
+
+from conftest import COMIDS, FORECAST_LAYOUT, REFERENCE_TIME, return_period_flow, streamflow
+
+REFERENCE_TIME_PARAM = REFERENCE_TIME.isoformat()
+
+
+def test_status(client):
+    status = client.get('/status').json()
+
+    assert status['backend'] == 'DuckDBBackend'
+    assert status['spatial_index']['ready'] and status['network_topology']['ready']
+
+
+@pytest.mark.parametrize('forecast_type', list(FORECAST_LAYOUT))
+def test_forecast_average(client, forecast_type):
+    response = client.get('/forecast', params=dict(
+        forecast_type=forecast_type, reference_time=REFERENCE_TIME_PARAM, comids=f'{COMIDS[0]},{COMIDS[2]}',
+    ))
+
+    assert response.status_code == 200
+    records = response.json()
+    layout = FORECAST_LAYOUT[forecast_type]
+    assert len(records) == 2 * layout['lead_times']
+    assert {record['ensemble'] for record in records} == {'average'}
+    members = range(layout['members'])
+    expected = {
+        (COMIDS[position], (REFERENCE_TIME + timedelta(hours=lead_time * layout['step'])).isoformat()):
+            sum(streamflow(position, member, lead_time) for member in members) / len(members)
+        for position in (0, 2) for lead_time in range(1, layout['lead_times'] + 1)
+    }
+    assert {(record['feature_id'], record['time']): record['streamflow'] for record in records} == pytest.approx(expected)
+
+
+def test_forecast_members_as_parquet(client):
+    response = client.get('/forecast', params=dict(
+        forecast_type='medium_range', reference_time=REFERENCE_TIME_PARAM, comids=COMIDS[1],
+        ensemble='1', output_format='parquet',
+    ))
+
+    table = pq.read_table(io.BytesIO(response.content))
+    assert table.num_rows == FORECAST_LAYOUT['medium_range']['lead_times']
+    assert set(table['ensemble'].to_pylist()) == {1}
+    assert table['streamflow'].to_pylist() == [streamflow(1, 1, lead_time) for lead_time in (1, 2, 3)]
+
+
+def test_forecast_of_the_latest_cycle(client):
+    records = client.get('/forecast', params=dict(forecast_type='short_range', comids=COMIDS[0])).json()
+
+    assert {record['reference_time'] for record in records} == {REFERENCE_TIME_PARAM}
+
+
+def test_invalid_requests(client):
+    assert client.get('/forecast', params=dict(forecast_type='hourly', comids=COMIDS[0])).status_code == 400
+    assert client.get('/forecast', params=dict(forecast_type='short_range')).status_code == 400
+    assert client.get('/return-period', params=dict(comids=COMIDS[0], return_periods='3')).status_code == 400
+    assert client.get('/analysis-assim', params=dict(comids=COMIDS[0], run_offset=4)).status_code == 400
+
+    # IDs that are not integers are rejected rather than failing the request
+    assert client.get('/forecast', params=dict(forecast_type='short_range', comids='1,abc')).status_code == 400
+    assert client.get('/forecast', params=dict(
+        forecast_type='medium_range', comids=COMIDS[0], ensemble='first',
+    )).status_code == 400
+    assert client.get('/geometry', params=dict(comids='x')).status_code == 400
+
+
+def test_analysis_assim_aggregated(client):
+    response = client.get('/analysis-assim', params=dict(
+        comids=COMIDS[3], start_time='2022-12-31', end_time='2023-01-02', aggregate='daily', statistics='mean,max',
+    ))
+
+    records = response.json()
+    assert len(records) == 1
+    assert records[0]['count'] == 6
+    assert records[0]['streamflow_max'] == streamflow(3, 0, 5)
+    assert records[0]['streamflow_mean'] == pytest.approx(sum(streamflow(3, 0, hour) for hour in range(6)) / 6)
+
+
+def test_analysis_assim_downsampled(client):
+    records = client.get('/analysis-assim', params=dict(
+        comids=COMIDS[0], start_time='2022-12-31', end_time='2023-01-02', max_points=3,
+    )).json()
+
+    assert len(records) == 3
+
+
+def test_return_periods(client):
+    response = client.get('/return-period', params=dict(
+        comids=f'{COMIDS[4]},{COMIDS[1]}', return_periods='2,100', order_by_comid=True, output_format='csv',
+    ))
+
+    assert response.text.split('\r\n')[:3] == [
+        'feature_id,return_period_2,return_period_100',
+        f'{COMIDS[1]},{return_period_flow(1, 2)},{return_period_flow(1, 100)}',
+        f'{COMIDS[4]},{return_period_flow(4, 2)},{return_period_flow(4, 100)}',
+    ]
+
+
+def test_forecast_exceedance(client):
+    records = client.get('/forecast-exceedance', params=dict(
+        forecast_type='short_range', reference_time=REFERENCE_TIME_PARAM, comids=COMIDS[0],
+    )).json()
+
+    # The peak, 10 + 3, exceeds the 25-year flow of the first reach, 10 + 2.5
+    assert records[0]['peak_streamflow'] == streamflow(0, 0, 3)
+    assert records[0]['return_period'] == 25
+
+
+def test_nearest_reach(client):
+    records = client.get('/geometry', params=dict(lat=40.0, lon=-110.7, k=2)).json()
+
+    assert [record['station_id'] for record in records] == [COMIDS[3], COMIDS[2]]
+
+
+def test_network_traversal(client):
+    # The reach at position p flows into the one at (p - 1) // 2
+    basin = client.get('/return-period', params=dict(upstream_of=COMIDS[2])).json()
+    assert sorted(record['feature_id'] for record in basin) == [COMIDS[p] for p in (2, 5, 6, 11, 12, 13, 14)]
+
+    path = client.get('/forecast', params=dict(
+        forecast_type='short_range', reference_time=REFERENCE_TIME_PARAM, downstream_of=COMIDS[9],
+    )).json()
+    assert {record['feature_id'] for record in path} == {COMIDS[p] for p in (9, 4, 1, 0)}
+
+    assert client.get('/return-period', params=dict(upstream_of=1)).status_code == 404
+
+
+def test_metrics_endpoint_labels(client):
+    client.get('/export/0123456789abcdef')
+    client.get('/no/such/path')
+    metrics = client.get('/metrics').text
+
+    # Requests are labelled by route template, and unknown paths share one label
+    assert 'nwm_api_requests_total{endpoint="/export/{export_id}"' in metrics
+    assert 'nwm_api_requests_total{endpoint="other",status="404"}' in metrics
+    assert '0123456789abcdef' not in metrics and '/no/such/path' not in metrics
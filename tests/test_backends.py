@@ -0,0 +1,23 @@
+import shutil
+
+from app.backends import DuckDBBackend
+from app.responses import read_arrow_table
+
+from conftest import COMIDS, DATA_DIR, return_period_flow
+
+
+def test_static_tables_of_a_root_with_a_quote(tmp_path):
+    root = tmp_path / "o'neil"
+    root.mkdir()
+    for name in ('stream_network', 'flood_return_periods'):
+        shutil.copy(f'{DATA_DIR}/{name}.parquet', root)
+    backend = DuckDBBackend(str(root))
+
+    assert read_arrow_table(backend.stream_network([COMIDS[3]]))['station_id'].to_pylist() == [COMIDS[3]]
+    assert read_arrow_table(backend.return_periods([COMIDS[1]], [2], False)).to_pylist() == [
+        dict(feature_id=COMIDS[1], return_period_2=return_period_flow(1, 2)),
+    ]
+    assert read_arrow_table(backend.static_table('flood_return_periods')).num_rows == len(COMIDS)
+    assert read_arrow_table(backend.reach_geometries()).num_rows == len(COMIDS)
+    assert read_arrow_table(backend.reach_topology()).num_rows == len(COMIDS)
+    assert read_arrow_table(backend.nearest_reach(40.0, -111.0))['station_id'].to_pylist() == [COMIDS[0]]
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pyarrow as pa
+
+from app.downsampling import downsample, lttb_indices
+
+
+def test_keeps_the_ends_and_the_extremes():
+    x = np.arange(100)
+    y = np.zeros(100)
+    y[37], y[71] = 50, -40
+
+    indices = lttb_indices(x, y, 10)
+    assert len(indices) == 10
+    assert indices[0] == 0 and indices[-1] == 99
+    assert np.all(np.diff(indices) > 0)
+    assert {37, 71} <= set(indices.tolist())
+
+
+def test_short_series_are_kept():
+    assert lttb_indices(np.arange(5), np.arange(5), 5).tolist() == list(range(5))
+    assert lttb_indices(np.arange(5), np.arange(5), 2).tolist() == list(range(5))
+
+
+def test_missing_values_are_avoided():
+    y = np.arange(10, dtype=np.float64)
+    y[1:3] = np.nan
+
+    assert not np.isnan(y[lttb_indices(np.arange(10), y, 4)]).any()
+
+
+def test_downsample_every_reach():
+    times = [datetime(2023, 1, 1) + timedelta(hours=hour) for hour in range(50)]
+    table = pa.table(dict(
+        feature_id=pa.array([1] * 50 + [2] * 3, pa.int64()),
+        time=pa.array(times + times[:3], pa.timestamp('us')),
+        streamflow=pa.array(np.sin(np.arange(50) / 5).tolist() + [1.0, 2.0, 3.0]),
+    ))
+
+    result = downsample(table, 10)
+    counts = dict(zip(*np.unique(result['feature_id'].to_numpy(), return_counts=True)))
+    assert counts == {1: 10, 2: 3}
+    # Ordered by time, then reach, like the analysis-assim records
+    assert result.to_pylist() == sorted(result.to_pylist(), key=lambda row: (row['time'], row['feature_id']))
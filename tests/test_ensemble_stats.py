@@ -0,0 +1,48 @@
+from datetime import timedelta
+
+import pytest
+
+from app import ensemble_stats as module
+from app.ensemble_stats import EnsembleStatsStore
+
+from conftest import COMIDS, REFERENCE_TIME, streamflow
+
+
+def test_materialize_and_read(tmp_path):
+    store = EnsembleStatsStore(str(tmp_path))
+    manifest = store.materialize('medium_range', REFERENCE_TIME)
+
+    assert manifest['rows'] == len(COMIDS) * 3
+    table = store.read('medium_range', REFERENCE_TIME, [COMIDS[1]], ['mean', 'max'])
+    assert table['streamflow_max'].to_pylist() == [streamflow(1, 1, lead_time) for lead_time in (1, 2, 3)]
+
+
+def test_stopped_store_abandons_the_cycle(tmp_path):
+    store = EnsembleStatsStore(str(tmp_path))
+    store.stop()
+
+    with pytest.raises(InterruptedError):
+        store.materialize('medium_range', REFERENCE_TIME)
+    assert store.materialized_cycles('medium_range') == []
+    assert list(tmp_path.iterdir()) == [tmp_path / 'medium_range']
+
+
+def test_seen_cycles_are_pruned(tmp_path, monkeypatch):
+    class Backend:
+        # A new cycle every update, never settled
+        reference_time = REFERENCE_TIME
+
+        def latest_reference_time(self, forecast_type):
+            return self.reference_time
+
+    backend = Backend()
+    monkeypatch.setattr(module, 'get_backend', lambda: backend)
+    store = EnsembleStatsStore(str(tmp_path), cycles=2, settle_seconds=3600)
+    for hour in range(5):
+        backend.reference_time = REFERENCE_TIME + timedelta(hours=6 * hour)
+        assert store.update(now=hour) == []
+
+    assert sorted(store._seen) == [
+        (forecast_type, (REFERENCE_TIME + timedelta(hours=6 * hour)).isoformat())
+        for forecast_type in ('long_range', 'medium_range') for hour in (3, 4)
+    ]
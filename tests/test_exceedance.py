@@ -0,0 +1,59 @@
+from datetime import datetime
+
+import pyarrow as pa
+
+from app.exceedance import EXCEEDANCE_SCHEMA, classify_exceedance, filter_exceedance
+
+REFERENCE_TIME = datetime(2023, 1, 1)
+
+
+def forecast(rows):
+    feature_ids, ensembles, hours, flows = zip(*rows)
+    return pa.table(dict(
+        feature_id=pa.array(feature_ids, pa.int64()),
+        reference_time=pa.array([REFERENCE_TIME] * len(rows), pa.timestamp('us', tz='UTC')),
+        time=pa.array([datetime(2023, 1, 1, hour) for hour in hours], pa.timestamp('us', tz='UTC')),
+        ensemble=pa.array(ensembles, pa.string()),
+        streamflow=pa.array(flows, pa.float64()),
+    ))
+
+
+THRESHOLDS = pa.table(dict(
+    feature_id=pa.array([2, 1], pa.int64()),
+    **{f'return_period_{rp}': [float(rp) + 100, float(rp)] for rp in (2, 5, 10, 25, 50, 100)},
+))
+
+
+def test_peaks_and_highest_return_period():
+    result = classify_exceedance(forecast([
+        (1, '0', 1, 3.0), (1, '0', 2, 12.0), (1, '0', 3, 12.0), (1, '0', 4, 1.0),
+        (1, '1', 1, 60.0),
+        (2, '0', 1, 50.0),
+        (3, '0', 1, 500.0),
+    ]), THRESHOLDS)
+
+    assert result.schema.names == EXCEEDANCE_SCHEMA.names
+    assert result.select(['feature_id', 'ensemble', 'peak_streamflow', 'return_period', 'return_period_streamflow']).to_pylist() == [
+        dict(feature_id=1, ensemble='0', peak_streamflow=12.0, return_period=10, return_period_streamflow=10.0),
+        dict(feature_id=1, ensemble='1', peak_streamflow=60.0, return_period=50, return_period_streamflow=50.0),
+        # Below the 2-year flow of its reach
+        dict(feature_id=2, ensemble='0', peak_streamflow=50.0, return_period=None, return_period_streamflow=None),
+        # Reach without return periods
+        dict(feature_id=3, ensemble='0', peak_streamflow=500.0, return_period=None, return_period_streamflow=None),
+    ]
+    # The first occurrence of the peak is reported
+    assert result['peak_time'][0].as_py().hour == 2
+
+
+def test_selected_return_periods():
+    result = classify_exceedance(forecast([(1, '0', 1, 60.0)]), THRESHOLDS, ['5', '25'])
+    assert result['return_period'].to_pylist() == [25]
+
+
+def test_empty_forecast():
+    assert classify_exceedance(forecast([(1, '0', 1, 1.0)]).slice(0, 0), THRESHOLDS).schema == EXCEEDANCE_SCHEMA
+
+
+def test_filter_exceedance():
+    result = classify_exceedance(forecast([(1, '0', 1, 12.0), (1, '1', 1, 60.0), (2, '0', 1, 50.0)]), THRESHOLDS)
+    assert filter_exceedance(result, 25)['ensemble'].to_pylist() == ['1']
@@ -0,0 +1,49 @@
+import asyncio
+
+import numpy as np
+import pyarrow as pa
+
+from app import forecasts
+from app.backends import get_backend
+from app.forecasts import _split_units, fetch_forecast
+from app.result_cache import ResultCache
+
+from conftest import COMIDS, REFERENCE_TIME, streamflow
+
+
+def test_units_do_not_share_the_buffers_of_the_result():
+    table = pa.table(dict(
+        feature_id=np.repeat(np.arange(100), 10),
+        ensemble=pa.array(['average'] * 1000),
+        time=np.tile(np.arange(10), 100),
+        streamflow=np.arange(1000, dtype=np.float64),
+    ))
+    units = _split_units(table)
+
+    assert len(units) == 100
+    assert units[(7, 'average')]['streamflow'].to_pylist() == list(range(70, 80))
+    # Each unit holds its own rows only, so evicting it frees its memory
+    assert sum(unit.get_total_buffer_size() for unit in units.values()) <= 2 * table.get_total_buffer_size()
+
+
+def test_units_without_data_are_cached(monkeypatch):
+    queries = []
+
+    class CountingBackend:
+        def forecast(self, *args):
+            queries.append(args)
+            return get_backend().forecast(*args)
+
+    monkeypatch.setattr(forecasts, 'result_cache', ResultCache(max_bytes=2 ** 20))
+    monkeypatch.setattr(forecasts, 'get_backend', CountingBackend)
+
+    comids = [COMIDS[1], 42, COMIDS[0]]
+    first = asyncio.run(fetch_forecast('short_range', REFERENCE_TIME, comids, None))
+    second = asyncio.run(fetch_forecast('short_range', REFERENCE_TIME, comids, None))
+
+    # The unknown reach is answered from the cache too, with no row
+    assert len(queries) == 1
+    assert first.table.equals(second.table)
+    assert set(second.table['feature_id'].to_pylist()) == {COMIDS[0], COMIDS[1]}
+    assert second.table.num_rows == 6
+    assert second.table['streamflow'].to_pylist()[:2] == [streamflow(1, 0, 1), streamflow(0, 0, 1)]
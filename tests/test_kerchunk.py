@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+import h5py
+import numpy as np
+import pytest
+
+from app.backends import KerchunkBackend
+from app.responses import read_arrow_table
+
+from conftest import COMIDS, DATA_DIR, FORECAST_LAYOUT, REFERENCE_TIME, streamflow
+
+
+def write_netcdf(path, time, values):
+    # One time of the streamflow and velocity of every reach, packed like the
+    # NWM channel_rt files, with the reaches split into compressed chunks
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(path, 'w') as f:
+        f.create_dataset('feature_id', data=np.array(COMIDS, dtype='i4'))
+        f['feature_id'].make_scale('feature_id')
+        f.create_dataset('time', data=np.array([(time - datetime(1970, 1, 1)) // timedelta(minutes=1)], dtype='i4'))
+        f['time'].attrs['units'] = 'minutes since 1970-01-01 00:00:00 UTC'
+        f['time'].make_scale('time')
+        for name, scale in (('streamflow', 0.01), ('velocity', 0.001)):
+            packed = np.round(np.asarray(values)[None, :] / 10 ** (name == 'velocity') / scale).astype('i4')
+            variable = f.create_dataset(name, data=packed, chunks=(1, 4), compression='gzip', fillvalue=-999900)
+            variable.attrs['scale_factor'] = np.float32(scale)
+            variable.attrs['add_offset'] = np.float32(0)
+            variable.attrs['_FillValue'] = np.int32(-999900)
+            variable.dims[0].attach_scale(f['time'])
+            variable.dims[1].attach_scale(f['feature_id'])
+
+
+@pytest.fixture(scope='module')
+def backend(tmp_path_factory):
+    root = tmp_path_factory.mktemp('netcdf')
+    positions = np.arange(len(COMIDS))
+    day = root / f'nwm.{REFERENCE_TIME:%Y%m%d}'
+    for forecast_type in ('short_range', 'medium_range'):
+        layout = FORECAST_LAYOUT[forecast_type]
+        for member in range(layout['members']):
+            if forecast_type == 'short_range':
+                folder, suffix = 'short_range', 'channel_rt'
+            else:
+                folder, suffix = f'medium_range_mem{member + 1}', f'channel_rt_{member + 1}'
+            for lead_time in range(1, layout['lead_times'] + 1):
+                hours = lead_time * layout['step']
+                write_netcdf(
+                    day / folder / f'nwm.t{REFERENCE_TIME:%H}z.{forecast_type}.{suffix}.f{hours:03d}.conus.nc',
+                    REFERENCE_TIME + timedelta(hours=hours),
+                    streamflow(positions, member, lead_time),
+                )
+
+    # The tm01 analysis of a cycle holds the time an hour before it
+    for hour in range(1, 4):
+        cycle = datetime(2023, 1, 1, hour)
+        write_netcdf(
+            day / 'analysis_assim' / f'nwm.t{cycle:%H}z.analysis_assim.channel_rt.tm01.conus.nc',
+            cycle - timedelta(hours=1),
+            streamflow(positions, 0, hour),
+        )
+
+    return KerchunkBackend(str(root), DATA_DIR)
+
+
+def test_short_range_forecast(backend):
+    table = read_arrow_table(backend.forecast('short_range', REFERENCE_TIME, [COMIDS[5], COMIDS[0], 42], None))
+
+    assert table['feature_id'].to_pylist() == [COMIDS[0], COMIDS[5]] * 3
+    assert table['time'].to_pylist() == [REFERENCE_TIME + timedelta(hours=hours) for hours in (1, 1, 2, 2, 3, 3)]
+    assert table['streamflow'].to_pylist() == pytest.approx([
+        streamflow(position, 0, lead_time) for lead_time in (1, 2, 3) for position in (0, 5)
+    ])
+    assert table['velocity'].to_pylist() == pytest.approx([
+        streamflow(position, 0, lead_time) / 10 for lead_time in (1, 2, 3) for position in (0, 5)
+    ])
+
+
+def test_medium_range_members(backend):
+    # Reaches of two different chunks
+    comids = [COMIDS[2], COMIDS[9]]
+    members = read_arrow_table(backend.forecast('medium_range', REFERENCE_TIME, comids, [1, 0]))
+    assert members.num_rows == 2 * 2 * 3
+    assert {
+        (row['feature_id'], row['ensemble'], row['time']): row['streamflow'] for row in members.to_pylist()
+    } == pytest.approx({
+        (COMIDS[position], member, REFERENCE_TIME + timedelta(hours=3 * lead_time)): streamflow(position, member, lead_time)
+        for position in (2, 9) for member in (0, 1) for lead_time in (1, 2, 3)
+    })
+
+    average = read_arrow_table(backend.forecast('medium_range', REFERENCE_TIME, comids, None))
+    assert set(average['ensemble'].to_pylist()) == {'average'}
+    assert average['streamflow'].to_pylist()[:2] == pytest.approx([
+        (streamflow(position, 0, 1) + streamflow(position, 1, 1)) / 2 for position in (2, 9)
+    ])
+
+
+def test_analysis_assim(backend):
+    table = read_arrow_table(backend.analysis_assim(
+        [COMIDS[14]], 1, datetime(2023, 1, 1, 0), datetime(2023, 1, 1, 1),
+    ))
+
+    assert table['time'].to_pylist() == [datetime(2023, 1, 1, 0), datetime(2023, 1, 1, 1)]
+    assert table['streamflow'].to_pylist() == pytest.approx([streamflow(14, 0, 1), streamflow(14, 0, 2)])
+    assert backend.stats()['reference_indexes']['builds'] >= 3
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app import queries
+
+
+def parameters(query):
+    return {
+        parameter.name: getattr(parameter, 'values', getattr(parameter, 'value', None))
+        for parameter in query.parameters
+    }
+
+
+def test_forecast_average_of_a_cycle():
+    query = queries.forecast('medium_range', '2023-01-01T06:00:00+01:00', [3, 1, 2, 1], None)
+
+    assert 'medium_range_channel_rt' in query.sql
+    assert "'average' AS ensemble" in query.sql
+    assert 'reference_time = @reference_time' in query.sql
+    values = parameters(query)
+    # The ids are deduplicated and sorted, the reference time converted to UTC
+    assert values['comids'] == [1, 2, 3]
+    assert values['reference_time'] == datetime(2023, 1, 1, 5)
+
+
+def test_forecast_members_of_the_latest_cycle():
+    query = queries.forecast('short_range', None, [1], [0])
+
+    assert 'ensemble IN UNNEST(@ensembles)' in query.sql
+    assert 'MAX(reference_time)' in query.sql
+    values = parameters(query)
+    assert values['ensembles'] == [0]
+    # The latest cycle is searched from the start of the previous day only
+    assert values['since'] <= datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=1)
+
+
+def test_equivalent_requests_build_the_same_query():
+    first = queries.forecast('long_range', '2023-01-01', [2, 1], [1, 0])
+    second = queries.forecast('long_range', datetime(2023, 1, 1), [1, 2, 2], [0, 1])
+
+    assert first.sql == second.sql
+    assert parameters(first) == parameters(second)
+
+
+def test_forecast_cycles_of_a_list():
+    query = queries.forecast_cycles(
+        'medium_range', '2023-01-01', '2023-01-02', ['2023-01-02', '2023-01-01'], [1], None,
+    )
+
+    assert 'reference_time IN UNNEST(@reference_times)' in query.sql
+    assert 'TIMESTAMP_DIFF(time, reference_time, HOUR) AS lead_time' in query.sql
+    assert parameters(query)['reference_times'] == [datetime(2023, 1, 1), datetime(2023, 1, 2)]
+
+
+def test_analysis_assim_aggregates():
+    query = queries.analysis_assim([1], 2, '2023-01-01', '2023-02-01', 'daily', ['mean', 'p95'])
+
+    assert 'TIMESTAMP_TRUNC(time, DAY) AS time' in query.sql
+    assert 'AVG(streamflow) AS streamflow_mean' in query.sql
+    assert 'APPROX_QUANTILES(velocity, 100)[OFFSET(95)] AS velocity_p95' in query.sql
+    assert 'COUNT(*) AS count' in query.sql
+    assert parameters(query)['run_offset'] == 2
+
+
+def test_parse_statistics():
+    assert queries.parse_statistics(None) == ['mean']
+    assert queries.parse_statistics(['max', 'p5', 'max']) == ['max', 'p5']
+    with pytest.raises(ValueError):
+        queries.parse_statistics(['p100'])
+    with pytest.raises(ValueError):
+        queries.parse_statistics(['mean); DROP TABLE x; --'])
+
+
+def test_return_periods_columns():
+    query = queries.return_periods([2, 1], ['10', '2', '10'], True)
+
+    assert 'feature_id,\n            return_period_10,\n            return_period_2' in query.sql
+    assert query.sql.rstrip().endswith('ORDER BY feature_id')
+    with pytest.raises(ValueError):
+        queries.return_periods([1], ['3'], False)
+
+
+def test_nearest_reach_bounds_the_search():
+    assert 'ST_DWITHIN' not in queries.nearest_reach(40, -111).sql
+
+    query = queries.nearest_reach(40, -111, 3, 500)
+    assert 'ST_DWITHIN' in query.sql
+    assert parameters(query)['max_distance'] == 500.0
+    assert parameters(query)['k'] == 3
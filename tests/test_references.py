@@ -0,0 +1,69 @@
+import base64
+import json
+from collections import OrderedDict
+
+import numpy as np
+
+from app import references
+from app.references import ChunkCache, ChunkReader, ReferenceIndex
+
+
+def inline(values):
+    return 'base64:' + base64.b64encode(np.asarray(values, '<i4').tobytes()).decode()
+
+
+def zarray(shape, chunks):
+    return json.dumps(dict(
+        shape=shape, chunks=chunks, dtype='<i4', compressor=None, filters=None, fill_value=None, order='C', zarr_format=2,
+    ))
+
+
+def index():
+    # Two times of four reaches, with two reaches per chunk
+    return ReferenceIndex(dict(version=1, refs={
+        '.zattrs': json.dumps(dict(version=1)),
+        'feature_id/.zarray': zarray([4], [2]),
+        'feature_id/0': inline([40, 10]),
+        'feature_id/1': inline([30, 20]),
+        'time/.zarray': zarray([2], [2]),
+        'time/.zattrs': json.dumps(dict(units='hours since 2023-01-01 00:00')),
+        'time/0': inline([1, 2]),
+        'streamflow/.zarray': zarray([2, 4], [2, 2]),
+        'streamflow/.zattrs': json.dumps(dict(scale_factor=0.5)),
+        'streamflow/0.0': inline([[1, 2], [5, 6]]),
+        'streamflow/0.1': inline([[3, 4], [7, 8]]),
+    }))
+
+
+class CountingReader(ChunkReader):
+    def __init__(self):
+        super().__init__({}, ChunkCache(None, 0))
+        self.references = []
+
+    def read(self, references):
+        self.references.extend(references)
+        return super().read(references)
+
+
+def test_read_reaches():
+    feature_ids, times, values = index().read(['streamflow'], [20, 40, 99], CountingReader())
+
+    assert feature_ids.tolist() == [40, 20]
+    assert times.astype(str).tolist() == ['2023-01-01T01:00:00', '2023-01-01T02:00:00']
+    assert values['streamflow'].tolist() == [[0.5, 2.0], [2.5, 4.0]]
+
+
+def test_feature_ids_are_hashed_once(monkeypatch):
+    monkeypatch.setattr(references, '_feature_ids', OrderedDict())
+    monkeypatch.setattr(references, '_feature_id_references', OrderedDict())
+    reader = CountingReader()
+    first = index()
+    first.read(['streamflow'], [10], reader)
+    assert any(reference == first.refs['feature_id/0'] for reference in reader.references)
+
+    # Neither the same index nor another one with the same feature_id
+    # references read the feature_id chunks again
+    reader.references.clear()
+    first.read(['streamflow'], [30], reader)
+    index().read(['streamflow'], [30], reader)
+    assert not any(reference in (first.refs['feature_id/0'], first.refs['feature_id/1']) for reference in reader.references)
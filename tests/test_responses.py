@@ -0,0 +1,92 @@
+import asyncio
+import io
+import json
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from fastapi import HTTPException
+
+from app.responses import format_datetimes, format_response, iter_record_batches, read_arrow_table
+from app.result_cache import ArrowRows
+
+TABLE = pa.table(dict(
+    feature_id=pa.array([1, 2, 3], pa.int64()),
+    time=pa.array([datetime(2023, 1, 1, hour) for hour in range(3)], pa.timestamp('us', tz='UTC')),
+    streamflow=pa.array([1.5, None, 3.0], pa.float64()),
+))
+
+
+class Row(dict):
+    # Mapping-like row, as returned by the BigQuery client
+    pass
+
+
+def encode(results, output_format):
+    async def read():
+        response = await format_response(results, output_format)
+        chunks = [chunk async for chunk in response.body_iterator]
+        return response, b''.join(chunk.encode() if isinstance(chunk, str) else chunk for chunk in chunks)
+
+    return asyncio.run(read())
+
+
+def test_json():
+    response, body = encode(ArrowRows(TABLE), 'json')
+
+    assert response.media_type == 'application/json'
+    assert json.loads(body) == [
+        dict(feature_id=1, time='2023-01-01T00:00:00', streamflow=1.5),
+        dict(feature_id=2, time='2023-01-01T01:00:00', streamflow=None),
+        dict(feature_id=3, time='2023-01-01T02:00:00', streamflow=3.0),
+    ]
+
+
+def test_csv():
+    _, body = encode(ArrowRows(TABLE), 'CSV')
+
+    assert body.decode().split('\r\n') == [
+        'feature_id,time,streamflow',
+        '1,2023-01-01T00:00:00,1.5',
+        '2,2023-01-01T01:00:00,',
+        '3,2023-01-01T02:00:00,3.0',
+        '',
+    ]
+
+
+@pytest.mark.parametrize('output_format', ['parquet', 'arrow'])
+def test_columnar_formats_keep_the_types(output_format):
+    response, body = encode(ArrowRows(TABLE), output_format)
+
+    if output_format == 'parquet':
+        table = pq.read_table(io.BytesIO(body))
+    else:
+        table = pa.ipc.open_stream(body).read_all()
+    assert table.equals(TABLE)
+    assert response.headers['content-disposition'] == f'attachment; filename=nwm.{output_format}'
+
+
+@pytest.mark.parametrize('output_format,expected', [('json', b'[]'), ('csv', b'')])
+def test_empty_results(output_format, expected):
+    assert encode([], output_format)[1] == expected
+
+
+def test_unsupported_format():
+    with pytest.raises(HTTPException) as error:
+        encode([], 'xml')
+    assert error.value.status_code == 400
+
+
+def test_rows_are_read_as_record_batches():
+    rows = [Row(feature_id=position, streamflow=float(position)) for position in range(2500)]
+
+    batches = list(iter_record_batches(rows))
+    assert [batch.num_rows for batch in batches] == [1000, 1000, 500]
+    assert read_arrow_table(rows)['feature_id'].to_pylist() == list(range(2500))
+    assert read_arrow_table([]).num_columns == 0
+
+
+def test_format_datetimes_keeps_the_nulls():
+    batch = pa.record_batch([pa.array([datetime(2023, 5, 1, 12, 30), None], pa.timestamp('s'))], names=['time'])
+    assert format_datetimes(batch).column(0).to_pylist() == ['2023-05-01T12:30:00', None]
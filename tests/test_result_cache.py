@@ -0,0 +1,144 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pyarrow as pa
+
+from app.result_cache import ArrowRows, ResultCache, forecast_key, forecast_ttl
+from app.singleflight import SingleFlight
+
+
+def table(rows, value=0.0):
+    return pa.table(dict(feature_id=list(range(rows)), streamflow=[value] * rows))
+
+
+def test_memory_lru_eviction():
+    first, second = table(100), table(100)
+    cache = ResultCache(max_bytes=first.nbytes + second.nbytes)
+    cache.put(('a',), first)
+    cache.put(('b',), second)
+
+    # Reading a refreshes it, so b is the least recently used entry
+    assert cache.get(('a',)) is first
+    cache.put(('c',), table(100))
+
+    assert cache.get(('b',)) is None
+    assert cache.get(('a',)) is first
+    stats = cache.stats()
+    assert stats['evictions'] == 1 and stats['entries'] == 2
+    assert stats['memory_hits'] == 2 and stats['misses'] == 1
+
+
+def test_ttl():
+    cache = ResultCache(max_bytes=2 ** 20)
+    cache.put(('recent',), table(1), ttl=-1)
+    cache.put(('immutable',), table(1))
+
+    assert cache.get(('recent',)) is None
+    assert cache.get(('immutable',)) is not None
+
+    # The expired result is removed rather than left in the LRU
+    stats = cache.stats()
+    assert stats['entries'] == 1 and stats['misses'] == 1
+
+
+def test_expired_result_is_removed_from_disk(tmp_path):
+    cache = ResultCache(max_bytes=2 ** 20, directory=str(tmp_path), disk_max_bytes=2 ** 20)
+    cache.put(('key',), table(1))
+    cache.put(('key',), table(2), ttl=-1)
+
+    assert cache.get(('key',)) is None
+    assert list(tmp_path.glob('*.arrow')) == []
+
+
+def test_disk_tier(tmp_path):
+    cached = table(10, 1.5)
+    cache = ResultCache(max_bytes=0, directory=str(tmp_path), disk_max_bytes=2 ** 20)
+    cache.put(('key',), cached)
+
+    # Nothing fits in memory, so the table is read back from its Arrow file
+    assert cache.get(('key',)).equals(cached)
+    assert cache.stats()['disk_hits'] == 1
+
+    # Results that may still change are not persisted
+    cache.put(('recent',), cached, ttl=60)
+    assert len(list(tmp_path.glob('*.arrow'))) == 1
+
+
+def test_disk_lru_eviction(tmp_path):
+    cache = ResultCache(max_bytes=0, directory=str(tmp_path), disk_max_bytes=2 ** 20)
+    for name in ('a', 'b'):
+        cache.put((name,), table(10))
+    size = cache.stats()['disk_bytes'] // 2
+
+    # Reading a refreshes it, then c only leaves room for two files
+    cache = ResultCache(max_bytes=0, directory=str(tmp_path), disk_max_bytes=2 * size)
+    assert cache.stats()['disk_bytes'] == 2 * size
+    assert cache.get(('a',)) is not None
+    cache.put(('c',), table(10))
+    assert cache.get(('b',)) is None
+    assert cache.get(('a',)) is not None and cache.get(('c',)) is not None
+
+    # A file already removed by another worker is skipped
+    for path in tmp_path.glob('*.arrow'):
+        path.unlink()
+    cache.put(('d',), table(10))
+    cache.put(('e',), table(10))
+    assert cache.get(('d',)) is not None and cache.get(('e',)) is not None
+
+
+def test_cached_table_runs_one_query_for_concurrent_callers():
+    cache = ResultCache(max_bytes=2 ** 20)
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return ArrowRows(table(5))
+
+    async def run():
+        return await asyncio.gather(*[cache.cached_table(('key',), fetch) for _ in range(10)])
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(result.table.num_rows == 5 for result in results)
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 42
+
+    async def run():
+        concurrent = await asyncio.gather(*[flights.do(('key',), work) for _ in range(5)])
+        # Once the flight has landed the next call runs the work again
+        return concurrent, await flights.do(('key',), work)
+
+    concurrent, later = asyncio.run(run())
+    assert concurrent == [42] * 5 and later == 42
+    assert len(calls) == 2
+    assert flights.stats() == dict(calls=6, coalesced=4, in_flight=0)
+
+
+def test_single_flight_shares_the_exception():
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError('query failed')
+
+    async def run():
+        return await asyncio.gather(*[flights.do(('key',), fail) for _ in range(3)], return_exceptions=True)
+
+    assert [str(error) for error in asyncio.run(run())] == ['query failed'] * 3
+
+
+def test_forecast_keys_and_ttl():
+    utc = datetime(2023, 1, 1, 6, tzinfo=timezone.utc)
+    local = datetime(2023, 1, 1, 7, tzinfo=timezone(timedelta(hours=1)))
+    assert forecast_key('short_range', utc, 1, 0) == forecast_key('short_range', local, 1, 0)
+
+    assert forecast_ttl(utc) is None
+    assert forecast_ttl(datetime.now(timezone.utc)) > 0
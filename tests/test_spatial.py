@@ -0,0 +1,169 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+
+from app.spatial import EARTH_RADIUS, ReachIndex, parse_vertices, read_points
+
+GEOMETRIES = pa.table(dict(
+    station_id=pa.array([11, 12, 13, 14], pa.int64()),
+    geometry=[
+        'LINESTRING (-111.0 40.0, -111.0 40.01, -111.0 40.02)',
+        'MULTILINESTRING ((-110.9 40.0, -110.9 40.01), (-110.8 40.0, -110.8 40.01))',
+        None,
+        'LINESTRING EMPTY',
+    ],
+))
+
+
+def haversine(lat, lon, lats, lons):
+    lat, lon, lats, lons = map(np.radians, (lat, lon, np.asarray(lats), np.asarray(lons)))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def line_distance(lat, lon, coordinates, samples=20001):
+    # Brute-force distance to a line, densely sampled along its great-circle segments
+    vectors = np.array([
+        [np.cos(np.radians(y)) * np.cos(np.radians(x)), np.cos(np.radians(y)) * np.sin(np.radians(x)), np.sin(np.radians(y))]
+        for x, y in coordinates
+    ])
+    distances = []
+    for start, end in zip(vectors[:-1], vectors[1:]):
+        angle = np.arccos(np.clip(start @ end, -1, 1))
+        fractions = np.linspace(0, 1, samples)[:, None]
+        points = (np.sin((1 - fractions) * angle) * start + np.sin(fractions * angle) * end) / np.sin(angle)
+        lats, lons = np.degrees(np.arcsin(points[:, 2])), np.degrees(np.arctan2(points[:, 1], points[:, 0]))
+        distances.append(haversine(lat, lon, lats, lons).min())
+    return min(distances)
+
+
+def dense_points(geometries, samples=2001):
+    # Points every few meters along the great-circle segments of the lines, with the index of their reach
+    lats, lons, reaches = [], [], []
+    for reach, coordinates in enumerate(geometries):
+        vectors = np.radians(np.array(coordinates))
+        vectors = np.column_stack([
+            np.cos(vectors[:, 1]) * np.cos(vectors[:, 0]), np.cos(vectors[:, 1]) * np.sin(vectors[:, 0]), np.sin(vectors[:, 1]),
+        ])
+        for start, end in zip(vectors[:-1], vectors[1:]):
+            angle = np.arccos(np.clip(start @ end, -1, 1))
+            fractions = np.linspace(0, 1, samples)[:, None]
+            points = (np.sin((1 - fractions) * angle) * start + np.sin(fractions * angle) * end) / np.sin(angle)
+            lats.append(np.degrees(np.arcsin(points[:, 2])))
+            lons.append(np.degrees(np.arctan2(points[:, 1], points[:, 0])))
+            reaches.append(np.full(samples, reach))
+    return np.concatenate(lats), np.concatenate(lons), np.concatenate(reaches)
+
+
+def test_parse_vertices():
+    parents, lines, lons, lats = parse_vertices(GEOMETRIES['geometry'])
+
+    assert parents.tolist() == [0, 0, 0, 1, 1, 1, 1]
+    assert lines.tolist() == [0, 0, 0, 1, 1, 2, 2]
+    assert lons.tolist() == [-111.0, -111.0, -111.0, -110.9, -110.9, -110.8, -110.8]
+    assert lats.tolist()[:3] == [40.0, 40.01, 40.02]
+
+
+def test_nearest_reach_of_every_point():
+    index = ReachIndex.from_table(GEOMETRIES)
+    matches = index.nearest([40.01, 40.0, 40.005], [-111.001, -110.81, -110.9])
+
+    assert matches['point'].to_pylist() == [0, 1, 2]
+    assert matches['station_id'].to_pylist() == [11, 12, 12]
+    assert matches['distance'][0].as_py() == pytest.approx(haversine(40.01, -111.001, 40.01, -111.0), rel=1e-6)
+
+
+def test_k_nearest_reaches_and_max_distance():
+    index = ReachIndex.from_table(GEOMETRIES)
+    matches = index.nearest([40.0, 0.0], [-111.0, 0.0], k=3, max_distance=20000)
+
+    # The far away point has no match, the reaches are ordered by distance
+    assert matches['point'].to_pylist() == [0, 0]
+    assert matches['station_id'].to_pylist() == [11, 12]
+    assert matches['distance'][0].as_py() == pytest.approx(0, abs=1e-6)
+    assert np.all(np.diff(matches['distance'].to_numpy()) >= 0)
+
+
+def test_distance_to_the_line_rather_than_the_vertices():
+    index = ReachIndex.from_table(pa.table(dict(
+        station_id=pa.array([21, 22], pa.int64()),
+        geometry=[
+            # A long, sparsely sampled segment passing about 100 m from the point
+            'LINESTRING (-111.2 40.0009, -110.8 40.0009)',
+            # A short reach whose vertex is 500 m away, closer than the ends of the long one
+            'LINESTRING (-111.0 39.9955, -111.0 39.99)',
+        ],
+    )))
+    matches = index.nearest([40.0], [-111.0], k=2)
+
+    assert matches['station_id'].to_pylist() == [21, 22]
+    assert matches['distance'][0].as_py() == pytest.approx(line_distance(40.0, -111.0, [(-111.2, 40.0009), (-110.8, 40.0009)]), abs=0.01)
+    assert matches['distance'][1].as_py() == pytest.approx(haversine(40.0, -111.0, 39.9955, -111.0), rel=1e-6)
+
+    # The reach is within max_distance of the point even though its vertices are not
+    assert index.nearest([40.0], [-111.0], max_distance=200)['station_id'].to_pylist() == [21]
+    assert index.nearest([40.0], [-111.0], max_distance=50).num_rows == 0
+
+
+def test_lines_of_multi_part_geometries_are_not_joined():
+    index = ReachIndex.from_table(GEOMETRIES)
+
+    # Halfway between the two lines of reach 12, 4 km from both of them
+    matches = index.nearest([40.005], [-110.85])
+    assert matches['station_id'].to_pylist() == [12]
+    assert matches['distance'][0].as_py() == pytest.approx(haversine(40.005, -110.85, 40.005, -110.8), rel=1e-3)
+
+
+def test_snapshot(tmp_path):
+    index = ReachIndex.from_table(GEOMETRIES)
+    path = str(tmp_path / 'index.npz')
+    index.save(path)
+
+    loaded = ReachIndex.load(path)
+    assert loaded.stats() == index.stats()
+    assert loaded.in_bbox(-110.95, 39.9, -110.0, 41.0).tolist() == [12]
+
+
+def test_read_points():
+    csv = read_points(b'id,lat,lon\na,40.0,-111.0\nb,41.0,-112.0\n', 'text/csv')
+    assert csv.to_pylist() == [dict(id='a', lat=40.0, lon=-111.0), dict(id='b', lat=41.0, lon=-112.0)]
+
+    geojson = read_points(
+        b'{"type": "FeatureCollection", "features": [{"type": "Feature", "id": 7,'
+        b' "geometry": {"type": "Point", "coordinates": [-111.0, 40.0]}}]}',
+        'application/json',
+    )
+    assert geojson.to_pylist() == [dict(id=7, lat=40.0, lon=-111.0)]
+
+    with pytest.raises(ValueError):
+        read_points(b'[{"lat": 40.0}]', 'application/json')
+
+
+def test_batch_k_nearest_against_brute_force():
+    rng = np.random.default_rng(3)
+    geometries = []
+    for _ in range(40):
+        # Lines of a few long, sparsely sampled segments around the same area
+        steps = rng.normal(0, 0.05, (rng.integers(2, 5), 2))
+        geometries.append((np.array([-111.0, 40.0]) + rng.uniform(-0.5, 0.5, 2) + np.cumsum(steps, axis=0)).tolist())
+    index = ReachIndex.from_table(pa.table(dict(
+        station_id=pa.array(np.arange(100, 140), pa.int64()),
+        geometry=['LINESTRING (' + ', '.join(f'{x} {y}' for x, y in line) + ')' for line in geometries],
+    )))
+    lats, lons = 40.0 + rng.uniform(-0.6, 0.6, 150), -111.0 + rng.uniform(-0.6, 0.6, 150)
+
+    k, max_distance = 4, 8000
+    matches = index.nearest(lats, lons, k=k, max_distance=max_distance)
+
+    dense_lats, dense_lons, dense_reaches = dense_points(geometries)
+    for point in range(len(lats)):
+        distances = haversine(lats[point], lons[point], dense_lats, dense_lons)
+        reach_distances = np.full(len(geometries), np.inf)
+        np.minimum.at(reach_distances, dense_reaches, distances)
+        expected = np.sort(reach_distances)[:k]
+        expected = expected[expected <= max_distance]
+
+        found = matches.filter(pc.equal(matches['point'], point))
+        assert found['distance'].to_numpy() == pytest.approx(expected, abs=3)
+        assert reach_distances[found['station_id'].to_numpy() - 100] == pytest.approx(found['distance'].to_numpy(), abs=3)
@@ -0,0 +1,28 @@
+import os
+
+from app.static_tables import StaticTables
+
+from conftest import COMIDS, return_period_flow
+
+
+def test_refresh_versions(tmp_path):
+    tables = StaticTables(str(tmp_path))
+    for _ in range(3):
+        entry = tables.refresh('flood_return_periods')
+
+    assert entry['version'] == 3
+    assert sorted(os.listdir(tmp_path)) == [
+        'flood_return_periods.v2.arrow', 'flood_return_periods.v3.arrow', 'manifest.json',
+    ]
+    table = tables.get('flood_return_periods')
+    assert table.version == 3
+    assert table.take([COMIDS[2], 1])['return_period_2'].to_pylist() == [return_period_flow(2, 2)]
+
+
+def test_get_does_not_wait_for_the_lock(tmp_path):
+    tables = StaticTables(str(tmp_path))
+    tables.refresh('stream_network')
+
+    # A refresh holding the lock to swap the tables does not block the readers
+    with tables._lock:
+        assert tables.get('stream_network').version == 1
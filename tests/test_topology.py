@@ -0,0 +1,92 @@
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from app.topology import NetworkTopology
+
+
+def network(downstream):
+    station_ids = list(downstream)
+    return NetworkTopology.from_table(pa.table(dict(
+        station_id=pa.array(station_ids, pa.int64()),
+        to=pa.array([downstream[station_id] for station_id in station_ids], pa.int64()),
+    )))
+
+
+# Two headwaters joining at 3, then 3 and a tributary joining at 5, the outlet;
+# 7 flows out of the network and 8 into itself
+TREE = {1: 3, 2: 3, 3: 5, 4: 5, 5: None, 6: 4, 7: 100, 8: 8}
+
+
+def brute_force_basin(downstream, comid):
+    basin, changed = {comid}, True
+    while changed:
+        changed = False
+        for station_id, target in downstream.items():
+            if target in basin and station_id not in basin:
+                basin.add(station_id)
+                changed = True
+    return basin
+
+
+def test_upstream_basin():
+    topology = network(TREE)
+
+    basin = topology.upstream_of(5).tolist()
+    assert basin[0] == 5
+    assert sorted(basin) == [1, 2, 3, 4, 5, 6]
+    assert topology.upstream_of(1).tolist() == [1]
+
+
+def test_downstream_path():
+    topology = network(TREE)
+
+    assert topology.downstream_of(6).tolist() == [6, 4, 5]
+    assert topology.downstream_of(7).tolist() == [7]
+    assert topology.downstream_of(8).tolist() == [8]
+
+
+def test_reaches_combines_basin_and_path():
+    topology = network(TREE)
+
+    # The basin of 3, then the reaches of the path from 1 not already in it
+    assert topology.reaches(upstream_of=3, downstream_of=1) == [3, 1, 2, 5]
+
+
+def test_limits_and_unknown_reaches():
+    topology = network(TREE)
+
+    with pytest.raises(ValueError):
+        topology.upstream_of(5, max_reaches=3)
+    with pytest.raises(ValueError):
+        topology.downstream_of(6, max_reaches=2)
+    with pytest.raises(KeyError):
+        topology.upstream_of(42)
+
+
+def test_cycles_terminate():
+    topology = network({1: 2, 2: 3, 3: 1, 4: 1})
+
+    assert sorted(topology.upstream_of(1).tolist()) == [1, 2, 3, 4]
+    assert topology.downstream_of(4).tolist() == [4, 1, 2, 3]
+
+
+def test_random_network_against_brute_force(tmp_path):
+    rng = np.random.default_rng(0)
+    station_ids = rng.permutation(np.arange(10, 510)).tolist()
+    downstream = {
+        station_id: (station_ids[rng.integers(0, position)] if position >= 5 else None)
+        for position, station_id in enumerate(station_ids)
+    }
+    topology = network(downstream)
+    path = str(tmp_path / 'topology.npz')
+    topology.save(path)
+    loaded = NetworkTopology.load(path)
+
+    for comid in station_ids[:50]:
+        assert set(loaded.upstream_of(comid).tolist()) == brute_force_basin(downstream, comid)
+        expected = [comid]
+        while downstream[expected[-1]] is not None:
+            expected.append(downstream[expected[-1]])
+        assert loaded.downstream_of(comid).tolist() == expected
+    assert loaded.stats() == dict(reaches=500, outlets=5)